@@ -4,18 +4,25 @@
     'summary': """Spain Veri*Factu law adaptation""",
     'author': "Raul Paz from Visualcom S.L.",
     'category': 'Accounting & Finance',
-    'version': '1.0',
+    'version': '1.3',
     'website': "http://www.visualcom.es",
     'depends': ['account_cancel'],
     'data': [
         'data/account.invoice.verifactu.type.csv',
         'data/ir_config_parameters.xml',
+        'data/ir_cron.xml',
         'views/res_company_view.xml',
         'views/res_config_settings_view.xml',
         'views/account_invoice_view.xml',
         'views/account_invoice_verifactu_view.xml',
+        'views/account_invoice_verifactu_batch_view.xml',
+        'views/account_invoice_verifactu_flow_view.xml',
+        'views/account_invoice_verifactu_breaker_view.xml',
+        'views/account_invoice_verifactu_requirement_view.xml',
+        'views/account_invoice_verifactu_timing_view.xml',
         'views/account_tax_view.xml',
         'wizard/account_invoice_verifactu_refund_view.xml',
+        'wizard/account_invoice_verifactu_export_view.xml',
         'reports/account_verifactu_report.xml',
     ],
     'license': 'AGPL-3',
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+'''
+Servidor SOAP simulado de la AEAT (VerifactuSOAP y RequerimientoSOAP) para pruebas de carga y
+de fallos sin salir de la máquina.
+
+Acepta los sobres RegFactuSistemaFacturacion que genera el módulo y responde con un
+RespuestaRegFactuSistemaFacturacion realista: CSV, TiempoEsperaEnvio, EstadoEnvio
+(Correcto / ParcialmenteCorrecto / Incorrecto) y una RespuestaLinea por registro, con
+EstadoRegistro, CodigoErrorRegistro y DescripcionErrorRegistro. Puede añadir latencia,
+rechazar líneas, limitar las peticiones por segundo (HTTP 429), fallar con HTTP 5xx o
+devolver páginas de error HTML como las de la sede electrónica.
+
+Sólo usa la biblioteca estándar; --generate-certs necesita ``cryptography`` (ya instalada
+como dependencia de signxml). Uso:
+
+    python3 benchmarks/aeat_mock_server.py --generate-certs /tmp/aeat-mock
+    python3 benchmarks/aeat_mock_server.py --certs /tmp/aeat-mock --port 8443 --line-error-rate 0.05
+
+--generate-certs crea en el directorio una CA de pruebas (ca.pem), el certificado del
+servidor para localhost (server.pem, server.key) y un certificado de cliente (client.p12,
+contraseña --p12-password) para cargar en la compañía. Con --certs el servidor exige
+certificado de cliente firmado por esa CA (mTLS), igual que la AEAT.
+
+Para enviar al servidor simulado basta con los parámetros del sistema existentes:
+    account_verifactu.verifactu_endpoint_no_produccion_verificable
+        https://localhost:8443/wlpl/TIKE-CONT/ws/SistemaFacturacion/VerifactuSOAP
+    account_verifactu.verifactu_endpoint_no_produccion_no_verificable
+        https://localhost:8443/wlpl/TIKE-CONT/ws/SistemaFacturacion/RequerimientoSOAP
+    account_verifactu.ssl_verify
+        /tmp/aeat-mock/ca.pem
+
+Comportamiento configurable (ver --help): --latency/--jitter (ms), --line-error-rate
+(líneas Incorrecto), --accepted-errors-rate (líneas AceptadoConErrores), --wait
+(TiempoEsperaEnvio), --max-rps (por encima responde 429), --error-rate/--error-status
+(HTTP 5xx), --html-rate/--html-status (página HTML), --fault-rate (SOAP Fault) y --seed.
+Los registros ya aceptados se rechazan como duplicados salvo con --allow-duplicates.
+'''
+import argparse
+import datetime
+import logging
+import os
+import random
+import ssl
+import string
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+_logger = logging.getLogger('aeat_mock')
+
+SOAPENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+_XSD = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/'
+TIK_NS = _XSD + 'SuministroInformacion.xsd'
+TIKR_NS = _XSD + 'RespuestaSuministro.xsd'
+
+SERVICES = ('/ws/SistemaFacturacion/VerifactuSOAP', '/ws/SistemaFacturacion/RequerimientoSOAP')
+
+MAX_REGISTERS_PER_ENVELOPE = 1000
+
+# Errores que rechazan el registro (EstadoRegistro = Incorrecto)
+LINE_ERRORS = (
+    ('1100', 'Valor o tipo incorrecto del campo: ImporteTotal.'),
+    ('1104', 'Valor del campo NumSerieFactura es incorrecto.'),
+    ('1189', 'Si TipoFactura es F1 o F3 o R1 o R2 o R3 o R4 el bloque Destinatarios tiene que estar cumplimentado.'),
+    ('1211', 'El bloque Tercero no puede estar cumplimentado si EmitidaPorTerceroODestinatario es distinto de T.'),
+)
+# Errores admitidos (EstadoRegistro = AceptadoConErrores)
+ACCEPTED_ERRORS = (
+    ('2000', 'El cálculo de la huella suministrada es incorrecta.'),
+    ('2001', 'El NIF del bloque Destinatarios no está identificado en el censo de la AEAT.'),
+)
+DUPLICATE_ERROR = ('3000', 'Registro de facturación duplicado.')
+SCHEMA_FAULT = 'Codigo[4102].El XML no cumple con el esquema. Falta informar campo obligatorio.: %s'
+
+HTML_ERROR_PAGE = '''<!DOCTYPE html>
+<html lang="es">
+<head><meta charset="utf-8"><title>Agencia Tributaria: Error</title></head>
+<body>
+<div class="AEAT_error">
+<h1>Se ha producido un error</h1>
+<p>En estos momentos no es posible atender su petición. Por favor, inténtelo más tarde.</p>
+<p>Código de error: %(code)s</p>
+</div>
+</body>
+</html>
+'''
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+
+def _child(element, *path):
+    ''' Primer descendiente que sigue ``path`` (nombres locales) '''
+    for name in path:
+        if element is None:
+            return None
+        element = next((child for child in element if _local(child.tag) == name), None)
+    return element
+
+
+def _text(element, *path):
+    element = _child(element, *path)
+    return (element.text or '').strip() if element is not None else ''
+
+
+def parse_request(data):
+    '''
+    Lee el sobre RegFactuSistemaFacturacion.
+    :return: (cabecera, registros); cabecera es un dict y cada registro es
+             (tipo_operacion, nif_emisor, num_serie, fecha_expedicion)
+    '''
+    root = ET.fromstring(data)
+    reg_factu = next((e for e in root.iter() if _local(e.tag) == 'RegFactuSistemaFacturacion'), None)
+    if reg_factu is None:
+        raise ValueError('RegFactuSistemaFacturacion')
+    cabecera_node = _child(reg_factu, 'Cabecera')
+    if cabecera_node is None:
+        raise ValueError('Cabecera')
+    cabecera = {
+        'nombre_razon': _text(cabecera_node, 'ObligadoEmision', 'NombreRazon'),
+        'nif': _text(cabecera_node, 'ObligadoEmision', 'NIF'),
+        'ref_requerimiento': _text(cabecera_node, 'RemisionRequerimiento', 'RefRequerimiento'),
+        'fin_requerimiento': _text(cabecera_node, 'RemisionRequerimiento', 'FinRequerimiento'),
+    }
+    if not cabecera['nif']:
+        raise ValueError('NIF')
+    registros = []
+    for registro_factura in reg_factu:
+        if _local(registro_factura.tag) != 'RegistroFactura':
+            continue
+        for registro in registro_factura:
+            name = _local(registro.tag)
+            if name == 'RegistroAlta':
+                registros.append(('Alta',
+                                  _text(registro, 'IDFactura', 'IDEmisorFactura'),
+                                  _text(registro, 'IDFactura', 'NumSerieFactura'),
+                                  _text(registro, 'IDFactura', 'FechaExpedicionFactura')))
+            elif name == 'RegistroAnulacion':
+                registros.append(('Anulacion',
+                                  _text(registro, 'IDFactura', 'IDEmisorFacturaAnulada'),
+                                  _text(registro, 'IDFactura', 'NumSerieFacturaAnulada'),
+                                  _text(registro, 'IDFactura', 'FechaExpedicionFacturaAnulada')))
+    return cabecera, registros
+
+
+class MockAeat(object):
+    ''' Estado compartido por las peticiones: aleatoriedad, límite de peticiones y registros aceptados '''
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.accepted = set()
+        self.window = []
+        self.stats = Counter()
+
+    def _rand(self):
+        with self.lock:
+            return self.random.random()
+
+    def throttled(self):
+        ''' Ventana deslizante de un segundo con como máximo --max-rps peticiones '''
+        if not self.options.max_rps:
+            return False
+        now = time.time()
+        with self.lock:
+            self.window = [t for t in self.window if t > now - 1.0]
+            if len(self.window) >= self.options.max_rps:
+                return True
+            self.window.append(now)
+            return False
+
+    def delay(self):
+        latency = self.options.latency + self.options.jitter * self._rand()
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+    def outcome(self):
+        ''' Fallo inyectado para la petición: None, 'error', 'html' o 'fault' '''
+        for kind, rate in (('error', self.options.error_rate), ('html', self.options.html_rate),
+                           ('fault', self.options.fault_rate)):
+            if rate and self._rand() < rate:
+                return kind
+        return None
+
+    def csv(self):
+        with self.lock:
+            return 'A-' + ''.join(self.random.choice(string.ascii_uppercase + string.digits) for _i in range(14))
+
+    def answer(self, cabecera, registros):
+        ''' (EstadoRegistro, código, descripción) de cada registro '''
+        lines = []
+        options = self.options
+        for registro in registros:
+            key = (cabecera['nif'],) + registro
+            with self.lock:
+                value = self.random.random()
+                duplicate = not options.allow_duplicates and key in self.accepted
+                if duplicate:
+                    line = ('Incorrecto',) + DUPLICATE_ERROR
+                elif value < options.line_error_rate:
+                    line = ('Incorrecto',) + self.random.choice(LINE_ERRORS)
+                elif value < options.line_error_rate + options.accepted_errors_rate:
+                    line = ('AceptadoConErrores',) + self.random.choice(ACCEPTED_ERRORS)
+                else:
+                    line = ('Correcto', '', '')
+                if line[0] != 'Incorrecto':
+                    self.accepted.add(key)
+                self.stats[line[0]] += 1
+            lines.append(line)
+        return lines
+
+
+def _estado_envio(lines):
+    estados = set(line[0] for line in lines)
+    if estados == {'Correcto'}:
+        return 'Correcto'
+    if estados == {'Incorrecto'}:
+        return 'Incorrecto'
+    return 'ParcialmenteCorrecto'
+
+
+def render_response(cabecera, registros, lines, csv, wait):
+    ''' Sobre RespuestaRegFactuSistemaFacturacion (bytes) '''
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<env:Envelope xmlns:env="%s">' % SOAPENV_NS,
+        '<env:Header/>',
+        '<env:Body Id="Body">',
+        '<tikR:RespuestaRegFactuSistemaFacturacion xmlns:tikR="%s" xmlns:tik="%s">' % (TIKR_NS, TIK_NS),
+    ]
+    estado_envio = _estado_envio(lines) if lines else 'Incorrecto'
+    if estado_envio != 'Incorrecto':
+        out.append('<tikR:CSV>%s</tikR:CSV>' % csv)
+        out.append('<tikR:DatosPresentacion><tik:NIFPresentador>%s</tik:NIFPresentador>'
+                   '<tik:TimestampPresentacion>%s</tik:TimestampPresentacion></tikR:DatosPresentacion>' % (
+                       escape(cabecera['nif']),
+                       datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat(timespec='seconds')))
+    out.append('<tikR:Cabecera><tik:ObligadoEmision><tik:NombreRazon>%s</tik:NombreRazon><tik:NIF>%s</tik:NIF>'
+               '</tik:ObligadoEmision>' % (escape(cabecera['nombre_razon']), escape(cabecera['nif'])))
+    if cabecera['ref_requerimiento']:
+        out.append('<tik:RemisionRequerimiento><tik:RefRequerimiento>%s</tik:RefRequerimiento>'
+                   '<tik:FinRequerimiento>%s</tik:FinRequerimiento></tik:RemisionRequerimiento>' % (
+                       escape(cabecera['ref_requerimiento']), escape(cabecera['fin_requerimiento'] or 'N')))
+    out.append('</tikR:Cabecera>')
+    out.append('<tikR:TiempoEsperaEnvio>%s</tikR:TiempoEsperaEnvio>' % wait)
+    out.append('<tikR:EstadoEnvio>%s</tikR:EstadoEnvio>' % estado_envio)
+    for (tipo_operacion, nif, num_serie, fecha), (estado, codigo, descripcion) in zip(registros, lines):
+        out.append('<tikR:RespuestaLinea>')
+        out.append('<tikR:IDFactura><tik:IDEmisorFactura>%s</tik:IDEmisorFactura>'
+                   '<tik:NumSerieFactura>%s</tik:NumSerieFactura>'
+                   '<tik:FechaExpedicionFactura>%s</tik:FechaExpedicionFactura></tikR:IDFactura>' % (
+                       escape(nif), escape(num_serie), escape(fecha)))
+        out.append('<tikR:Operacion><tik:TipoOperacion>%s</tik:TipoOperacion></tikR:Operacion>' % tipo_operacion)
+        out.append('<tikR:EstadoRegistro>%s</tikR:EstadoRegistro>' % estado)
+        if codigo:
+            out.append('<tikR:CodigoErrorRegistro>%s</tikR:CodigoErrorRegistro>' % codigo)
+            out.append('<tikR:DescripcionErrorRegistro>%s</tikR:DescripcionErrorRegistro>' % escape(descripcion))
+        out.append('</tikR:RespuestaLinea>')
+    out.append('</tikR:RespuestaRegFactuSistemaFacturacion></env:Body></env:Envelope>')
+    return '\n'.join(out).encode('utf-8')
+
+
+def render_fault(message):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<env:Envelope xmlns:env="%s"><env:Body><env:Fault>'
+            '<faultcode>env:Client</faultcode><faultstring>%s</faultstring>'
+            '</env:Fault></env:Body></env:Envelope>' % (SOAPENV_NS, escape(message))).encode('utf-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive, como la sesión persistente del módulo
+    server_version = 'AEAT-mock'
+
+    def log_message(self, fmt, *args):
+        _logger.debug('%s %s', self.address_string(), fmt % args)
+
+    def _reply(self, status, body, content_type='text/xml; charset=utf-8', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _html(self, status, code):
+        self._reply(status, (HTML_ERROR_PAGE % {'code': code}).encode('utf-8'), 'text/html; charset=utf-8')
+
+    def do_GET(self):
+        self._html(405, 'METHOD')
+
+    def do_POST(self):
+        mock = self.server.mock
+        options = mock.options
+        data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.path.rstrip('/').endswith(SERVICES):
+            mock.stats['http_404'] += 1
+            return self._html(404, 'NOT_FOUND')
+        if mock.throttled():
+            mock.stats['http_429'] += 1
+            return self._reply(429, b'', 'text/plain', {'Retry-After': '1'})
+        mock.delay()
+        failure = mock.outcome()
+        if failure == 'error':
+            mock.stats['http_%s' % options.error_status] += 1
+            return self._html(options.error_status, 'SERVICE_UNAVAILABLE')
+        if failure == 'html':
+            mock.stats['html'] += 1
+            return self._html(options.html_status, 'ERR_%s' % options.html_status)
+        if failure == 'fault':
+            mock.stats['fault'] += 1
+            return self._reply(500, render_fault('Codigo[4104].Error interno en el servidor.'))
+        try:
+            cabecera, registros = parse_request(data)
+        except (ET.ParseError, ValueError) as e:
+            mock.stats['fault'] += 1
+            return self._reply(500, render_fault(SCHEMA_FAULT % e))
+        if not registros or len(registros) > MAX_REGISTERS_PER_ENVELOPE:
+            mock.stats['fault'] += 1
+            return self._reply(500, render_fault(
+                SCHEMA_FAULT % ('RegistroFactura (entre 1 y %s)' % MAX_REGISTERS_PER_ENVELOPE)))
+        lines = mock.answer(cabecera, registros)
+        mock.stats['envelopes'] += 1
+        _logger.info('%s %s: %s registros, %s', cabecera['nif'], self.path.rsplit('/', 1)[-1],
+                     len(registros), _estado_envio(lines))
+        self._reply(200, render_response(cabecera, registros, lines, mock.csv(), options.wait))
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Los clientes sin certificado válido fallan en el handshake: no es un error del servidor
+        _logger.warning('%s: %s', client_address[0], sys.exc_info()[1])
+
+
+def ssl_context(certs):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(os.path.join(certs, 'server.pem'), os.path.join(certs, 'server.key'))
+    context.load_verify_locations(os.path.join(certs, 'ca.pem'))
+    context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def generate_certs(directory, p12_password, nif):
+    ''' CA de pruebas, certificado del servidor (localhost) y certificado de cliente (.p12) '''
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    now = datetime.datetime.utcnow()
+
+    def key():
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def certificate(subject, public_key, issuer, signing_key, extensions):
+        builder = x509.CertificateBuilder().subject_name(subject).issuer_name(issuer) \
+            .public_key(public_key).serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=825))
+        for extension, critical in extensions:
+            builder = builder.add_extension(extension, critical=critical)
+        return builder.sign(signing_key, hashes.SHA256())
+
+    def write(name, data):
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+
+    def pem_key(private_key):
+        return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption())
+
+    ca_key = key()
+    ca_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'AEAT mock CA')])
+    ca_cert = certificate(ca_name, ca_key.public_key(), ca_name, ca_key,
+                          [(x509.BasicConstraints(ca=True, path_length=None), True)])
+
+    server_key = key()
+    server_cert = certificate(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')]), server_key.public_key(), ca_name, ca_key,
+        [(x509.SubjectAlternativeName([x509.DNSName('localhost'), x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+          False),
+         (x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), False)])
+
+    client_key = key()
+    client_cert = certificate(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'EMPRESA DE PRUEBAS - %s' % nif),
+                   x509.NameAttribute(NameOID.SERIAL_NUMBER, 'IDCES-%s' % nif)]),
+        client_key.public_key(), ca_name, ca_key,
+        [(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), False)])
+
+    write('ca.pem', ca_cert.public_bytes(serialization.Encoding.PEM))
+    write('server.pem', server_cert.public_bytes(serialization.Encoding.PEM))
+    write('server.key', pem_key(server_key))
+    write('client.pem', client_cert.public_bytes(serialization.Encoding.PEM))
+    write('client.key', pem_key(client_key))
+    write('client.p12', pkcs12.serialize_key_and_certificates(
+        b'client', client_key, client_cert, [ca_cert],
+        serialization.BestAvailableEncryption(p12_password.encode('utf-8'))))
+    return directory
+
+
+def _rate(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError('debe estar entre 0 y 1')
+    return value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Servidor SOAP simulado de la AEAT (Veri*Factu)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--certs', help='directorio con ca.pem, server.pem y server.key (mTLS); sin él, HTTP plano')
+    parser.add_argument('--generate-certs', metavar='DIR', help='crea los certificados de prueba en DIR y termina')
+    parser.add_argument('--p12-password', default='1234', help='contraseña de client.p12')
+    parser.add_argument('--nif', default='B00000000', help='NIF del certificado de cliente generado')
+    parser.add_argument('--latency', type=float, default=0, help='latencia fija por petición (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='latencia aleatoria adicional (ms)')
+    parser.add_argument('--line-error-rate', type=_rate, default=0, help='proporción de líneas Incorrecto')
+    parser.add_argument('--accepted-errors-rate', type=_rate, default=0,
+                        help='proporción de líneas AceptadoConErrores')
+    parser.add_argument('--wait', type=int, default=60, help='TiempoEsperaEnvio (segundos)')
+    parser.add_argument('--max-rps', type=int, default=0, help='peticiones por segundo antes de responder 429')
+    parser.add_argument('--error-rate', type=_rate, default=0, help='proporción de respuestas HTTP --error-status')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--html-rate', type=_rate, default=0, help='proporción de páginas de error HTML')
+    parser.add_argument('--html-status', type=int, default=200)
+    parser.add_argument('--fault-rate', type=_rate, default=0, help='proporción de SOAP Fault')
+    parser.add_argument('--allow-duplicates', action='store_true', help='no rechazar registros ya aceptados')
+    parser.add_argument('--seed', type=int, help='semilla para repetir la misma secuencia de respuestas')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if options.generate_certs:
+        generate_certs(options.generate_certs, options.p12_password, options.nif)
+        _logger.info('Certificados de prueba en %s (client.p12, contraseña %s)',
+                     options.generate_certs, options.p12_password)
+        return 0
+    server = MockServer((options.host, options.port), Handler)
+    server.mock = MockAeat(options)
+    scheme = 'http'
+    if options.certs:
+        # El handshake se hace en el hilo de cada conexión, no en el que acepta
+        server.socket = ssl_context(options.certs).wrap_socket(
+            server.socket, server_side=True, do_handshake_on_connect=False)
+        scheme = 'https'
+    _logger.info('AEAT simulada en %s://%s:%s/wlpl/TIKE-CONT%s', scheme, options.host, options.port, SERVICES[0])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        _logger.info('Resumen: %s', dict(server.mock.stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+Mide las conexiones a PostgreSQL abiertas mientras varios usuarios informan facturas a la vez.
+
+Cada hilo simula un usuario: abre su propio cursor y llama a action_invoice_inform factura a
+factura. Un hilo aparte muestrea pg_stat_activity de la base de datos. create_account_incoice_verifactu
+crea los registros en el cursor del usuario y los deja en la cola, así que informar no abre
+ninguna conexión adicional; con el cursor independiente por factura el pico era del orden del
+doble de usuarios. El envío, el circuit breaker y la ventana de espera de la AEAT usan sus
+propios cursores, pero en el distribuidor de la cola (un cron), no por usuario.
+
+Se ejecuta desde el shell de Odoo sobre una base de datos DE PRUEBAS (las facturas se informan
+y quedan en la cola; el cron del distribuidor las envía al endpoint configurado):
+
+    odoo-bin shell -c odoo.conf -d <db> < benchmarks/bench_inform_connections.py
+
+Variables de entorno opcionales:
+    VERIFACTU_BENCH_THREADS   usuarios concurrentes (8 por defecto)
+    VERIFACTU_BENCH_INVOICES  facturas en borrador por usuario (5 por defecto)
+'''
+import os
+import time
+import threading
+from contextlib import closing
+
+import odoo
+
+THREADS = int(os.environ.get('VERIFACTU_BENCH_THREADS', 8))
+INVOICES = int(os.environ.get('VERIFACTU_BENCH_INVOICES', 5))
+SAMPLE_SECONDS = 0.02
+
+dbname = env.cr.dbname
+uid = env.uid
+invoices = env['account.invoice'].search([
+    ('state', '=', 'draft'), ('type', 'in', ['out_invoice', 'out_refund']), ('verifactu_active', '=', True),
+], limit=THREADS * INVOICES, order='id')
+
+
+def baseline_connections():
+    with closing(odoo.sql_db.db_connect(dbname).cursor()) as cr:
+        cr.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = %s", [dbname])
+        return cr.fetchone()[0]
+
+
+def sampler(stop, samples):
+    with closing(odoo.sql_db.db_connect(dbname).cursor()) as cr:
+        while not stop.is_set():
+            cr.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = %s", [dbname])
+            samples.append(cr.fetchone()[0])
+            cr.rollback()
+            time.sleep(SAMPLE_SECONDS)
+
+
+def user(invoice_ids, errors):
+    with odoo.api.Environment.manage():
+        with closing(odoo.registry(dbname).cursor()) as cr:
+            uenv = odoo.api.Environment(cr, uid, {})
+            for invoice in uenv['account.invoice'].browse(invoice_ids):
+                try:
+                    invoice.action_invoice_inform()
+                    cr.commit()
+                except Exception as e:
+                    cr.rollback()
+                    errors.append('%s: %s' % (invoice.id, e))
+
+
+if len(invoices) < THREADS:
+    print("Hacen falta al menos %s facturas en borrador con Veri*Factu activo" % THREADS)
+else:
+    # Las conexiones ya abiertas (este shell, el pool de Odoo, otros procesos) no cuentan
+    idle = baseline_connections()
+    stop, samples, errors = threading.Event(), [], []
+    watcher = threading.Thread(target=sampler, args=(stop, samples))
+    watcher.start()
+    chunks = [invoices.ids[i::THREADS] for i in range(THREADS)]
+    users = [threading.Thread(target=user, args=(chunk, errors)) for chunk in chunks]
+    start = time.perf_counter()
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    watcher.join()
+
+    # El muestreador también es una conexión
+    extra = [max(0, count - idle - 1) for count in samples] or [0]
+    print("Usuarios: %s, facturas: %s, tiempo: %.1fs" % (THREADS, len(invoices), elapsed))
+    print("Conexiones en reposo: %s" % idle)
+    print("Conexiones adicionales: pico %s, media %.1f (%.2f por usuario)"
+          % (max(extra), sum(extra) / float(len(extra)), max(extra) / float(THREADS)))
+    print("Errores: %s %s" % (len(errors), errors[:5]))
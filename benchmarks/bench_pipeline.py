@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+'''
+Suite de rendimiento del circuito de registros Veri*Factu.
+
+Genera compañías, impuestos, clientes y facturas sintéticas y mide por etapa la latencia
+(p50/p95/p99) y el rendimiento (operaciones/s) con distintos volúmenes de registros ya
+existentes en account_invoice_verifactu:
+
+* decide_values / check_rules: _decide_values y _check_verifactu_rules de la factura.
+* chain_search, generate_hash, generate_register, sign y update_register_data: preparación
+  del registro (sign sólo en compañías no verificables).
+* soap_envelope (un registro) y soap_envelope_batch (ENVELOPE registros de una compañía).
+* aeat_response: lectura de una respuesta de la AEAT y _apply_aeat_response.
+* generate_qr y qr_image (URL del QR y PNG sin caché).
+* invoice_write: comprobaciones de AccountInvoice.write sobre una factura informada.
+
+No se envía nada a la AEAT. Los datos sintéticos y los registros de relleno se CONFIRMAN en
+la base de datos, por lo que sólo se ejecuta sobre una base de datos desechable cuyo nombre
+se indica en VERIFACTU_BENCH_DB:
+
+    VERIFACTU_BENCH_DB=<db> odoo-bin shell -c odoo.conf -d <db> < benchmarks/bench_pipeline.py
+
+Las etapas que escriben se ejecutan dentro de un savepoint que se revierte, de modo que cada
+nivel se mide sobre los mismos datos. Los resultados se comparan con la línea base guardada
+(VERIFACTU_BENCH_BASELINE) y se marcan las etapas cuyo p95 empeora más de la tolerancia.
+
+Variables de entorno opcionales:
+    VERIFACTU_BENCH_COMPANIES     compañías sintéticas (2 por defecto)
+    VERIFACTU_BENCH_LEVELS        registros existentes por nivel (1000,10000,100000)
+    VERIFACTU_BENCH_SAMPLES       operaciones medidas por etapa y nivel (200 por defecto)
+    VERIFACTU_BENCH_ENVELOPE      registros del sobre de soap_envelope_batch (50 por defecto)
+    VERIFACTU_BENCH_BASELINE      fichero JSON de la línea base (benchmarks/baseline_pipeline.json)
+    VERIFACTU_BENCH_SAVE          1 para guardar los resultados como nueva línea base
+    VERIFACTU_BENCH_TOLERANCE     empeoramiento admitido del p95 (0.25 = 25 % por defecto)
+    VERIFACTU_BENCH_P12           .p12 de las compañías no verificables (si no, se genera uno
+    VERIFACTU_BENCH_P12_PASSWORD  autofirmado; sin cryptography >= 3.0 sólo hay verificables)
+'''
+import os
+import json
+import math
+import time
+import base64
+import socket
+import datetime
+
+import odoo
+from odoo import fields
+
+from odoo.addons.account_verifactu.models import aeat_response
+from odoo.addons.account_verifactu.models import verifactu_qr
+
+DBNAME = os.environ.get('VERIFACTU_BENCH_DB')
+COMPANIES = int(os.environ.get('VERIFACTU_BENCH_COMPANIES', 2))
+LEVELS = [int(level) for level in os.environ.get('VERIFACTU_BENCH_LEVELS', '1000,10000,100000').split(',')]
+SAMPLES = int(os.environ.get('VERIFACTU_BENCH_SAMPLES', 200))
+ENVELOPE = int(os.environ.get('VERIFACTU_BENCH_ENVELOPE', 50))
+BASELINE = os.environ.get('VERIFACTU_BENCH_BASELINE', os.path.join('benchmarks', 'baseline_pipeline.json'))
+SAVE = os.environ.get('VERIFACTU_BENCH_SAVE', '') not in ('', '0')
+TOLERANCE = float(os.environ.get('VERIFACTU_BENCH_TOLERANCE', 0.25))
+# Diferencias de p95 por debajo de este umbral (ms) se consideran ruido
+NOISE_MS = 0.05
+SEED_CHUNK = 20000
+NAME = 'Veri*Factu Bench %02d'
+
+cr = env.cr
+Verifactu = env['account.invoice.verifactu'].with_context(verifactu_defer_submit=True, verifactu_defer_invoice_sync=True)
+Invoice = env['account.invoice']
+
+
+# ---------- Datos sintéticos ----------
+
+def bench_p12():
+    ''' (p12_data, password) o None si no se puede obtener un certificado '''
+    path = os.environ.get('VERIFACTU_BENCH_P12')
+    password = os.environ.get('VERIFACTU_BENCH_P12_PASSWORD', 'bench')
+    if path:
+        with open(path, 'rb') as p12_file:
+            return p12_file.read(), password
+    try:
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.serialization import pkcs12, BestAvailableEncryption
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Veri*Factu Bench')])
+        now = datetime.datetime.utcnow()
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()).not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=365)).sign(key, hashes.SHA256(), default_backend())
+        data = pkcs12.serialize_key_and_certificates(b'bench', key, cert, None,
+                                                     BestAvailableEncryption(password.encode('utf-8')))
+        return data, password
+    except (ImportError, AttributeError):
+        return None
+
+
+def ensure_company(index, p12):
+    company = env['res.company'].search([('name', '=', NAME % index)], limit=1)
+    if company:
+        return company
+    no_verificable = bool(p12) and index % 2 == 1
+    values = {
+        'name': NAME % index,
+        'vat': 'ESB%08d' % (10000000 + index),
+        'country_id': env.ref('base.es').id,
+        'currency_id': env.ref('base.EUR').id,
+        'verifactu_date': '2000-01-01',
+        'verifactu_sif': 'no_verificable' if no_verificable else 'verificable',
+        'verifactu_razon_social': NAME % index,
+        'verifactu_operation': 'Benchmark',
+    }
+    if no_verificable:
+        values.update(verifactu_p12_file=base64.b64encode(p12[0]), verifactu_p12_password=p12[1])
+    company = env['res.company'].create(values)
+    env.user.write({'company_ids': [(4, company.id)]})
+    return company
+
+
+def ensure_accounting(company, index):
+    ''' Cuentas, diario, impuesto y cliente de la compañía '''
+    Account = env['account.account']
+    receivable = Account.search([('company_id', '=', company.id), ('code', '=', '430000')], limit=1) or Account.create({
+        'name': 'Clientes (bench)', 'code': '430000', 'company_id': company.id, 'reconcile': True,
+        'user_type_id': env.ref('account.data_account_type_receivable').id,
+    })
+    income = Account.search([('company_id', '=', company.id), ('code', '=', '700000')], limit=1) or Account.create({
+        'name': 'Ventas (bench)', 'code': '700000', 'company_id': company.id,
+        'user_type_id': env.ref('account.data_account_type_revenue').id,
+    })
+    journal = env['account.journal'].search([('company_id', '=', company.id), ('code', '=', 'BNCH')], limit=1) or \
+        env['account.journal'].create({
+            'name': 'Ventas (bench)', 'code': 'BNCH', 'type': 'sale', 'company_id': company.id,
+            'default_credit_account_id': income.id, 'default_debit_account_id': income.id,
+        })
+    tax = env['account.tax'].search([('company_id', '=', company.id), ('name', '=', 'IVA 21% (bench)')], limit=1) or \
+        env['account.tax'].create({
+            'name': 'IVA 21% (bench)', 'amount': 21.0, 'amount_type': 'percent', 'type_tax_use': 'sale',
+            'company_id': company.id, 'account_id': income.id, 'refund_account_id': income.id,
+            'verifactu_impuesto': '01', 'verifactu_regimen': '01', 'verifactu_calificacion': 'S1',
+        })
+    partner = env['res.partner'].search([('name', '=', 'Cliente bench %02d' % index)], limit=1) or \
+        env['res.partner'].create({
+            'name': 'Cliente bench %02d' % index, 'vat': 'ESA%08d' % (20000000 + index),
+            'country_id': env.ref('base.es').id, 'customer': True,
+        })
+    return receivable, income, journal, tax, partner
+
+
+def ensure_invoices(company, index, count):
+    ''' Facturas en borrador de la compañía con número asignado (move_name) '''
+    prefix = 'BENCH%02d/' % index
+    invoices = Invoice.search([('company_id', '=', company.id), ('move_name', '=like', prefix + '%')], order='id')
+    if len(invoices) >= count:
+        return invoices[:count]
+    receivable, income, journal, tax, partner = ensure_accounting(company, index)
+    f1 = env['account.invoice.verifactu.type']._get_type('F1')
+    today = fields.Date.context_today(Invoice)
+    for number in range(len(invoices), count):
+        invoice = Invoice.create({
+            'type': 'out_invoice',
+            'company_id': company.id,
+            'journal_id': journal.id,
+            'account_id': receivable.id,
+            'partner_id': partner.id,
+            'currency_id': company.currency_id.id,
+            'date_invoice': today,
+            'move_name': '%s%06d' % (prefix, number),
+            'verifactu_invoice_type': f1.id,
+            'invoice_line_ids': [(0, 0, {
+                'name': 'Servicio bench %s' % number,
+                'account_id': income.id,
+                'quantity': 1 + number % 3,
+                'price_unit': 100.0 + number,
+                'invoice_line_tax_ids': [(6, 0, [tax.id])],
+            })],
+        })
+        invoice.compute_taxes()
+        invoices |= invoice
+    return invoices
+
+
+def ensure_registers(invoices):
+    ''' Registros de alta (sin enviar) de las facturas '''
+    registers = Verifactu.search([('invoice_id', 'in', invoices.ids), ('type', '=', 'alta')], order='id')
+    for invoice in invoices - registers.mapped('invoice_id'):
+        registers |= Verifactu.create({'invoice_id': invoice.id, 'type': 'alta'})
+    return registers
+
+
+def seed_registers(company_ids, seed_invoice_ids, level):
+    ''' Completa con registros aceptados de relleno hasta ``level`` registros en la tabla '''
+    cr.execute("SELECT count(*), coalesce(max(id), 0) FROM account_invoice_verifactu")
+    existing, last_id = cr.fetchone()
+    missing = level - existing
+    done = 0
+    while done < missing:
+        chunk = min(SEED_CHUNK, missing - done)
+        cr.execute("""
+            INSERT INTO account_invoice_verifactu
+                (company_id, invoice_id, type, state, hash, generation_date, send_date,
+                 create_uid, create_date, write_uid, write_date)
+            SELECT c.company_id, c.invoice_id, 'alta', 'accepted', md5(g::text) || md5((g + 1)::text),
+                   to_char(now() at time zone 'UTC' - g * interval '1 minute', 'YYYY-MM-DD"T"HH24:MI:SS+00:00'),
+                   now() at time zone 'UTC' - g * interval '1 minute',
+                   %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+              FROM generate_series(%s, %s) g
+              JOIN unnest(%s, %s, %s) AS c(position, company_id, invoice_id)
+                ON c.position = g %% %s
+        """, [env.uid, env.uid, last_id + done + 1, last_id + done + chunk,
+              list(range(len(company_ids))), company_ids, seed_invoice_ids, len(company_ids)])
+        done += chunk
+        cr.commit()
+    cr.execute("ANALYZE account_invoice_verifactu")
+    cr.commit()
+    return max(missing, 0)
+
+
+# ---------- Medición ----------
+
+def percentile(values, pct):
+    ''' Percentil por rango más cercano de una lista ordenada '''
+    if not values:
+        return 0.0
+    return values[max(0, int(math.ceil(pct / 100.0 * len(values))) - 1)]
+
+
+def measure(ops, rollback=False):
+    '''
+    :param ops: lista de (setup, run); sólo se mide run(setup())
+    :param rollback: revertir lo escrito por cada operación
+    '''
+    latencies = []
+    for setup, run in ops:
+        if rollback:
+            cr.execute("SAVEPOINT verifactu_bench")
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        latencies.append(time.perf_counter() - start)
+        if rollback:
+            cr.execute("ROLLBACK TO SAVEPOINT verifactu_bench")
+            env.clear()
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'n': len(latencies),
+        'p50_ms': round(1000 * percentile(latencies, 50), 3),
+        'p95_ms': round(1000 * percentile(latencies, 95), 3),
+        'p99_ms': round(1000 * percentile(latencies, 99), 3),
+        'ops_s': round(len(latencies) / total, 1) if total else 0.0,
+    }
+
+
+def virtual_register(invoice_id, prepared=False):
+    ''' Registro de alta en memoria (NewId): no bloquea la cabeza de la cadena ni escribe '''
+    invoice = Invoice.browse(invoice_id)
+    register = Verifactu.new({'invoice_id': invoice.id, 'type': 'alta', 'company_id': invoice.company_id.id})
+    if prepared:
+        # Mismo formato que update_register_data (ISO con zona horaria)
+        register.generation_date = (lambda s: s[:-2] + ':' + s[-2:])(fields.Datetime.context_timestamp(
+            register, datetime.datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S%z'))
+        register.anterior = register._get_anterior()
+        register.generate_hash()
+    return register
+
+
+def response_for(register_id):
+    register = Verifactu.browse(register_id)
+    return ("""<?xml version="1.0" encoding="UTF-8"?>
+<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+  <env:Body>
+    <tikR:RespuestaRegFactuSistemaFacturacion xmlns:tikR="urn:bench" xmlns:tik="urn:bench:tik">
+      <tikR:CSV>BENCH%(id)012d</tikR:CSV>
+      <tikR:TiempoEsperaEnvio>60</tikR:TiempoEsperaEnvio>
+      <tikR:EstadoEnvio>Correcto</tikR:EstadoEnvio>
+      <tikR:RespuestaLinea>
+        <tikR:IDFactura>
+          <tik:IDEmisorFactura>%(nif)s</tik:IDEmisorFactura>
+          <tik:NumSerieFactura>%(num)s</tik:NumSerieFactura>
+          <tik:FechaExpedicionFactura>%(fecha)s</tik:FechaExpedicionFactura>
+        </tikR:IDFactura>
+        <tikR:Operacion><tik:TipoOperacion>Alta</tik:TipoOperacion></tikR:Operacion>
+        <tikR:EstadoRegistro>Correcto</tikR:EstadoRegistro>
+      </tikR:RespuestaLinea>
+    </tikR:RespuestaRegFactuSistemaFacturacion>
+  </env:Body>
+</env:Envelope>
+""" % {
+        'id': register.id,
+        'nif': register.company_id.vat_clean()[1],
+        'num': register.invoice_id.move_name,
+        'fecha': register.date_invoice,
+    }).encode('utf-8')
+
+
+def accept(register_id):
+    ''' Deja informada y aceptada la factura del registro (dentro del savepoint de la operación) '''
+    register = Verifactu.browse(register_id)
+    cr.execute("UPDATE account_invoice_verifactu SET state = 'accepted', send_date = %s WHERE id = %s",
+               [fields.Datetime.now(), register.id])
+    register.invalidate_cache()
+    register.invoice_id._verifactu_sync()
+    return register.invoice_id.id
+
+
+def clear_qr(register_id):
+    verifactu_qr.png_cache.clear()
+    register = Verifactu.browse(register_id)
+    register.invalidate_cache(['verifactu_qr'])
+    return register
+
+
+def no_setup(value):
+    return lambda: value
+
+
+def run_stages(invoice_ids, register_ids, signing_invoice_ids, envelopes):
+    stages = []
+
+    def stage(name, ops, rollback=False):
+        if ops:
+            stages.append((name, measure(ops, rollback)))
+
+    sample = [invoice_ids[i % len(invoice_ids)] for i in range(SAMPLES)]
+    registers = [register_ids[i % len(register_ids)] for i in range(SAMPLES)]
+    signing = [signing_invoice_ids[i % len(signing_invoice_ids)] for i in range(SAMPLES)] if signing_invoice_ids else []
+
+    stage('decide_values', [(no_setup(i), lambda i: Invoice.browse(i)._decide_values()) for i in sample])
+    stage('check_rules', [(no_setup(i), lambda i: Invoice.browse(i)._check_verifactu_rules()) for i in sample])
+    stage('chain_search', [(lambda i=i: virtual_register(i), lambda r: r._get_anterior()) for i in sample])
+    stage('generate_hash', [(lambda i=i: virtual_register(i, prepared=True), lambda r: r.generate_hash()) for i in sample])
+    stage('generate_register', [(lambda i=i: virtual_register(i, prepared=True), lambda r: r.generate_register())
+                                for i in sample])
+    stage('sign', [(lambda i=i: virtual_register(i, prepared=True), lambda r: r._sign_registers()) for i in signing])
+    stage('update_register_data', [(lambda i=i: virtual_register(i), lambda r: r.update_register_data())
+                                   for i in sample])
+    stage('soap_envelope', [(no_setup(r), lambda r: Verifactu.browse(r).generate_soap_envelope()) for r in registers],
+          rollback=True)
+    stage('soap_envelope_batch', [(no_setup(ids), lambda ids: Verifactu.browse(ids)._render_soap_envelope())
+                                  for ids in envelopes for _round in range(max(1, SAMPLES // (10 * len(envelopes))))])
+    stage('aeat_response', [(lambda r=r: (r, response_for(r)),
+                             lambda arg: Verifactu.browse(arg[0])._apply_aeat_response(aeat_response.parse(arg[1])))
+                            for r in registers], rollback=True)
+    stage('generate_qr', [(no_setup(r), lambda r: Verifactu.browse(r).generate_qr()) for r in registers], rollback=True)
+    stage('qr_image', [(lambda r=r: clear_qr(r), lambda register: register.verifactu_qr) for r in registers])
+    stage('invoice_write', [(lambda r=r: accept(r),
+                             lambda i: Invoice.browse(i).write({'partner_id': Invoice.browse(i).partner_id.id}))
+                            for r in registers], rollback=True)
+    return stages
+
+
+# ---------- Línea base ----------
+
+def compare(results, baseline):
+    ''' Líneas del informe comparando el p95 con la línea base; devuelve (líneas, regresiones) '''
+    lines, regressions = [], 0
+    for level, stages in results.items():
+        base_level = baseline.get('results', {}).get(level, {})
+        for name, result in stages.items():
+            base = base_level.get(name)
+            if not base:
+                continue
+            delta = result['p95_ms'] - base['p95_ms']
+            ratio = result['p95_ms'] / base['p95_ms'] if base['p95_ms'] else 1.0
+            status = ''
+            if ratio > 1 + TOLERANCE and delta > NOISE_MS:
+                status = 'REGRESIÓN'
+                regressions += 1
+            elif ratio < 1 - TOLERANCE and -delta > NOISE_MS:
+                status = 'mejora'
+            lines.append("%8s %-22s p95 %9.3f -> %9.3f ms (%+6.1f %%) %s"
+                         % (level, name, base['p95_ms'], result['p95_ms'], 100 * (ratio - 1), status))
+    return lines, regressions
+
+
+if DBNAME != cr.dbname:
+    print("La suite confirma datos sintéticos: indica la base de datos desechable con VERIFACTU_BENCH_DB=%s" % cr.dbname)
+else:
+    p12 = bench_p12()
+    companies = env['res.company'].browse()
+    invoice_ids, register_ids, signing_invoice_ids, envelopes, seed_invoice_ids = [], [], [], [], []
+    per_company = int(math.ceil(float(SAMPLES) / COMPANIES))
+    for index in range(COMPANIES):
+        company = ensure_company(index, p12)
+        companies |= company
+        # La primera factura sólo se usa para los registros de relleno
+        invoices = ensure_invoices(company, index, per_company + ENVELOPE + 1)
+        seed_invoice_ids.append(invoices[0].id)
+        sample_invoices, envelope_invoices = invoices[1:per_company + 1], invoices[per_company + 1:]
+        if company.verifactu_sif == 'no_verificable':
+            signing_invoice_ids += sample_invoices.ids
+        invoice_ids += sample_invoices.ids
+        registers = ensure_registers(envelope_invoices)
+        register_ids += registers.ids
+        envelopes.append(registers.ids)
+        cr.commit()
+
+    results = {}
+    for level in LEVELS:
+        seeded = seed_registers(companies.ids, seed_invoice_ids, level)
+        cr.execute("SELECT count(*) FROM account_invoice_verifactu")
+        existing = cr.fetchone()[0]
+        print("Nivel %s: %s registros existentes (%s de relleno añadidos)" % (level, existing, seeded))
+        stages = run_stages(invoice_ids, register_ids, signing_invoice_ids, envelopes)
+        results[str(level)] = dict(stages)
+        print("%-22s %6s %10s %10s %10s %10s" % ('etapa', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'ops/s'))
+        for name, result in stages:
+            print("%-22s %6s %10.3f %10.3f %10.3f %10.1f" % (
+                name, result['n'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['ops_s']))
+        cr.rollback()
+
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as baseline_file:
+            baseline = json.load(baseline_file)
+        lines, regressions = compare(results, baseline)
+        print("Comparación con la línea base %s (%s):" % (BASELINE, baseline.get('meta', {}).get('date')))
+        for line in lines:
+            print(line)
+        print("Regresiones: %s" % regressions)
+    else:
+        print("Sin línea base en %s" % BASELINE)
+    if SAVE:
+        with open(BASELINE, 'w') as baseline_file:
+            json.dump({
+                'meta': {
+                    'date': fields.Datetime.now(),
+                    'host': socket.gethostname(),
+                    'odoo': odoo.release.version,
+                    'companies': COMPANIES,
+                    'samples': SAMPLES,
+                    'envelope': ENVELOPE,
+                    'no_verificable': bool(signing_invoice_ids),
+                },
+                'results': results,
+            }, baseline_file, indent=2, sort_keys=True)
+        print("Línea base guardada en %s" % BASELINE)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+'''
+Compara la generación de RegistroFactura con QWeb + pretty_xml frente al constructor lxml nativo.
+
+Se ejecuta desde el shell de Odoo sobre una base de datos con registros Veri*Factu:
+
+    odoo-bin shell -c odoo.conf -d <db> < benchmarks/bench_register_builder.py
+
+Variables de entorno opcionales:
+    VERIFACTU_BENCH_LIMIT   número de registros a generar (100 por defecto)
+    VERIFACTU_BENCH_ROUNDS  repeticiones por registro (5 por defecto)
+
+No modifica la base de datos: los registros se generan en memoria y la transacción se revierte.
+'''
+import os
+import time
+
+from odoo.addons.account_verifactu.models import verifactu_xml
+
+LIMIT = int(os.environ.get('VERIFACTU_BENCH_LIMIT', 100))
+ROUNDS = int(os.environ.get('VERIFACTU_BENCH_ROUNDS', 5))
+
+TEMPLATES = {
+    'alta': 'account_verifactu.RegistroAlta',
+    'anulation': 'account_verifactu.RegistroAnulacion',
+}
+
+
+def render_qweb(register):
+    rendered = env['ir.qweb'].render(TEMPLATES[register.type], {'o': register, 'env': env})
+    if isinstance(rendered, (bytes, bytearray)):
+        rendered = rendered.decode('utf-8')
+    return register.pretty_xml(rendered, xml_declaration=False)
+
+
+def timed(func, registers):
+    start = time.perf_counter()
+    for _round in range(ROUNDS):
+        for register in registers:
+            func(register)
+    return time.perf_counter() - start
+
+
+registers = env['account.invoice.verifactu'].search(
+    [('type', 'in', list(TEMPLATES)), ('invoice_id', '!=', False)], limit=LIMIT, order='id desc')
+if not registers:
+    print("No hay registros de alta/anulación para comparar")
+else:
+    mismatches = registers.filtered(lambda r: render_qweb(r) != verifactu_xml.render_register(r))
+    qweb_time = timed(render_qweb, registers)
+    native_time = timed(verifactu_xml.render_register, registers)
+    envelope = registers.filtered(lambda r: r.company_id == registers[0].company_id)
+    envelope = envelope.filtered('registro_factura')[:1000]
+    native_envelope = qweb_envelope = 0.0
+    if envelope:
+        start = time.perf_counter()
+        envelope.with_context(soap_template_xml_id='account_verifactu.soap_request')._render_soap_envelope()
+        qweb_envelope = time.perf_counter() - start
+        start = time.perf_counter()
+        envelope._render_soap_envelope()
+        native_envelope = time.perf_counter() - start
+
+    renders = len(registers) * ROUNDS
+    print("Registros: %s, repeticiones: %s" % (len(registers), ROUNDS))
+    print("QWeb + pretty_xml: %.3fs (%.3f ms/registro)" % (qweb_time, 1000.0 * qweb_time / renders))
+    print("lxml nativo:       %.3fs (%.3f ms/registro)" % (native_time, 1000.0 * native_time / renders))
+    if native_time:
+        print("Aceleración:       x%.1f" % (qweb_time / native_time))
+    if envelope:
+        print("Sobre SOAP (%s registros): QWeb %.3fs, nativo %.3fs" % (len(envelope), qweb_envelope, native_envelope))
+    print("Registros con XML distinto: %s %s" % (len(mismatches), mismatches.ids[:20]))
+env.cr.rollback()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+Compara la firma de registros de SIF no verificable en varias pasadas (generate_register,
+_build_signature_tag_from_p12 y generate_register de nuevo) con el motor de firma en una
+sola pasada (_sign_registers), en registros por segundo.
+
+Se ejecuta desde el shell de Odoo sobre una base de datos con registros de una compañía
+no verificable con certificado .p12:
+
+    odoo-bin shell -c odoo.conf -d <db> < benchmarks/bench_register_signer.py
+
+Variables de entorno opcionales:
+    VERIFACTU_BENCH_LIMIT   número de registros a firmar (100 por defecto)
+
+No modifica la base de datos: la transacción se revierte al terminar.
+'''
+import os
+import time
+
+from signxml import XMLVerifier
+
+LIMIT = int(os.environ.get('VERIFACTU_BENCH_LIMIT', 100))
+
+
+def multi_pass(registers):
+    for register in registers:
+        register.generate_register()
+        register.signature = register._build_signature_tag_from_p12()
+        register.generate_register()
+
+
+def single_pass(registers):
+    registers._sign_registers()
+
+
+def timed(func, registers):
+    start = time.perf_counter()
+    func(registers)
+    return time.perf_counter() - start
+
+
+registers = env['account.invoice.verifactu'].search([
+    ('type', 'in', ['alta', 'anulation']), ('invoice_id.company_id.verifactu_sif', '=', 'no_verificable'),
+], limit=LIMIT, order='id desc')
+if not registers:
+    print("No hay registros de compañías no verificables para firmar")
+else:
+    # Carga del .p12 fuera de la medición (queda en caché para ambas variantes)
+    registers.mapped('invoice_id.company_id')[0]._verifactu_p12()
+    multi_time = timed(multi_pass, registers)
+    single_time = timed(single_pass, registers)
+    certificate = registers[0].invoice_id.company_id._verifactu_p12().register_signer.chain_pem[0]
+    invalid = 0
+    for register in registers:
+        try:
+            XMLVerifier().verify(register.registro_factura.encode('utf-8'), x509_cert=certificate)
+        except Exception:
+            invalid += 1
+    print("Registros: %s" % len(registers))
+    print("Varias pasadas: %.3fs (%.0f registros/s)" % (multi_time, len(registers) / multi_time))
+    print("Una pasada:     %.3fs (%.0f registros/s)" % (single_time, len(registers) / single_time))
+    print("Registros con firma no verificable tras la firma en una pasada: %s" % invalid)
+env.cr.rollback()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime, timedelta
+
+from odoo import fields, http
+from odoo.exceptions import AccessError
+from odoo.http import request
+from odoo.tools import consteq
+
+from ..models import verifactu_metrics
+
+
+class VerifactuMetrics(http.Controller):
+    '''
+    Histogramas de los tiempos por etapa (account.invoice.verifactu.timing) por compañía,
+    endpoint y etapa, en formato de texto de Prometheus o en JSON.
+    Acceso: administradores con sesión o el token del parámetro account_verifactu.metrics_token
+    (cabecera ``Authorization: Bearer <token>`` o ``?token=``) para el scraper.
+    Con ``?minutes=N`` sólo se agregan las medidas de los últimos N minutos.
+    '''
+
+    def _authorized(self, token):
+        expected = request.env['ir.config_parameter'].sudo().get_param('account_verifactu.metrics_token')
+        auth = request.httprequest.headers.get('Authorization') or ''
+        if auth.startswith('Bearer '):
+            token = auth[len('Bearer '):].strip()
+        if expected and token and consteq(expected, token):
+            return True
+        return request.env.user.has_group('base.group_system')
+
+    def _rows(self, minutes):
+        since = None
+        if minutes:
+            try:
+                since = fields.Datetime.to_string(datetime.utcnow() - timedelta(minutes=int(minutes)))
+            except ValueError:
+                since = None
+        return request.env['account.invoice.verifactu.timing'].sudo()._aggregate(since)
+
+    @http.route('/account_verifactu/metrics', type='http', auth='public', methods=['GET'], csrf=False)
+    def metrics(self, token=None, minutes=None, **kw):
+        if not self._authorized(token):
+            return request.make_response('Forbidden', [('Content-Type', 'text/plain')], status=403)
+        return request.make_response(verifactu_metrics.render_prometheus(self._rows(minutes)),
+                                     [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+
+    @http.route('/account_verifactu/metrics.json', type='http', auth='public', methods=['GET'], csrf=False)
+    def metrics_json(self, token=None, minutes=None, **kw):
+        if not self._authorized(token):
+            return request.make_response('Forbidden', [('Content-Type', 'text/plain')], status=403)
+        return request.make_response(json.dumps(verifactu_metrics.render_json(self._rows(minutes))),
+                                     [('Content-Type', 'application/json')])
+
+
+class VerifactuExport(http.Controller):
+    '''
+    Descarga del zip de la exportación de un periodo (account.invoice.verifactu.export).
+    Se sirve por bloques desde el filestore: /web/content cargaría el adjunto entero en memoria.
+    '''
+
+    @http.route('/account_verifactu/export/<int:attachment_id>', type='http', auth='user', methods=['GET'])
+    def export(self, attachment_id, **kw):
+        attachment = request.env['ir.attachment'].browse(attachment_id).exists()
+        try:
+            attachment.check('read')
+        except AccessError:
+            return request.not_found()
+        if not attachment.store_fname:
+            return request.not_found()
+        return http.send_file(attachment._full_path(attachment.store_fname), mimetype=attachment.mimetype,
+                              as_attachment=True, filename=attachment.datas_fname, cache_timeout=0)
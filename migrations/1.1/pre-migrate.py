@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+'''
+Índices de account_invoice_verifactu.
+
+Rellena company_id con SQL (evita recalcularlo registro a registro) y crea los índices
+con CREATE INDEX CONCURRENTLY para no bloquear la escritura en tablas grandes. Los índices
+concurrentes no pueden crearse dentro de una transacción, así que se confirma la transacción
+de la actualización y se usa una conexión aparte en modo autocommit. _auto_init no volverá
+a crear los índices que ya existan.
+'''
+import logging
+
+from odoo.sql_db import db_connect
+
+_logger = logging.getLogger(__name__)
+
+INDEXES = [
+    ('account_invoice_verifactu_chain_idx',
+     '(company_id, type, state, send_date DESC, generation_date DESC, id DESC)', ''),
+    ('account_invoice_verifactu_invoice_state_idx',
+     '(invoice_id, state, send_date DESC, generation_date DESC, id DESC)', ''),
+    ('account_invoice_verifactu_invoice_informed_idx',
+     '(invoice_id, send_date DESC NULLS LAST, id DESC)', "WHERE state IN ('accepted','partially_accepted','rejected')"),
+    ('account_invoice_verifactu_queue_idx',
+     '(company_id, id)', "WHERE queue_state IN ('queued','sending')"),
+    ('account_invoice_verifactu_invoice_id_index', '(invoice_id)', ''),
+    ('account_invoice_verifactu_company_id_index', '(company_id)', ''),
+    ('account_invoice_verifactu_hash_index', '(hash)', ''),
+]
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    cr.execute("""
+        ALTER TABLE account_invoice_verifactu
+            ADD COLUMN IF NOT EXISTS company_id integer,
+            ADD COLUMN IF NOT EXISTS queue_state varchar
+    """)
+    cr.execute("""
+        UPDATE account_invoice_verifactu v
+        SET company_id = i.company_id
+        FROM account_invoice i
+        WHERE i.id = v.invoice_id AND v.company_id IS NULL
+    """)
+    _logger.info('account_invoice_verifactu: company_id set on %s registers', cr.rowcount)
+    # Las huellas son SHA-256 en hexadecimal: 64 caracteres
+    cr.execute("SELECT coalesce(max(length(hash)), 0) FROM account_invoice_verifactu")
+    if cr.fetchone()[0] <= 64:
+        cr.execute("ALTER TABLE account_invoice_verifactu ALTER COLUMN hash TYPE varchar(64)")
+    cr.commit()
+
+    with db_connect(cr.dbname).cursor() as icr:
+        icr.autocommit(True)
+        for name, expression, where in INDEXES:
+            _logger.info('account_invoice_verifactu: creating index %s', name)
+            icr.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS "%s" ON account_invoice_verifactu %s %s'
+                        % (name, expression, where))
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''
+verifactu_id, verifactu_state, verifactu_send_date y verifactu_active pasan a almacenarse
+en account_invoice. Se crean las columnas y se rellenan con SQL para que la actualización
+no tenga que calcularlas factura a factura.
+'''
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    cr.execute("""
+        ALTER TABLE account_invoice
+            ADD COLUMN IF NOT EXISTS verifactu_id integer,
+            ADD COLUMN IF NOT EXISTS verifactu_state varchar,
+            ADD COLUMN IF NOT EXISTS verifactu_send_date timestamp,
+            ADD COLUMN IF NOT EXISTS verifactu_active boolean
+    """)
+    cr.execute("""
+        UPDATE account_invoice i
+        SET verifactu_active = (c.verifactu_date IS NOT NULL AND i.date_invoice IS NOT NULL AND i.date_invoice >= c.verifactu_date)
+        FROM res_company c
+        WHERE c.id = i.company_id
+    """)
+    _logger.info('account_invoice: verifactu_active set on %s invoices', cr.rowcount)
+    cr.execute("""
+        UPDATE account_invoice i
+        SET verifactu_id = v.id, verifactu_state = v.state, verifactu_send_date = v.send_date
+        FROM (
+            SELECT DISTINCT ON (invoice_id) invoice_id, id, state, send_date
+            FROM account_invoice_verifactu
+            WHERE state in ('accepted','partially_accepted','rejected')
+            ORDER BY invoice_id, state in ('accepted','partially_accepted') DESC, send_date DESC NULLS LAST, id DESC
+        ) v
+        WHERE i.id = v.invoice_id
+    """)
+    _logger.info('account_invoice: verifactu_id set on %s invoices', cr.rowcount)
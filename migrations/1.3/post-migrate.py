@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+'''
+registro_factura, signature, request, response y verifactu_qr pasan a guardarse comprimidos
+en account.invoice.verifactu.payload. Se trasladan las columnas antiguas por bloques de ids
+(las repetidas, como el QR de las anulaciones, se guardan una sola vez) y se eliminan de la
+tabla de registros para reducir su tamaño.
+'''
+import base64
+import logging
+
+from odoo import api, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+CHUNK = 1000
+
+# (tabla, columna antigua, columna del payload, columna con el PNG en base64)
+COLUMNS = [
+    ('account_invoice_verifactu', 'registro_factura', 'registro_factura_payload_id', False),
+    ('account_invoice_verifactu', 'signature', 'signature_payload_id', False),
+    ('account_invoice_verifactu', 'request', 'request_payload_id', False),
+    ('account_invoice_verifactu', 'response', 'response_payload_id', False),
+    ('account_invoice_verifactu', 'verifactu_qr', 'qr_payload_id', True),
+    ('account_invoice_verifactu_batch', 'request', 'request_payload_id', False),
+    ('account_invoice_verifactu_batch', 'response', 'response_payload_id', False),
+]
+
+
+def _column_exists(cr, table, column):
+    cr.execute("""
+        SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s
+    """, [table, column])
+    return bool(cr.fetchone())
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    store = env['account.invoice.verifactu.payload']
+    for table, column, payload_column, base64_png in COLUMNS:
+        if not _column_exists(cr, table, column):
+            continue
+        moved = last_id = 0
+        while True:
+            cr.execute("""
+                SELECT id, %s FROM %s WHERE id > %%s AND %s IS NOT NULL ORDER BY id LIMIT %%s
+            """ % (column, table, column), [last_id, CHUNK])
+            rows = cr.fetchall()
+            if not rows:
+                break
+            for reg_id, value in rows:
+                if base64_png:
+                    value = base64.b64decode(bytes(value))
+                payload_id = store._store(value)
+                if payload_id:
+                    cr.execute('UPDATE %s SET %s = %%s WHERE id = %%s' % (table, payload_column), [payload_id, reg_id])
+                    moved += 1
+            last_id = rows[-1][0]
+        _logger.info('%s: %s %s values moved to payloads', table, moved, column)
+        cr.execute('ALTER TABLE %s DROP COLUMN %s' % (table, column))
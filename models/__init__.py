@@ -3,5 +3,12 @@ from . import res_config_settings
 from . import res_partner
 from . import res_company
 from . import account_tax
+from . import account_invoice_verifactu_payload
 from . import account_invoice_verifactu
+from . import account_invoice_verifactu_batch
+from . import account_invoice_verifactu_chain
+from . import account_invoice_verifactu_flow
+from . import account_invoice_verifactu_breaker
+from . import account_invoice_verifactu_requirement
+from . import account_invoice_verifactu_timing
 from . import account_invoice
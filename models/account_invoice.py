@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 import logging
-from odoo import api, fields, models, _, registry, SUPERUSER_ID
+from odoo import api, fields, models, tools, _
 from odoo.tools import float_is_zero,float_compare
 from odoo.exceptions import UserError, ValidationError
+from .account_invoice_verifactu import VERIFACTU_STATES
+from . import verifactu_rules
 
 _logger = logging.getLogger(__name__)
 
 _DEFAULT_VERIFACTU_INVOICE_TYPE = {'in_invoice': None, 'in_refund': None, 'out_invoice': 'F1', 'out_refund': 'R4'}
 
+# Campos de la factura que alimentan los datos informados en el registro Veri*Factu
+VERIFACTU_LEGAL_FIELDS = (
+    'partner_id', 'company_id', 'currency_id', 'type', 'date_invoice', 'number', 'move_name',
+    'verifactu_invoice_type', 'invoice_line_ids', 'tax_line_ids', 'amount_tax', 'amount_total',
+)
+
 # ---------- Lógica de decisión centralizada ----------
 ''' REGLAS DE OBLIGADO CUMPLIMIENTO (NO REVISADO)
          - verifactu_replaced_invoice tiene por dominio [('type', 'in', ['out_invoice']),('state','in',['open','paid'])]
@@ -56,11 +64,12 @@ class AccountInvoice(models.Model):
     _inherit = "account.invoice"
     
     verifactu_ids = fields.One2many(comodel_name = 'account.invoice.verifactu', inverse_name = 'invoice_id')
-    verifactu_id = fields.Many2one(comodel_name = 'account.invoice.verifactu', compute='_get_verifactu_id')
+    # Mantenidos por _verifactu_sync cada vez que cambia el estado de un registro
+    verifactu_id = fields.Many2one(comodel_name = 'account.invoice.verifactu', index=True, readonly=True, copy=False)
     verifactu_qr = fields.Binary(related='verifactu_id.verifactu_qr')
-    verifactu_state = fields.Selection(related='verifactu_id.state')
-    verifactu_send_date = fields.Datetime(related='verifactu_id.send_date')
-    verifactu_active = fields.Boolean(compute='_get_verifactu_active')
+    verifactu_state = fields.Selection(VERIFACTU_STATES, index=True, readonly=True, copy=False)
+    verifactu_send_date = fields.Datetime(readonly=True, copy=False)
+    verifactu_active = fields.Boolean(compute='_get_verifactu_active', store=True, index=True)
         
     # 1) Solo se puede seleccionar como "replaced" una factura de cliente (out_invoice)
     verifactu_replaced_invoice = fields.Many2one(
@@ -136,92 +145,136 @@ Claves R1–R5 (qué significan)
         for f in self:
             f.verifactu_active = f.company_id.verifactu_date and f.date_invoice and bool(f.date_invoice >= f.company_id.verifactu_date)
 
-    @api.depends('verifactu_ids', 'verifactu_ids.send_date', 'verifactu_ids.state')
-    def _get_verifactu_id(self):
+    @api.multi
+    def _verifactu_sync(self):
         '''
-        El objetivo de este campo es determinar el estado del registro de factura.
+        Actualiza verifactu_id, verifactu_state y verifactu_send_date de las facturas.
         Puede haber varios registros informados para la misma factura (rechazados, aceptados con errores, anulación, rectificación)
-        Esta función hace que el campo calculado verifactu_id apunte a:
+        verifactu_id apunta a:
             - Si el registro ha sido registrado con éxito en la AEAT como aceptado, parcialmente o anulado apunta a él (ignora los rechazos)
             - En caso contrario si existe algún rechazo, apunta al último rechazo
             - Si no existe ningún registro informado será False
-
         '''
         invoices_ids = self.filtered(lambda r: r.id)
         if not invoices_ids:
-            self.write({'verifactu_id': False})
-            return
-        child = self.env['account.invoice.verifactu']
-        query_including_rejected = """
-                SELECT DISTINCT ON (invoice_id) id, invoice_id
-                FROM account_invoice_verifactu
-                WHERE invoice_id = ANY(%s)
-                  AND state in ('accepted','partially_accepted','rejected')
-                ORDER BY invoice_id, send_date DESC NULLS LAST, id DESC
-            """
-        self.env.cr.execute(query_including_rejected, [invoices_ids.ids])
-        # Mapea invoice_id -> verifactu_id
-        children_including_rejected_map = {invoice_id: child.browse(child_id) for child_id, invoice_id in self.env.cr.fetchall()}
-    
-        query_accepted = """
-                SELECT DISTINCT ON (invoice_id) id, invoice_id
-                FROM account_invoice_verifactu
-                WHERE invoice_id = ANY(%s)
-                  AND state in ('accepted','partially_accepted')
-                ORDER BY invoice_id, send_date DESC NULLS LAST, id DESC
-            """
-            
-        self.env.cr.execute(query_accepted, [invoices_ids.ids])
-
-        children_map = {invoice_id: child.browse(child_id) for child_id, invoice_id in self.env.cr.fetchall()}
-        
-        for invoice_id in invoices_ids:
-            if children_map.get(invoice_id.id, False) and children_map.get(invoice_id.id, False).exists():
-                invoice_id.verifactu_id = children_map.get(invoice_id.id, False)
-            elif children_including_rejected_map.get(invoice_id.id, False) and children_including_rejected_map.get(invoice_id.id, False).exists():
-                invoice_id.verifactu_id = children_including_rejected_map.get(invoice_id.id, False)
-            else:
-                invoice_id.verifactu_id = False
+            return True
+        self.env.cr.execute("""
+                UPDATE account_invoice i
+                SET verifactu_id = v.id, verifactu_state = v.state, verifactu_send_date = v.send_date
+                FROM unnest(%s) AS inv(id)
+                LEFT JOIN LATERAL (
+                    SELECT id, state, send_date
+                    FROM account_invoice_verifactu
+                    WHERE invoice_id = inv.id
+                      AND state in ('accepted','partially_accepted','rejected')
+                    ORDER BY state in ('accepted','partially_accepted') DESC, send_date DESC NULLS LAST, id DESC
+                    LIMIT 1
+                ) v ON true
+                WHERE i.id = inv.id
+                  AND (i.verifactu_id IS DISTINCT FROM v.id
+                       OR i.verifactu_state IS DISTINCT FROM v.state
+                       OR i.verifactu_send_date IS DISTINCT FROM v.send_date)
+            """, [invoices_ids.ids])
+        invoices_ids.invalidate_cache(['verifactu_id', 'verifactu_state', 'verifactu_send_date', 'verifactu_qr'], invoices_ids.ids)
+        return True
                 
+    @api.multi
     def create_account_incoice_verifactu(self, values):
-        """Crea account.invoice.verifactu en un cursor independiente + commit."""
-        self.ensure_one()
-        dbname = self.env.cr.dbname
-        with api.Environment.manage():
-            with registry(dbname).cursor() as cr2:
-                env2 = api.Environment(cr2, SUPERUSER_ID, dict(self.env.context or {}))
-                verifactu_id = env2['account.invoice.verifactu'].sudo().create(values) 
-                cr2.commit()
-                return verifactu_id
+        """
+        Crea un account.invoice.verifactu por factura en la transacción de la factura, sin abrir
+        otro cursor ni confirmar una transacción que no es nuestra, y lo deja en la cola de envío.
+        El distribuidor (_cron_dispatch_queue) los envía en bloque una vez confirmada la
+        transacción, con su propio cursor, y valida las facturas aceptadas (_verifactu_post_inform):
+        si la validación falla nada se ha enviado a la AEAT y el registro se deshace con la factura.
+        Con verifactu_async desactivado el distribuidor se ejecuta en cuanto se confirma la
+        transacción (_submit); si no, en la siguiente ejecución de su cron.
+        El error de una factura no impide crear los registros de las demás.
+        """
+        verifactu = self.env['account.invoice.verifactu'].sudo().with_context(
+            verifactu_defer_invoice_sync=True, verifactu_defer_submit=True)
+        registers = verifactu.browse()
+        for invoice in self:
+            try:
+                with self.env.cr.savepoint():
+                    registers |= verifactu.create(dict(values, invoice_id=invoice.id))
+            except Exception:
+                if len(self) == 1:
+                    raise
+                _logger.exception('Error creando el registro Veri*Factu de la factura %s', invoice.move_name)
+        registers.filtered(lambda r: r.company_id.verifactu_sif == 'verificable')._submit()
+        self._verifactu_sync()
+        return registers
             
     @api.multi
     def action_invoice_inform(self):
+        '''
+        Informa a la AEAT las facturas. Con varias facturas (validación en bloque) los asientos se
+        generan juntos y los registros quedan en la cola, desde donde se envían en sobres de varios
+        registros; el resultado se aplica factura a factura: una factura rechazada no afecta a las demás.
+        '''
         # lots of duplicate calls to action_invoice_open, so we remove those already open
-        self.ensure_one()
-        if self.verifactu_state != 'partially_accepted' and self.state != 'draft':
-            raise UserError(_("Invoice must be in draft state in order to validate it."))
-
-        if float_compare(self.amount_total, 0.0, precision_rounding=self.currency_id.rounding) == -1:
-            raise UserError(_("You cannot validate an invoice with a negative total amount. You should create a credit note instead."))
+        for inv in self:
+            if inv.verifactu_state != 'partially_accepted' and inv.state != 'draft':
+                raise UserError(_("Invoice must be in draft state in order to validate it."))
+            if float_compare(inv.amount_total, 0.0, precision_rounding=inv.currency_id.rounding) == -1:
+                raise UserError(_("You cannot validate an invoice with a negative total amount. You should create a credit note instead."))
+            if inv.verifactu_ids.filtered(lambda v: v.queue_state in ['queued','sending']):
+                raise UserError(_("Invoice %s is already waiting to be informed to AEAT.") % inv.move_name)
         
-        if self.state == 'draft':
-            self.action_date_assign()
-            self.action_move_create()
+        drafts = self.filtered(lambda inv: inv.state == 'draft')
+        if drafts:
+            drafts.action_date_assign()
+            drafts.action_move_create()
+
+        to_inform = self.filtered(lambda inv: inv.type in ['out_invoice','out_refund'] and inv.verifactu_active and
+                                  not float_is_zero(inv.amount_total, precision_rounding=inv.currency_id.rounding))
+        if to_inform:
+            to_inform.create_account_incoice_verifactu({'type': 'alta'})
+        
+        res = True
+        for inv in drafts:
+            try:
+                with self.env.cr.savepoint():
+                    res = inv._verifactu_finish_inform()
+            except Exception:
+                if len(drafts) == 1:
+                    raise
+                _logger.exception('Error validando la factura %s tras informarla a AEAT', inv.move_name)
+        return res
 
-        if self.type in ['out_invoice','out_refund'] and self.verifactu_active and not float_is_zero(self.amount_total, precision_rounding = self.currency_id.rounding):
-            verifactu_id = self.create_account_incoice_verifactu({'invoice_id': self.id, 'type': 'alta'})  
-                
-        if self.verifactu_state in ['accepted','partially_accepted'] and self.state == 'draft':
-            res = super(AccountInvoice, self).invoice_validate()
-        elif self.state == 'draft':
-            move_id = self.move_id
-            self.move_id = False
-            move_id.button_cancel()
-            res = move_id.unlink()  
-        else:
-            return True           
-        return res        
+    @api.multi
+    def _verifactu_finish_inform(self):
+        ''' Valida la factura si su registro ha sido aceptado; si no, elimina el asiento y queda en borrador '''
+        self.ensure_one()
+        if self.verifactu_state in ['accepted','partially_accepted']:
+            return super(AccountInvoice, self).invoice_validate()
+        move_id = self.move_id
+        self.move_id = False
+        move_id.button_cancel()
+        return move_id.unlink()
     
+    @api.multi
+    def _verifactu_post_inform(self):
+        '''
+        Valida las facturas en borrador cuyo registro de alta ha sido aceptado por la AEAT
+        después de salir de action_invoice_inform (envío desde la cola).
+        '''
+        for inv in self.filtered(lambda f: f.state == 'draft' and f.verifactu_state in ['accepted','partially_accepted']):
+            if not inv.move_id:
+                inv.action_move_create()
+            inv.invoice_validate()
+        return True
+    
+    @api.multi
+    def _verifactu_rule(self, vals_snapshot=None):
+        ''' Regla de la tabla de decisión (verifactu_rules) que aplica a la factura '''
+        self.ensure_one()
+        # Tomamos valores "en vivo" del record (o un snapshot propuesto por create/write)
+        t = (vals_snapshot or {}).get('type', self.type)
+        partner_id = (vals_snapshot or {}).get('partner_id', self.partner_id.id if self.partner_id else False)
+        rep = self.verifactu_replaced_invoice  # M2O ya resuelto
+        return verifactu_rules.lookup(t, partner_id, rep, rep.partner_id)
+
     @api.multi
     def _decide_values(self, vals_snapshot=None):
         """
@@ -233,90 +286,29 @@ Claves R1–R5 (qué significan)
         según las reglas pedidas.
         """
         self.ensure_one()
-        # Tomamos valores "en vivo" del record (o un snapshot propuesto por create/write)
-        t = (vals_snapshot or {}).get('type', self.type)
+        rule = self._verifactu_rule(vals_snapshot)
         partner_id = (vals_snapshot or {}).get('partner_id', self.partner_id.id if self.partner_id else False)
-        rep = self.verifactu_replaced_invoice  # M2O ya resuelto
-
-        result = {'allowed': []}
-        has_partner = bool(partner_id)
-        has_rep = bool(rep)
-        rep_has_partner = bool(rep.partner_id) if has_rep else False
-
-        # Regla 1: si type es compra (in_invoice/in_refund) => dejar vacío verifactu & replaced
-        if t in ('in_invoice', 'in_refund'):
-            result.update({
-                'verifactu_invoice_type': False,
-                'verifactu_replaced_invoice': False, 
-            })
-            # No forzamos nada más
-            return result
-
-        # A partir de aquí: ámbito de ventas (out_invoice/out_refund/replaced/None)
-        verifactu_invoice_type_ids = self.env['account.invoice.verifactu.type'].search([])
-        verifactu_invoice_type_dict = {t.type: t for t in verifactu_invoice_type_ids}
-        if has_rep:
-            # 3) verifactu_replaced_invoice existe y verifactu_replaced_invoice.partner_id existe
-            if rep_has_partner:
-                # ⇒ debe ser out_refund; partner_id = verifactu_replaced_invoice.partner_id
-                result['type'] = 'out_refund'
-                if (not partner_id) or (partner_id != rep.partner_id.id):
-                    result['partner_id'] = rep.partner_id.id
-                # verifactu: R4 por defecto pero admite R1/R2/R3/R4
-                if self.verifactu_invoice_type.type not in ('R1', 'R2', 'R3', 'R4'):
-                    result['verifactu_invoice_type'] = verifactu_invoice_type_dict.get('R4',False)
-                result['allowed'] = ['R1', 'R2', 'R3', 'R4']
-                return result
-
-            # 4) verifactu_replaced_invoice existe y rep.partner_id NO existe y partner_id NO existe
-            if not rep_has_partner and not has_partner:
-                result['type'] = 'out_refund'
-                result['verifactu_invoice_type'] = verifactu_invoice_type_dict.get('R5',False)
-                result['allowed'] = ['R5']
-                return result
-
-            # 5) verifactu_replaced_invoice existe y rep.partner_id NO existe y partner_id SÍ existe
-            if not rep_has_partner and has_partner:
-                # ⇒ es un canje/sustitución: F3
-                result['type'] = 'replaced'  # <- si querías 'replace', cámbialo aquí y en selection_add
-                result['verifactu_invoice_type'] = verifactu_invoice_type_dict.get('F3',False)
-                result['allowed'] = ['F3']
-                return result
-
-        # Sin verifactu_replaced_invoice
-        if not has_rep and has_partner:
-            # 6) partner existe, type = out_invoice ⇒ F1
-            if t == 'out_invoice':
-                result['verifactu_invoice_type'] = verifactu_invoice_type_dict.get('F1',False)
-                result['allowed'] = ['F1']
-                return result
-
-            # 7) partner existe, type = out_refund ⇒ R4 por defecto (admite R1/R2/R3/R4)
-            if t == 'out_refund':
-                if self.verifactu_invoice_type.type not in ('R1', 'R2', 'R3', 'R4'):
-                    result['verifactu_invoice_type'] = verifactu_invoice_type_dict.get('R4',False)
-                result['allowed'] = ['R1', 'R2', 'R3', 'R4']
-                return result
-
-        # 8) verifactu_replaced_invoice NO y partner NO ⇒ type = out_invoice y F2
-        if not has_rep and not has_partner:
-            result['type'] = 'out_invoice'
-            result['verifactu_invoice_type'] = verifactu_invoice_type_dict.get('F2',False)
-            result['allowed'] = ['F2']
-            return result
-
-        # Si ninguna regla aplicó (raro), no toques nada
+        result = {'allowed': list(rule.allowed)}
+        if rule.clear_replaced:
+            result['verifactu_replaced_invoice'] = False
+        if rule.type:
+            result['type'] = rule.type
+        rep_partner = self.verifactu_replaced_invoice.partner_id
+        if rule.partner_from_replaced and partner_id != rep_partner.id:
+            result['partner_id'] = rep_partner.id
+        code = verifactu_rules.resolve(rule, self.verifactu_invoice_type.type)
+        if code is not None:
+            result['verifactu_invoice_type'] = code and self.env['account.invoice.verifactu.type']._get_type(code)
         return result
 
 
     @api.depends('type', 'partner_id', 'verifactu_replaced_invoice')
     def _get_verifactu_allowed_type_ids(self):
-        verifactu_allowed_type_ids = self.env['account.invoice.verifactu.type']
+        verifactu_type = self.env['account.invoice.verifactu.type']
+        type_ids = verifactu_type._get_type_ids()
         for inv in self:
-            updates = inv._decide_values()
-            allowed = updates.pop('allowed')
-            # Aplicamos cambios
-            inv.verifactu_allowed_type_ids = verifactu_allowed_type_ids.search([('type','in',allowed)])
+            allowed = inv._verifactu_rule().allowed
+            inv.verifactu_allowed_type_ids = verifactu_type.browse([type_ids[code] for code in allowed if code in type_ids])
         
     # ---------- Onchange: aplica automáticamente en el formulario ----------
     @api.onchange('type', 'partner_id', 'verifactu_replaced_invoice')
@@ -340,33 +332,27 @@ Claves R1–R5 (qué significan)
     def _check_verifactu_rules(self):
         for inv in self:
             # Regla 1: compras -> ambos vacíos
-            if inv.type in ('in_invoice', 'in_refund'):
+            if inv.type in verifactu_rules.PURCHASE_TYPES:
                 if inv.verifactu_invoice_type and inv.verifactu_invoice_type.type or inv.verifactu_replaced_invoice:
                     raise ValidationError(_("En facturas de compra (in_invoice/in_refund) "
                                             "verifactu_invoice_type y verifactu_replaced_invoice deben estar vacíos."))
                 continue
 
-            # Recalcular decisión esperada y comparar
-            expected = inv._decide_values()
-            expected.pop('allowed')
-            # Solo comprobamos las claves con reglas explícitas
-            checks = {}
-            for k in ('type', 'verifactu_invoice_type'):
-                if k in expected:
-                    checks[k] = expected[k]
-
+            # Comparamos con la decisión esperada sólo en lo que la regla fija explícitamente
+            rule = inv._verifactu_rule()
+            current_code = inv.verifactu_invoice_type.type
+            checks = []
+            if rule.type:
+                checks.append(('type', rule.type, inv.type))
             # partner_id forzado en el caso replaced->R1..R4
-            if 'partner_id' in expected:
-                checks['partner_id'] = expected['partner_id']
+            if rule.partner_from_replaced:
+                checks.append(('partner_id', inv.verifactu_replaced_invoice.partner_id.id, inv.partner_id.id))
+            code = verifactu_rules.resolve(rule, current_code)
+            if code is not None:
+                checks.append(('verifactu_invoice_type', code, current_code))
 
             # Validaciones
-            for k, v in checks.items():
-                if k =='partner_id':
-                    current = getattr(inv, k) and getattr(inv, k).id
-                elif k=='verifactu_invoice_type':
-                    current = getattr(inv, k) and getattr(inv, k).type
-                else:
-                    current = getattr(inv, k)
+            for k, v, current in checks:
                 if current != v:
                     raise ValidationError(_(
                         "Regla Veri*Factu incumplida para %s (esperado: %s, actual: %s)."
@@ -412,6 +398,10 @@ Claves R1–R5 (qué significan)
     
     @api.multi
     def write(self, vals):
+        # El registro en cola ya tiene su XML y su huella: se enviarían datos que no son los de la factura
+        if set(vals) & set(VERIFACTU_LEGAL_FIELDS):
+            for f in self.filtered(lambda f: f.verifactu_ids.filtered(lambda v: v.queue_state in ['queued','sending'])):
+                raise UserError(_("Invoice %s is waiting to be informed to AEAT and can't be changed until it has been sent.") % f.move_name)
         res = super(AccountInvoice, self).write(vals)
 
         # Asegura que todo lo derivado del write está materializado en BD
@@ -420,15 +410,27 @@ Claves R1–R5 (qué significan)
         invoices = self.browse(self.ids)  # rebrowse limpio
 
         # ---- VERIFICACIONES VERIFACTU POST-ESCRITURA ----
-        # Verificamos que los cambios no afectan a la infomración del registri vefifactu
+        # Verificamos que los cambios no afectan a la infomración del registri vefifactu.
+        # Sólo los campos con trascendencia legal pueden alterarla (p.ej. no la conciliación de pagos)
+        legal_change = bool(set(vals) & set(VERIFACTU_LEGAL_FIELDS))
         verifactu_invoices_to_verify_changes = invoices.filtered(lambda f: f.type in ['out_invoice','out_refund'] and f.verifactu_active and f.verifactu_id)
         verifactu = self.env['account.invoice.verifactu']
         for f in verifactu_invoices_to_verify_changes:
-            if  f.verifactu_id.state in ['accepted','partially_accepted']:
-                data = f.verifactu_id.read(['anterior','date_invoice','even_type','generation_date','hash','invoice_id','rechazo_previo','send_date','signature','sin_registro_previo','subsanacion','type'])[0]
-                v = verifactu.new(data)
-                v.update_register_data()
-                if not verifactu.compare_registers(v.registro_factura, f.verifactu_id.registro_factura):
+            if  f.verifactu_state in ['accepted','partially_accepted']:
+                if not legal_change:
+                    continue
+                register = f.verifactu_id
+                if register.legal_digest:
+                    unchanged = register._legal_digest() == register.legal_digest
+                else:
+                    # Registros anteriores a la huella legal: se regenera el registro y se compara el XML
+                    data = register.read(['anterior','date_invoice','even_type','generation_date','hash','invoice_id','rechazo_previo','send_date','signature','sin_registro_previo','subsanacion','type'])[0]
+                    v = verifactu.new(data)
+                    v.update_register_data()
+                    unchanged = verifactu.compare_registers(v.registro_factura, register.registro_factura)
+                    if unchanged:
+                        register.sudo().write({'legal_digest': register._legal_digest()})
+                if not unchanged:
                     raise ValidationError(_('Changes not accepted for invoice %s. Changes that affect legally required information already provided cannot be changed.') % f.move_name)
             elif f.verifactu_invoice_type not in f.verifactu_allowed_type_ids: 
                 raise ValidationError(_('Changes not accepted for invoice %s. Verifactu invoice type error.') % f.move_name)
@@ -449,7 +451,7 @@ Claves R1–R5 (qué significan)
         values = super(AccountInvoice,self)._prepare_refund(invoice, date_invoice=date_invoice, date=date, description=description, journal_id=journal_id)
         if description in ['R1','R2','R3','R4','R5']:
             AccountInvoiceVerifactuType = self.env['account.invoice.verifactu.type']
-            values.update({'verifactu_invoice_type': AccountInvoiceVerifactuType.search([('type','=',description)],limit = 1).id,
+            values.update({'verifactu_invoice_type': AccountInvoiceVerifactuType._get_type_ids().get(description, False),
                           'verifactu_replaced_invoice': invoice.id,
                           })
         return values
@@ -473,4 +475,30 @@ class AccountInvoiceVerifactuType(models.Model):
     
     name = fields.Char()
     type = fields.Char()
+
+    @api.model
+    @tools.ormcache()
+    def _get_type_ids(self):
+        ''' {código: id} de los tipos de factura; en caché del registry hasta que cambian los tipos '''
+        return dict((r.type, r.id) for r in self.sudo().search([]) if r.type)
+
+    @api.model
+    def _get_type(self, code):
+        return self.browse(self._get_type_ids().get(code, []))
+
+    @api.model
+    def create(self, values):
+        self.clear_caches()
+        return super(AccountInvoiceVerifactuType, self).create(values)
+
+    @api.multi
+    def write(self, values):
+        if 'type' in values:
+            self.clear_caches()
+        return super(AccountInvoiceVerifactuType, self).write(values)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(AccountInvoiceVerifactuType, self).unlink()
                 
\ No newline at end of file
@@ -1,35 +1,121 @@
 # -*- coding: utf-8 -*-
+import os
 import re
+import json
+import time
+import uuid
+import random
+import socket
 import logging
 import hashlib
 import base64
+import tempfile
 import requests
-from urllib.parse import urlencode, quote
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 from lxml import etree
-from signxml import XMLSigner, methods
-from cryptography.hazmat.primitives.serialization import pkcs12
-from requests_pkcs12 import post as pkcs12_post
 
-from odoo import api, fields, models, _
+from odoo import api, fields, models, registry, SUPERUSER_ID, _
 from odoo.exceptions import UserError, ValidationError
 
+from . import aeat_session
+from . import aeat_response
+from . import verifactu_xml
+from . import verifactu_hash
+from . import verifactu_signer
+from . import verifactu_qr
+from . import verifactu_sql
+from . import verifactu_integrity
+from . import verifactu_export
+from . import verifactu_metrics
+
 _logger = logging.getLogger(__name__)
 
+# Tiempo durante el que un registro reclamado por el distribuidor queda reservado.
+# Si el proceso muere antes de terminar, otro distribuidor lo reclamará al expirar.
+_LEASE_SECONDS = 300
+# Clave para los advisory locks de PostgreSQL que serializan el envío por compañía
+_DISPATCH_LOCK_KEY = 0x56460001
+# Máximo de RegistroFactura admitidos por la AEAT en un RegFactuSistemaFacturacion
+MAX_REGISTERS_PER_ENVELOPE = 1000
+# Reintentos inmediatos ante un fallo transitorio antes de dejar el reenvío a la cola
+_INLINE_RETRIES = 2
+_INLINE_BACKOFF = 1
+# Espera (segundos) entre reenvíos desde la cola: exponencial con jitter, hasta _RETRY_BACKOFF_MAX
+_RETRY_BACKOFF = 30
+_RETRY_BACKOFF_MAX = 3600
+# Envíos con fallo transitorio tras los que el registro se da por rechazado
+_MAX_SEND_ATTEMPTS = 10
+# Registros por UPDATE al regenerar en bloque las URL de los QR
+_QR_UPDATE_CHUNK = 1000
+# EstadoRegistro de cada RespuestaLinea -> estado del registro
+_ESTADO_REGISTRO = {
+    'Correcto': 'accepted',
+    'AceptadoConErrores': 'partially_accepted',
+    'Incorrecto': 'rejected',
+}
+
+# EstadoEnvio de la respuesta: estado de los registros sin RespuestaLinea propia
+_ESTADO_ENVIO = {
+    'Correcto': 'accepted',
+    'ParcialmenteCorrecto': 'partially_accepted',
+    'Incorrecto': 'rejected',
+}
+
+VERIFACTU_STATES = [
+    ('draft', 'No informada'),
+    ('accepted', 'Aceptada'),
+    ('partially_accepted', 'Parcialmente Aceptada'),
+    ('rejected', 'Rechazada'),
+]
+
+# Índices compuestos para los accesos habituales (encadenamiento, estado de la factura, cola)
+_INDEXES = [
+    ('account_invoice_verifactu_chain_idx',
+     '(company_id, type, state, send_date DESC, generation_date DESC, id DESC)', ''),
+    ('account_invoice_verifactu_invoice_state_idx',
+     '(invoice_id, state, send_date DESC, generation_date DESC, id DESC)', ''),
+    ('account_invoice_verifactu_invoice_informed_idx',
+     '(invoice_id, send_date DESC NULLS LAST, id DESC)', "WHERE state IN ('accepted','partially_accepted','rejected')"),
+    ('account_invoice_verifactu_queue_idx',
+     '(company_id, id)', "WHERE queue_state IN ('queued','sending')"),
+]
+
 class AccountInvoiceVerifactu(models.Model):
     _name = "account.invoice.verifactu"
+    _inherit = ['account.invoice.verifactu.payload.mixin']
+    
+    # Contenido guardado comprimido en account.invoice.verifactu.payload
+    _payload_fields = {
+        'registro_factura': 'text',
+        'signature': 'text',
+        'request': 'text',
+        'response': 'text',
+        # QR guardados antes de qr_url
+        'verifactu_qr': 'binary',
+    }
 
-    invoice_id = fields.Many2one('account.invoice')
+    invoice_id = fields.Many2one('account.invoice', index=True)
     number = fields.Char(related='invoice_id.move_name')
     
-    verifactu_qr = fields.Binary("Veri*factu QR",
+    company_id = fields.Many2one('res.company', index=True, help="Compañía de la factura (obligado a emitir)")
+    
+    verifactu_qr = fields.Binary("Veri*factu QR", compute='_compute_verifactu_qr',
         help="QR fro veri*factu 200x200px")
+    qr_url = fields.Char(string="QR URL", readonly=True, copy=False,
+        help="URL de cotejo de la factura en la AEAT codificada en el QR; la imagen se genera al mostrarla")
+    qr_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
     
-    hash = fields.Char(size=256,
+    # SHA-256 en hexadecimal (64 caracteres)
+    hash = fields.Char(size=64, index=True,
         help="Hash gerenated for sending AEAT")
     
+    legal_digest = fields.Char(size=64, readonly=True, copy=False,
+                               help="SHA-256 de los datos de la factura con trascendencia legal incluidos en el registro")
+    
     anterior = fields.Many2one('account.invoice.verifactu', help="Anterior register sent to AEAT to use as concatenation")
     
     type = fields.Selection([('alta','Registro de alta'),('anulation','Registro de anulación'),('event','Registro de evento')])
@@ -49,12 +135,13 @@ class AccountInvoiceVerifactu(models.Model):
         ]
         )
     
-    state = fields.Selection([
-          ('draft', 'No informada'),
-          ('accepted', 'Aceptada'),
-          ('partially_accepted', 'Parcialmente Aceptada'),
-          ('rejected', 'Rechazada'),
-      ], default='draft',
+    event_processed = fields.Integer(string="Registros procesados", readonly=True, copy=False,
+                                     help="Registros de facturación procesados por el proceso de detección de anomalías")
+    event_anomalies = fields.Integer(string="Anomalías", readonly=True, copy=False)
+    event_details = fields.Text(string="Detalle del evento", readonly=True, copy=False,
+                                help="Detalle del evento en JSON (p.ej. registros anómalos por comprobación)")
+    
+    state = fields.Selection(VERIFACTU_STATES, default='draft',
          help="""
          *draft (No informada): No enviada/informada a la AEAT,
          *accepted (Aceptada): Enviada/informada a la AEAT y aceptado el registro,
@@ -68,13 +155,20 @@ class AccountInvoiceVerifactu(models.Model):
     rechazo_previo = fields.Selection([('S','Si'),('N','No'),('X','')], help=_("Exist a rejected try"))
     subsanacion = fields.Selection([('S','Si'),('N','No')], help=_("Exist a partially accepted register"))
     
-    registro_factura = fields.Text(string="Registro Factura Verifactu")
+    registro_factura = fields.Text(string="Registro Factura Verifactu",
+                                   compute='_compute_registro_factura', inverse='_inverse_registro_factura')
+    registro_factura_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
     
-    signature = fields.Text(help="Firma electrónica del registro de facturación en formato Xades Enveloped.\n Namespace=http://www.w3.org/2000/09/xmldsig#", default='')
+    signature = fields.Text(help="Firma electrónica del registro de facturación en formato Xades Enveloped.\n Namespace=http://www.w3.org/2000/09/xmldsig#",
+                            compute='_compute_signature', inverse='_inverse_signature')
+    signature_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
     
-    request = fields.Text(help="Soap Envelope to send AEAT, including registro_factura and signature", default='')
+    request = fields.Text(help="Soap Envelope to send AEAT, including registro_factura and signature",
+                          compute='_compute_request', inverse='_inverse_request')
+    request_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
     
-    response = fields.Text(help="AEAT soap service response")
+    response = fields.Text(help="AEAT soap service response", compute='_compute_response', inverse='_inverse_response')
+    response_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
     
     response_mode = fields.Selection([
         ('xml', 'XML'),
@@ -91,12 +185,57 @@ class AccountInvoiceVerifactu(models.Model):
     
     send_date = fields.Datetime()
     
+    estado_registro = fields.Selection([(key, key) for key in _ESTADO_REGISTRO], index=True, readonly=True, copy=False,
+                                       help="EstadoRegistro de la RespuestaLinea de la AEAT")
+    codigo_error_registro = fields.Char(index=True, readonly=True, copy=False,
+                                        help="CodigoErrorRegistro de la RespuestaLinea de la AEAT")
+    descripcion_error_registro = fields.Char(readonly=True, copy=False,
+                                             help="DescripcionErrorRegistro de la RespuestaLinea de la AEAT")
+    csv = fields.Char(string="CSV", index=True, readonly=True, copy=False,
+                      help="Código seguro de verificación del envío devuelto por la AEAT")
+    
+    queue_state = fields.Selection([
+        ('queued', 'En cola'),
+        ('sending', 'Enviando'),
+        ('done', 'Procesado'),
+        ], index=True, copy=False,
+        help="""
+        *queued (En cola): Registro generado y encadenado pendiente de envío a la AEAT,
+        *sending (Enviando): Reclamado por el distribuidor de envíos (ver lease_until),
+        *done (Procesado): Enviado y aplicada la respuesta de la AEAT
+        """)
+    send_attempts = fields.Integer(readonly=True, copy=False, help="Envíos fallidos por errores transitorios de transporte")
+    last_error = fields.Char(readonly=True, copy=False, help="Último error de transporte")
+    retry_after = fields.Datetime(readonly=True, copy=False, help="El registro se reenvía, sin cambios, a partir de esta fecha")
+    
+    lease_owner = fields.Char(copy=False, help="Distribuidor que tiene reservado el registro")
+    lease_until = fields.Datetime(copy=False, help="Fin de la reserva del registro por el distribuidor")
+    
+    batch_id = fields.Many2one('account.invoice.verifactu.batch', index=True, copy=False, ondelete='set null',
+        help="Envío en bloque en el que se informó el registro")
+    
+    timing_ids = fields.One2many('account.invoice.verifactu.timing', 'register_id', string="Tiempos por etapa", readonly=True,
+        help="Duración de cada etapa del registro (parámetro account_verifactu.verifactu_metrics)")
+    
+    @api.model_cr_context
+    def _auto_init(self):
+        res = super(AccountInvoiceVerifactu, self)._auto_init()
+        cr = self.env.cr
+        for name, expression, where in _INDEXES:
+            cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [name])
+            if not cr.fetchone():
+                cr.execute('CREATE INDEX "%s" ON "%s" %s %s' % (name, self._table, expression, where))
+        return res
+    
     @api.model
     def create(self, values):
         if 'invoice_id' in values and 'type' in values:
             invoice_id = self.env['account.invoice'].sudo().browse(values['invoice_id'])
+            values.setdefault('company_id', invoice_id.company_id.id)
             # Si el código qr se había generado debemos mantenerlo
-            verifactu_qr = invoice_id.verifactu_qr or b'' # guardamos el código qr
+            # guardamos el código qr
+            qr_url = invoice_id.verifactu_id.qr_url
+            qr_payload_id = invoice_id.verifactu_id.qr_payload_id.id
             if invoice_id.exists() and (invoice_id.type in ['out_invoice','out_refund']) and invoice_id.verifactu_active:
                 if invoice_id.verifactu_invoice_type in invoice_id.verifactu_allowed_type_ids:
                     if values['type'] == 'alta':
@@ -107,9 +246,9 @@ class AccountInvoiceVerifactu(models.Model):
                             if res:
                                 res.update_register_data()
                                 if res.invoice_id.company_id.verifactu_sif == 'verificable':
-                                    res.send_soap_request()
-                                    if res.state in ['accepted','partially_accepted']:
-                                        res.generate_qr()
+                                    # Al informar desde la factura se dejan en la cola (create_account_incoice_verifactu)
+                                    if not self._context.get('verifactu_defer_submit'):
+                                        res._submit()
                                 elif res.invoice_id.company_id.verifactu_sif == 'no_verificable':
                                     res.generate_qr()
                             return res
@@ -121,14 +260,15 @@ class AccountInvoiceVerifactu(models.Model):
                         elif invoice_id.state == 'cancel' and invoice_id.verifactu_state not in ['rejected']:
                             raise UserError(_("Canceled invoice %s is informed so you can't anulate it") % invoice_id.move_name)
                         else:
-                            values['verifactu_qr'] = verifactu_qr # mantenemos el mismo qr que el de la factura sin anular
+                            # mantenemos el mismo qr que el de la factura sin anular
+                            values.update(qr_url=qr_url, qr_payload_id=qr_payload_id)
                             res = super(AccountInvoiceVerifactu,self).create(values)
                             if res:
                                 res.update_register_data()
                                 if res.invoice_id.company_id.verifactu_sif == 'verificable':
-                                    res.send_soap_request()
-                                    if res.state in ['accepted','partially_accepted']:
-                                        res.generate_qr()
+                                    # Al informar desde la factura se dejan en la cola (create_account_incoice_verifactu)
+                                    if not self._context.get('verifactu_defer_submit'):
+                                        res._submit()
                                 elif res.invoice_id.company_id.verifactu_sif == 'no_verificable':
                                     res.write()
                                     res.generate_qr()
@@ -140,9 +280,25 @@ class AccountInvoiceVerifactu(models.Model):
                     raise ValidationError(_('Invoice type error'))                    
             else:
                 raise ValidationError(_('Just out invoices and refund for verifactua active companies should be informed'))
+        elif values.get('type') == 'event' and values.get('company_id') and values.get('even_type'):
+            # Registros de evento de la compañía: se encadenan entre sí y se conservan en el sistema
+            res = super(AccountInvoiceVerifactu,self).create(values)
+            res.update_register_data()
+            self.env['account.invoice.verifactu.chain']._get_head(res.company_id.id, 'event')._set_head(res)
+            return res
         else:
             raise ValidationError(_('Register type or invoice not found'))
     
+    @api.multi
+    def write(self, values):
+        invoices = self.mapped('invoice_id') if 'invoice_id' in values else self.env['account.invoice']
+        res = super(AccountInvoiceVerifactu, self).write(values)
+        if values.get('state') in ['accepted','partially_accepted']:
+            self.env['account.invoice.verifactu.chain']._advance(self)
+        if {'state', 'send_date', 'invoice_id'} & set(values) and not self._context.get('verifactu_defer_invoice_sync'):
+            (invoices | self.mapped('invoice_id'))._verifactu_sync()
+        return res
+    
     @api.model
     def compare_registers(self, reg1, reg2):
         ''' Comprueba si dos registros se generan a partir de los mismo datos de factura '''
@@ -169,11 +325,57 @@ class AccountInvoiceVerifactu(models.Model):
         # comparar por C14N tras normalizar
         reg1_c14n = etree.tostring(xml1, method='c14n', exclusive=True, with_comments=False)
         reg2_c14n = etree.tostring(xml2, method='c14n', exclusive=True, with_comments=False)
-        _logger.info(self.pretty_xml(reg1_c14n, xml_declaration=False))
-        _logger.info(self.pretty_xml(reg2_c14n, xml_declaration=False))
+        _logger.debug(self.pretty_xml(reg1_c14n, xml_declaration=False))
+        _logger.debug(self.pretty_xml(reg2_c14n, xml_declaration=False))
         return reg1_c14n == reg2_c14n
 
 
+    @api.multi
+    def _legal_digest(self):
+        '''
+        Huella SHA-256 de los datos de la factura que el registro comunica a la AEAT, excluyendo los
+        propios del registro (Subsanacion, RechazoPrevio, Encadenamiento, Huella y fecha de generación).
+        Dos registros con la misma huella legal informan la misma factura, igual que compare_registers.
+        '''
+        self.ensure_one()
+        invoice = self.invoice_id
+        if self.type not in ('alta', 'anulation') or not invoice:
+            return False
+        company = invoice.company_id
+        cuples = [
+            ("Tipo", self.type),
+            ("IDEmisorFactura", company.partner_id.vat_clean()[1]),
+            ("NumSerieFactura", invoice.move_name or ''),
+            ("FechaExpedicionFactura", self.date_invoice or ''),
+            ("NombreRazon", company.verifactu_razon_social or ''),
+            ("NIF", company.vat_clean()[1]),
+        ]
+        if self.type == 'alta':
+            partner = invoice.partner_id
+            cuples += [
+                ("TipoFactura", invoice.verifactu_invoice_type.type or ''),
+                ("DescripcionOperacion", company.verifactu_operation or ''),
+                ("NombreRazonDestinatario", partner.name or ''),
+                ("NIFDestinatario", partner.vat_clean()[1] if partner else ''),
+            ]
+            for tax_line in invoice.tax_line_ids:
+                tax = tax_line.tax_id
+                cuples += [
+                    ("Impuesto", tax.verifactu_impuesto or ''),
+                    ("ClaveRegimen", tax.verifactu_regimen or ''),
+                    ("OperacionExenta", tax.verifactu_exento or ''),
+                    ("CalificacionOperacion", tax.verifactu_calificacion or ''),
+                    ("TipoImpositivo", "{:.2f}".format(tax.amount or 0.00)),
+                    ("BaseImponibleOimporteNoSujeto", "{:.2f}".format(tax_line.base)),
+                    ("CuotaRepercutida", "{:.2f}".format(tax_line.amount_total)),
+                ]
+            cuples += [
+                ("CuotaTotal", "{:.2f}".format(invoice.amount_tax)),
+                ("ImporteTotal", "{:.2f}".format(invoice.amount_total)),
+            ]
+        chain = "&".join("{}={}".format(k, v) for k, v in cuples)
+        return hashlib.sha256(chain.encode("utf-8")).hexdigest().upper()
+
     @api.depends('state')
     def _compute_state_icon(self):
         for rec in self:
@@ -185,6 +387,45 @@ class AccountInvoiceVerifactu(models.Model):
             }
             rec.state_icon = mapping.get(rec.state, u'●')
         
+    @api.depends('registro_factura_payload_id')
+    def _compute_registro_factura(self):
+        self._get_payload('registro_factura')
+
+    def _inverse_registro_factura(self):
+        self._set_payload('registro_factura')
+
+    @api.depends('signature_payload_id')
+    def _compute_signature(self):
+        self._get_payload('signature')
+
+    def _inverse_signature(self):
+        self._set_payload('signature')
+
+    @api.depends('request_payload_id')
+    def _compute_request(self):
+        self._get_payload('request')
+
+    def _inverse_request(self):
+        self._set_payload('request')
+
+    @api.depends('response_payload_id')
+    def _compute_response(self):
+        self._get_payload('response')
+
+    def _inverse_response(self):
+        self._set_payload('response')
+
+    @api.depends('qr_url', 'qr_payload_id')
+    def _compute_verifactu_qr(self):
+        report = self.env['ir.actions.report']
+
+        def render(url):
+            return report.barcode('QR', url, width=verifactu_qr.QR_SIZE, height=verifactu_qr.QR_SIZE, humanreadable=0)
+
+        for rec in self.filtered('qr_url'):
+            rec.verifactu_qr = base64.b64encode(verifactu_qr.png_cache.get(rec.qr_url, render))
+        self.filtered(lambda r: not r.qr_url)._get_payload('verifactu_qr')
+
     @api.depends('response')
     def _compute_response_mode(self):
         '''
@@ -192,17 +433,22 @@ class AccountInvoiceVerifactu(models.Model):
         En caso contrario devuelve un html 
         '''
         for rec in self:
-            t = (rec.response or '').lstrip()
-            low = t[:200].lower()
-            mode = 'text'
-            if t.startswith('{') or t.startswith('['):
-                mode = 'json'
-            elif t.startswith('<'):
-                if low.startswith('<!doctype html') or '<html' in low:
-                    mode = 'html'
-                else:
-                    mode = 'xml'
-            rec.response_mode = mode
+            rec.response_mode = self._get_response_mode(rec.response)
+
+    @api.model
+    def _get_response_mode(self, response):
+        ''' xml, html, json o text según el contenido de la respuesta '''
+        t = (response or '').lstrip()
+        low = t[:200].lower()
+        mode = 'text'
+        if t.startswith('{') or t.startswith('['):
+            mode = 'json'
+        elif t.startswith('<'):
+            if low.startswith('<!doctype html') or '<html' in low:
+                mode = 'html'
+            else:
+                mode = 'xml'
+        return mode
 
     @api.depends('response', 'response_mode')
     def _compute_response_html(self):
@@ -217,7 +463,7 @@ class AccountInvoiceVerifactu(models.Model):
                     rec.invoice_id.date_invoice, "%Y-%m-%d"
                 ).strftime("%d-%m-%Y")
             else:
-                rec.fecha_ddmmyyyy = ""
+                rec.date_invoice = ""
 
     @api.model
     def pretty_xml(self, xml_str, encoding='UTF-8', xml_declaration=True):
@@ -255,54 +501,78 @@ class AccountInvoiceVerifactu(models.Model):
         y si estamos en modo producción o pruebas
         '''
         self.ensure_one()
-        runing_method = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_runing_method')
-        sif_verificable = self.invoice_id.company_id.verifactu_sif
-        endpoint = False
-        if runing_method == 'production':
-            if sif_verificable == 'verificable':
-                endpoint = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_endpoint_produccion_verificable')
-            else:
-                endpoint = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_endpoint_produccion_no_verificable')
-        else:
-            if sif_verificable == 'verificable':
-                endpoint = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_endpoint_no_produccion_verificable')
-            else:
-                endpoint = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_endpoint_no_produccion_no_verificable')
-        return endpoint
+        return (self.invoice_id.company_id or self.company_id)._verifactu_config().endpoint
     
     @api.multi
+    @verifactu_metrics.timed('generate_qr')
     def generate_qr(self):
         '''
-        Genera el QR y lo asocia al registro
+        Genera la URL del QR y la asocia al registro; la imagen se genera al mostrarla
         '''
-        
+        for vf, url in self._qr_urls().items():
+            if vf.qr_url != url:
+                vf.qr_url = url
+        # importante: recargar la vista para ver la imagen recién escrita
+        return {'type': 'ir.actions.client', 'tag': 'reload'}
 
-        report = self.env['ir.actions.report']
-        for vf in self:
+    @api.multi
+    def _qr_urls(self):
+        ''' {registro: URL del QR} '''
+        urls = OrderedDict()
+        for vf in self.filtered('invoice_id'):
+            invoice = vf.invoice_id
+            company = invoice.company_id
+            config = company._verifactu_config()
             # normalize NIF to not include country sympbol
-            country_code = vf.invoice_id.company_id.country_id.code
-            vat_number = vf.invoice_id.company_id.vat
-            vat = re.sub(r"^%s" % re.escape(country_code), "", vat_number, flags=re.IGNORECASE).strip()
-            date = datetime.strptime(vf.invoice_id.date_invoice, "%Y-%m-%d").strftime("%d-%m-%Y")
-            amount = "{:.2f}".format(vf.invoice_id.amount_total)
-            number = vf.invoice_id.move_name
-            params = {
-                'nif': vat,
-                'numserie': number,   # el '/' se codificará a %2F
-                'fecha': date,         # DD-MM-AAAA
-                'importe': amount,             # punto decimal
-            }
-            # Codifica SOLO valores de parámetros (mantén ?, &, = sin codificar)
-            endpoint = self.verifactu_endpoint().replace('/ws/SistemaFacturacion/VerifactuSOAP','/ValidarQR').replace('/ws/SistemaFacturacion/RequerimientoSOAP','ValidarQRNoVerifactu').replace('www1','www2')
-            value = endpoint + '?' + urlencode(params, quote_via=quote, safe='')
-            # Genera el QR sin volver a codificar la URL completa
-            png = report.barcode('QR', value, width=200, height=200, humanreadable=0)
-            # genera PNG (bytes) y guarda en binario (base64-encoded BYTES, no str)
-            vf.verifactu_qr = base64.b64encode(png)  # NO hagas str(...)
-        # importante: recargar la vista para ver la imagen recién escrita
-        return {'type': 'ir.actions.client', 'tag': 'reload'}   
+            vat = verifactu_hash.clean_vat(company.country_id.code, company.vat)
+            date = datetime.strptime(invoice.date_invoice, "%Y-%m-%d").strftime("%d-%m-%Y")
+            urls[vf] = verifactu_qr.qr_url(config.endpoint, vat, invoice.move_name, date, invoice.amount_total)
+        return urls
+
+    @api.model
+    def _regenerate_qr_urls(self, company_ids=None):
+        '''
+        Recalcula en una sola pasada la URL del QR de todos los registros que lo tienen,
+        p.ej. tras cambiar el endpoint. Se recorre con un cursor de servidor y se actualiza
+        por bloques con SQL.
+        '''
+        companies = self.env['res.company'].browse(company_ids) if company_ids else self.env['res.company'].search([])
+        updated = 0
+        for company in companies:
+            endpoint = company._verifactu_config().endpoint
+            vat = verifactu_hash.clean_vat(company.country_id.code, company.vat)
+            rows = verifactu_sql.stream_rows(self.env.cr, 'verifactu_qr_urls', """
+                SELECT r.id, i.move_name, to_char(i.date_invoice, 'DD-MM-YYYY'), i.amount_total
+                  FROM account_invoice_verifactu r
+                  JOIN account_invoice i ON i.id = r.invoice_id
+                 WHERE r.company_id = %s AND (r.qr_url IS NOT NULL OR r.qr_payload_id IS NOT NULL)
+            """, [company.id])
+            chunk = []
+            for reg_id, move_name, fecha, amount_total in rows:
+                chunk.append((reg_id, verifactu_qr.qr_url(endpoint, vat, move_name, fecha, amount_total)))
+                if len(chunk) >= _QR_UPDATE_CHUNK:
+                    updated += self._write_qr_urls(chunk)
+                    chunk = []
+            updated += self._write_qr_urls(chunk)
+        self.invalidate_cache(['qr_url', 'verifactu_qr'])
+        self.env['account.invoice'].invalidate_cache(['verifactu_qr'])
+        _logger.info("Veri*Factu: QR URL regenerated on %s registers", updated)
+        return updated
+
+    @api.model
+    def _write_qr_urls(self, values):
+        ''' UPDATE ... FROM (VALUES ...) de una lista [(id, url)] '''
+        if not values:
+            return 0
+        self.env.cr.execute("""
+            UPDATE account_invoice_verifactu r SET qr_url = v.url
+              FROM (VALUES %s) AS v(id, url)
+             WHERE r.id = v.id AND r.qr_url IS DISTINCT FROM v.url
+        """ % ', '.join(['(%s, %s)'] * len(values)), [item for pair in values for item in pair])
+        return self.env.cr.rowcount
     
     @api.multi
+    @verifactu_metrics.timed('sign', size=lambda records, signature: verifactu_metrics.payload_size(signature))
     def _build_signature_tag_from_p12(self):
         """
         Devuelve SOLO el tag <ds:Signature>...</ds:Signature> (XMLDSig Enveloped),
@@ -330,128 +600,53 @@ class AccountInvoiceVerifactu(models.Model):
         if not (company and company.verifactu_date):
             raise UserError(_("Esta compañía no está habilitada para Verifactu."))
     
-        if not company.verifactu_p12_file:
+        if not company.sudo().verifactu_p12_file:
             raise UserError(_("No se encontró el contenido del certificado .p12 en la compañía."))
     
-        p12_password = (company.verifactu_p12_password or "").strip()
-    
-        # 2) Cargar clave y certificado desde PKCS#12 (desde Binary base64)
+        # 2) Clave, certificado y firmante ya preparados (caché por compañía y certificado)
         try:
-            p12_data = base64.b64decode(company.verifactu_p12_file)
-        except Exception as e:
-            _logger.exception("Error decodificando el .p12 (base64)")
-            raise UserError(_("El contenido base64 del .p12 es inválido: %s") % e)
-    
-        try:
-            try:
-                # cryptography >= 3.4 (no necesita backend)
-                private_key, cert, additional_certs = pkcs12.load_key_and_certificates(
-                p12_data,
-                p12_password.encode("utf-8") if p12_password else None
-                )
-            except TypeError:
-                # cryptography 2.x (requiere backend)
-                from cryptography.hazmat.backends import default_backend
-                private_key, cert, additional_certs = pkcs12.load_key_and_certificates(
-                p12_data,
-                p12_password.encode("utf-8") if p12_password else None,
-                backend=default_backend()
-                )
-            if private_key is None or cert is None:
-                raise ValueError("El .p12 no contiene clave y/o certificado.")
+            bundle = company._verifactu_p12()
         except Exception as e:
             _logger.exception("Error cargando .p12 desde Binary")
             raise UserError(_("No se pudo cargar el .p12: %s") % e)
 
-
-        # 3) Preparar firmante XMLDSig Enveloped (RSA-SHA256, digest SHA256, C14N 1.0)
-        signer = XMLSigner(
-            method=methods.enveloped,
-            signature_algorithm="rsa-sha256",
-            digest_algorithm="sha256",
-            c14n_algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315",
-        )
-
-        # 4) Firmar el documento (inserta <ds:Signature> dentro del root)
+        # 3) Firmar el documento con el motor de firma del certificado (inserta <ds:Signature> dentro del root)
         try:
-            # reference_uri=None => referencia al root (enveloped signature)
-            #Firmar: usar cert_chain en lugar de cert (evita el TypeError)
-            chain = [cert] + (additional_certs or [])
-            signed_root = signer.sign(
-                root,
-                key=private_key,
-                cert=chain,                     # << clave: iterable con el cert principal y cadena
-                key_name=None,                  # puedes poner un KeyName si AEAT lo pide
-                always_add_key_value=True       # añade <ds:KeyValue> (útil para interoperabilidad)
-            )
-        except TypeError:
-            # Fallback para versiones que esperan bytes DER en lugar de objetos
-            from cryptography.hazmat.primitives import serialization
-            chain_der = [c.public_bytes(serialization.Encoding.DER) for c in [cert] + (additional_certs or [])]
-            signed_root = signer.sign(
-                root,
-                key=private_key,
-                cert_chain=chain_der, 
-                key_name=None,
-                always_add_key_value=True
-            )
+            _signed_root, sig_el = bundle.register_signer.sign(root)
         except Exception as e:
             _logger.exception("Error firmando XML")
             raise UserError(_("Fallo al firmar el XML: %s") % e)
 
-        # 5) Extraer SOLO el elemento <ds:Signature> y devolverlo como string
-        DSIG_NS = "http://www.w3.org/2000/09/xmldsig#"
-        sig_el = signed_root.find(".//{%s}Signature" % DSIG_NS)
-        if sig_el is None:
-            raise UserError(_("No se pudo localizar el elemento <Signature> en la firma generada."))
-
+        # 4) Devolver SOLO el elemento <ds:Signature> como string
         return etree.tostring(sig_el, pretty_print=True, encoding="utf-8").decode("utf-8")
         
     @api.multi    
     def generate_hash(self):
         self.ensure_one()
-        country_code = self.invoice_id.company_id.country_id.code
-        vat_number = self.invoice_id.company_id.vat
-        vat = re.sub(r"^%s" % re.escape(country_code), "", vat_number, flags=re.IGNORECASE).strip()
+        company = self.company_id or self.invoice_id.company_id
+        vat = verifactu_hash.clean_vat(company.country_id.code, company.vat)
+        anterior_hash = self.anterior and self.anterior.hash or ""
         cuples = []
         chain = ''
         if self.type=='alta':
-            cuples = [
-                ("IDEmisorFactura", vat),
-                ("NumSerieFactura", self.invoice_id.move_name.strip()),
-                ("FechaExpedicionFactura", self.date_invoice.strip()),
-                ("TipoFactura", self.invoice_id.verifactu_invoice_type.type),
-                ("CuotaTotal", "{:.2f}".format(self.invoice_id.amount_tax  * (1 if self.invoice_id.type == 'out_invoice' else -1))),
-                ("ImporteTotal", "{:.2f}".format(self.invoice_id.amount_total  * (1 if self.invoice_id.type == 'out_invoice' else -1))),
-                ("Huella", (self.anterior and self.anterior.hash or "").strip()),
-                ("FechaHoraHusoGenRegistro", self.generation_date),
-            ]
+            sign = verifactu_hash.amount_sign(self.invoice_id.type)
+            cuples = verifactu_hash.alta_cuples(
+                vat, self.invoice_id.move_name, self.date_invoice, self.invoice_id.verifactu_invoice_type.type,
+                self.invoice_id.amount_tax * sign, self.invoice_id.amount_total * sign,
+                anterior_hash, self.generation_date)
         elif self.type=='anulation':
-            cuples = [
-                ("IDEmisorFacturaAnulada", vat),
-                ("NumSerieFacturaAnulada", self.invoice_id.move_name.strip()),
-                ("FechaExpedicionFacturaAnulada", self.date_invoice.strip()),
-                ("Huella", (self.anterior and self.anterior.hash or "").strip()),
-                ("FechaHoraHusoGenRegistro", self.generation_date),
-            ]            
+            cuples = verifactu_hash.anulation_cuples(
+                vat, self.invoice_id.move_name, self.date_invoice, anterior_hash, self.generation_date)
         elif self.type=='event':
-            cuples = [
-                ("NIF", vat),
-                ("IdSistemaInformatico", 'OD'),
-                ("Version", '11.0.0'),
-                ("NumeroInstalacion", str(self.invoice_id.company_id.id)),
-                ("NIF", vat),
-                ("TipoEvento", self.even_type),
-                ("HuellaEvento", (self.anterior and self.anterior.hash or "").strip()),
-                ("FechaHoraHusoGenEvento", self.generation_date),
-            ]            
+            cuples = verifactu_hash.event_cuples(vat, company.id, self.even_type, anterior_hash, self.generation_date)
         if cuples:
-            chain = "&".join("{}={}".format(k, v) for k, v in cuples)
-            self.hash = hashlib.sha256(chain.encode("utf-8")).hexdigest().upper()
+            chain, self.hash = verifactu_hash.compute_hash(cuples)
             _logger.info('Hass: %s calculated for chain %s' % (self.hash, chain))
         return chain
     
     @api.multi
+    @verifactu_metrics.timed('update_register_data',
+                             size=lambda records, _res: verifactu_metrics.payload_size(records.registro_factura))
     def update_register_data(self):
         self.ensure_one()
     
@@ -460,14 +655,18 @@ class AccountInvoiceVerifactu(models.Model):
             fields.Datetime.context_timestamp(self, datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S%z')
         )
         domain = [('id', '!=', self.id)] if not isinstance(self.id, models.NewId) else []
-        domain += [('state', '!=', 'draft'),('invoice_id.company_id', '=', self.invoice_id.company_id.id),]
+        domain += [('state', '!=', 'draft'),('company_id', '=', self.invoice_id.company_id.id),]
         domain += [('type','=','event')] if self.type == 'event' else [('type','!=','event')]
             
-        prev_any = self.search(domain + [('invoice_id', '=', self.invoice_id.id),], order='send_date desc, generation_date desc, id desc', limit=1)
+        # Registros previos de la misma factura (pocos): una sola consulta para ambos indicadores
+        prev_invoice = self.search(domain + [('invoice_id', '=', self.invoice_id.id),], order='send_date desc, generation_date desc, id desc') \
+            if self.invoice_id else self.browse()
+        prev_any = prev_invoice[:1]
         prev_rejected = bool(prev_any and prev_any.state == 'rejected')
-        prev_in_aeat = self.search(domain + [('invoice_id', '=', self.invoice_id.id),('state', 'in', ['accepted', 'partially_accepted']),], limit=1).exists()
-        # El encadenado debe sólo con registros aceptados o partcialmente aceptados
-        self.anterior = self.search(domain + [('state', 'in', ['accepted', 'partially_accepted']),], order="send_date desc, generation_date desc, id desc", limit=1)
+        # Un registro ya aceptado que se reconstruye (reencadenado tras un rechazo) es una subsanación
+        prev_in_aeat = self.state in ['accepted', 'partially_accepted'] or \
+            bool(prev_invoice.filtered(lambda r: r.state in ['accepted', 'partially_accepted']))
+        self.anterior = self._get_anterior()
     
         # === 1) Ramas por tipo ===
         if self.type == 'alta':
@@ -486,25 +685,101 @@ class AccountInvoiceVerifactu(models.Model):
     
         # === 2) Huella (dependiente de type)
         self.generate_hash()
-        self.generate_register()
-        # === 3) Firma y regeneración XML en No-Verificable ===
+        if self.type == 'event':
+            # Los eventos no se remiten a la AEAT: su contenido queda en event_details
+            return True
+        self.legal_digest = self._legal_digest()
+        # === 3) XML; en No-Verificable se construye y firma en una sola pasada ===
         if self.invoice_id.company_id.verifactu_sif == 'no_verificable':
+            if self._context.get('verifactu_defer_sign'):
+                # _chain_batch firma después todos los registros juntos
+                return True
+            if 'template_xml_id' not in self._context:
+                return self._sign_registers()
+            self.generate_register()
             self.signature = self._build_signature_tag_from_p12()
             if not self.signature:
                 raise UserError(_("Unverificable software: se requiere p12 en la compañía."))
             # Re-render con <ds:Signature/> embebida
             self.generate_register()
+        else:
+            self.generate_register()
     
         return True
 
+    @api.multi
+    @verifactu_metrics.timed('sign', size=lambda records, _res: sum(
+        verifactu_metrics.payload_size(rec.signature) for rec in records))
+    def _sign_registers(self):
+        '''
+        Construye y firma (XMLDSig Enveloped) el RegistroFactura de los registros con el motor de
+        firma del certificado de cada compañía, sin renderizar ni parsear el XML más de una vez.
+        '''
+        for company in self.mapped('invoice_id.company_id'):
+            records = self.filtered(lambda r: r.invoice_id.company_id == company)
+            if records.filtered(lambda r: not r.invoice_id.verifactu_active):
+                raise UserError(_("There isn't any information to send"))
+            if not company.sudo().verifactu_p12_file:
+                raise UserError(_("No se encontró el contenido del certificado .p12 en la compañía."))
+            try:
+                engine = company._verifactu_p12().register_signer
+            except Exception as e:
+                _logger.exception("Error cargando .p12 desde Binary")
+                raise UserError(_("No se pudo cargar el .p12: %s") % e)
+            nodes = [verifactu_xml.build_unsigned(rec) for rec in records]
+            try:
+                signed = engine.sign_many(nodes)
+            except Exception as e:
+                _logger.exception("Error firmando XML")
+                raise UserError(_("Fallo al firmar el XML: %s") % e)
+            for rec, (signed_root, signature) in zip(records, signed):
+                rec.registro_factura, rec.signature = verifactu_signer.serialize(signed_root, signature)
+        return True
+
 
     @api.multi
+    def _get_anterior(self):
+        ''' Último registro de la compañía con el que debe encadenarse este registro '''
+        self.ensure_one()
+        if self._context.get('verifactu_anterior_id'):
+            return self.browse(self._context['verifactu_anterior_id'])
+        # El encadenado debe sólo con registros aceptados o partcialmente aceptados.
+        # Los registros que se envían a la AEAT van a la cola y el distribuidor los vuelve a
+        # encadenar (_chain_batch) bajo su advisory lock por compañía: leer la cabeza sin
+        # bloquearla evita que informar una factura espere a un envío en curso (y al revés).
+        # Los eventos y los registros no verificables no pasan por la cola: su cabeza queda
+        # bloqueada hasta el final de la transacción (salvo en registros virtuales).
+        is_new = isinstance(self.id, models.NewId)
+        company = self.company_id or self.invoice_id.company_id
+        queued = self.type != 'event' and company.verifactu_sif == 'verificable'
+        head = self.env['account.invoice.verifactu.chain']._get_head(
+            company.id, 'event' if self.type == 'event' else 'invoice', lock=not is_new and not queued)
+        if head.head_id and head.head_id.id != self.id:
+            return head.head_id
+        domain = [('id', '!=', self.id)] if not is_new else []
+        domain += [('company_id', '=', company.id),]
+        domain += [('type','=','event')] if self.type == 'event' else [('type','!=','event')]
+        return self.search(domain + [('state', 'in', ['accepted', 'partially_accepted']),], order="send_date desc, generation_date desc, id desc", limit=1)
+
+    @api.multi
+    @verifactu_metrics.timed('generate_register',
+                             size=lambda records, _res: verifactu_metrics.payload_size(records.registro_factura))
     def generate_register(self):
-        """Renderiza el template QWeb y guarda el resultado en RegistroFactura."""
+        """
+        Genera el XML del registro y lo guarda en RegistroFactura.
+        Altas y anulaciones se construyen directamente con lxml (verifactu_xml); la plantilla QWeb
+        sólo se usa para eventos o si se indica expresamente con la clave de contexto template_xml_id.
+        """
         self.ensure_one()
         if not self.invoice_id or not self.invoice_id.verifactu_active:
             raise UserError(_("There isn't any information to send"))
-        
+
+        if 'template_xml_id' not in self._context:
+            registro_factura = verifactu_xml.render_register(self)
+            if registro_factura is not None:
+                self.registro_factura = registro_factura
+                return True
+
         default_template = {
                 'alta': 'account_verifactu.RegistroAlta',
                 'anulation': 'account_verifactu.RegistroAnulacion',
@@ -514,7 +789,6 @@ class AccountInvoiceVerifactu(models.Model):
         if not template_xml_id:
             return False
 
-        self.ensure_one()
         qweb = self.env['ir.qweb']
         values = {
                 'o': self,   # para ${object...}
@@ -529,23 +803,321 @@ class AccountInvoiceVerifactu(models.Model):
         return True
     
     @api.multi
-    def generate_soap_envelope(self):
-        """Renderiza el template QWeb y devueve el resultado."""
-        self.ensure_one()
-        if not self.registro_factura:
+    @verifactu_metrics.timed('soap_envelope', size=lambda records, request: verifactu_metrics.payload_size(request))
+    def _render_soap_envelope(self):
+        """
+        Genera el sobre SOAP para uno o varios registros de una misma compañía. La plantilla QWeb
+        account_verifactu.soap_request sólo se usa si se indica con la clave de contexto soap_template_xml_id.
+        La AEAT admite hasta MAX_REGISTERS_PER_ENVELOPE RegistroFactura bajo una misma Cabecera.
+        """
+        if not self:
+            raise UserError(_("No existe el XML de RegistroFactura."))
+        if self.filtered(lambda r: not r.registro_factura):
             raise UserError(_("No existe el XML de RegistroFactura."))
+        if len(self.mapped('company_id')) != 1:
+            raise UserError(_("All registers of a SOAP envelope must belong to the same company."))
+        if len(self) > MAX_REGISTERS_PER_ENVELOPE:
+            raise UserError(_("A SOAP envelope can't include more than %s registers.") % MAX_REGISTERS_PER_ENVELOPE)
+        template_xml_id = self._context.get('soap_template_xml_id')
         try:
+            if not template_xml_id:
+                return verifactu_xml.render_envelope(self[0].invoice_id.company_id, self.mapped('registro_factura'))
             qweb = self.env['ir.qweb']
-            template_xml_id = 'account_verifactu.soap_request'
             values = {
-                    'o': self,   # para ${object...}
+                    'docs': self,
+                    'o': self[0],   # para ${object...}
+                    'company': self[0].invoice_id.company_id,
                     'env': self.env, # útil si lo usas en expresiones
                 }
             request = qweb.render(template_xml_id, values)
             # En Odoo 11, _render puede devolver bytes. Normalizamos a unicode.
-            self.request = self.pretty_xml(request,xml_declaration=True)
+            return self.pretty_xml(request,xml_declaration=True)
         except:
             raise UserError(_("Could'nt be posible to prepare sopa envelope"))
+
+    @api.multi
+    def generate_soap_envelope(self):
+        """Genera el sobre SOAP y guarda el resultado en request."""
+        self.ensure_one()
+        self.request = self._render_soap_envelope()
+        return True
+
+    @api.model
+    def _batch_threshold(self):
+        ''' Registros acumulados en cola a partir de los cuales se envían sin esperar a TiempoEsperaEnvio '''
+        threshold = self.env['res.company']._get_verifactu_config(False).batch_threshold or MAX_REGISTERS_PER_ENVELOPE
+        return max(1, min(threshold, MAX_REGISTERS_PER_ENVELOPE))
+
+    @api.model
+    def _flow_window_open(self, company):
+        ''' Indica si ha transcurrido el TiempoEsperaEnvio del último envío del obligado (NIF) '''
+        return self.env['account.invoice.verifactu.flow']._window_open(company._verifactu_config().nif)
+
+    @api.model
+    def _verifactu_async(self):
+        ''' Indica si los registros se envían a la AEAT desde la cola (cron) o en línea '''
+        return self.env['res.company']._get_verifactu_config(False).send_async
+
+    @api.multi
+    def _submit(self):
+        '''
+        Deja los registros en la cola de envío. Nunca se envían dentro de la transacción que los
+        crea: si después se deshiciera, la AEAT tendría registros que aquí no existen.
+        En modo asíncrono los envía el cron del distribuidor (_cron_dispatch_queue); si no, el
+        distribuidor se ejecuta en cuanto se confirma la transacción (_dispatch_after_commit).
+        '''
+        self.write({'queue_state': 'queued', 'lease_owner': False, 'lease_until': False})
+        if self and not self._verifactu_async():
+            self._dispatch_after_commit(self.mapped('company_id').ids)
+        return True
+
+    @api.model
+    def _dispatch_after_commit(self, company_ids):
+        '''
+        Ejecuta el distribuidor de la cola de las compañías indicadas, con un cursor propio, tras
+        confirmar la transacción actual. Se registra una sola vez por transacción.
+        '''
+        cr = self.env.cr
+        pending = getattr(cr, '_verifactu_dispatch_company_ids', None)
+        if pending is not None:
+            pending.update(company_ids)
+            return True
+        pending = cr._verifactu_dispatch_company_ids = set(company_ids)
+        dbname = cr.dbname
+        # Sin las claves de contexto del proceso que informa (p.ej. verifactu_defer_invoice_sync)
+        context = dict((key, self._context[key]) for key in ('lang', 'tz') if key in self._context)
+
+        def forget():
+            cr._verifactu_dispatch_company_ids = None
+
+        def dispatch():
+            forget()
+            try:
+                with api.Environment.manage(), registry(dbname).cursor() as dispatch_cr:
+                    env = api.Environment(dispatch_cr, SUPERUSER_ID, context)
+                    env['account.invoice.verifactu']._cron_dispatch_queue(company_ids=list(pending))
+            except Exception:
+                # La transacción ya está confirmada: los registros siguen en la cola para el cron
+                _logger.exception('Error enviando a AEAT la cola de las compañías %s', sorted(pending))
+
+        cr.after('commit', dispatch)
+        cr.after('rollback', forget)
+        return True
+
+    @api.model
+    def _cron_verify_chain_integrity(self, company_ids=None, workers=None):
+        '''
+        Proceso de detección de anomalías en los registros de facturación (eventos 03/04).
+        Cada compañía se verifica en paralelo con su propio cursor (verifactu_integrity) y el
+        resultado queda en un registro de evento 03 y, si hay anomalías, en otro 04.
+        '''
+        if company_ids is None:
+            self.env.cr.execute("""
+                SELECT DISTINCT company_id FROM account_invoice_verifactu
+                WHERE company_id IS NOT NULL AND type != 'event'
+            """)
+            company_ids = [row[0] for row in self.env.cr.fetchall()]
+        companies = self.env['res.company'].sudo().browse(company_ids)
+        if not companies:
+            return self.browse()
+        vats = dict((company.id, verifactu_hash.clean_vat(company.country_id.code, company.vat)) for company in companies)
+        if not workers:
+            workers = self.env['res.company']._get_verifactu_config(False).integrity_workers
+        dbname = self.env.cr.dbname
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(vats)))) as pool:
+            results = list(pool.map(
+                lambda company_id: verifactu_integrity.verify_company_chain(dbname, company_id, vats[company_id]), vats))
+        events = self.browse()
+        for result in results:
+            events |= self._create_integrity_events(result)
+        return events
+
+    @api.model
+    def _create_integrity_events(self, result):
+        anomalies = sum(result['anomalies'].values())
+        values = {
+            'type': 'event',
+            'company_id': result['company_id'],
+            'even_type': '03',
+            'event_processed': result['processed'],
+            'event_anomalies': anomalies,
+            'event_details': json.dumps({
+                'checks': list(verifactu_integrity.CHECKS),
+                'anomalies': result['anomalies'],
+                'anomaly_ids': result['anomaly_ids'],
+            }, sort_keys=True),
+        }
+        events = self.create(values)
+        if anomalies:
+            _logger.warning("Veri*Factu: %s anomalies detected in company %s registers", anomalies, result['company_id'])
+            events |= self.create(dict(values, even_type='04'))
+        return events
+
+    @api.model
+    def _export_period(self, company_id, date_from, date_to, export_format='ndjson', path=None):
+        '''
+        Exporta a un zip los registros de facturación de las facturas de la compañía expedidas en el periodo y
+        deja constancia con un registro de evento 08. Puede llamarse desde el shell de Odoo:
+
+            env['account.invoice.verifactu']._export_period(1, '2025-01-01', '2025-12-31', path='/tmp/verifactu.zip')
+
+        Devuelve el registro de evento y la ruta del zip. Sin ``path`` el zip es un temporal del
+        que se hace cargo quien llama (p.ej. el asistente lo mueve al filestore y lo adjunta al
+        evento), por lo que su ruta no queda en el evento.
+        '''
+        if export_format not in dict(verifactu_export.EXPORT_FORMATS):
+            raise UserError(_("Unknown export format %s") % export_format)
+        company = self.env['res.company'].browse(company_id)
+        details = {}
+        if path:
+            details['path'] = path
+        else:
+            handle, path = tempfile.mkstemp(prefix='verifactu_%s_' % company.id, suffix='.zip')
+            os.close(handle)
+        summary = verifactu_export.export_period(self.env.cr, company.id, date_from, date_to, export_format, path)
+        event = self.create({
+            'type': 'event',
+            'company_id': company.id,
+            'even_type': '08',
+            'event_processed': summary['count'],
+            'event_details': json.dumps(dict(summary, **details), sort_keys=True),
+        })
+        return event, path
+
+    @api.model
+    def _cron_dispatch_queue(self, limit=None, company_ids=None):
+        '''
+        Distribuidor de la cola de envíos a la AEAT.
+        Los registros de una misma compañía se envían en orden y por un único distribuidor
+        (advisory lock de sesión, se libera solo si el proceso muere). Cada registro reclamado
+        queda reservado durante _LEASE_SECONDS; si el distribuidor cae, al expirar la reserva
+        otro distribuidor lo vuelve a reclamar.
+        Se respeta el TiempoEsperaEnvio de la AEAT: mientras no transcurre, los registros se
+        acumulan en la cola salvo que haya suficientes (_batch_threshold) para un envío completo.
+        :param company_ids: sólo las colas de estas compañías (por defecto todas)
+        '''
+        owner = '%s-%s' % (socket.gethostname(), uuid.uuid4().hex[:12])
+        threshold = self._batch_threshold()
+        limit = limit or threshold
+        cr = self.env.cr
+        cr.execute("""
+            SELECT DISTINCT v.company_id
+            FROM account_invoice_verifactu v
+            WHERE v.queue_state IN ('queued', 'sending')
+              AND (v.lease_until IS NULL OR v.lease_until < %s)
+        """, [fields.Datetime.now()])
+        pending_ids = [row[0] for row in cr.fetchall() if company_ids is None or row[0] in company_ids]
+        for company in self.env['res.company'].browse(pending_ids):
+            cr.execute("SELECT pg_try_advisory_lock(%s, %s)", [_DISPATCH_LOCK_KEY, company.id])
+            if not cr.fetchone()[0]:
+                continue
+            try:
+                while True:
+                    # Los reenvíos pendientes bloquean la cola para no romper el encadenamiento
+                    if self._retry_pending(company.id):
+                        break
+                    if not self._flow_window_open(company) and self._count_queued(company.id, threshold) < threshold:
+                        break
+                    ids = self._claim_queued(company.id, owner, limit)
+                    if not ids:
+                        break
+                    self.browse(ids)._dispatch_claimed(owner)
+            finally:
+                cr.execute("SELECT pg_advisory_unlock(%s, %s)", [_DISPATCH_LOCK_KEY, company.id])
+                cr.commit()
+        return True
+
+    @api.model
+    def _count_queued(self, company_id, limit):
+        ''' Registros de la compañía pendientes de envío (sin contar más allá de limit) '''
+        self.env.cr.execute("""
+            SELECT count(*) FROM (
+                SELECT 1 FROM account_invoice_verifactu v
+                WHERE v.company_id = %s
+                  AND v.queue_state IN ('queued', 'sending')
+                  AND (v.lease_until IS NULL OR v.lease_until < %s)
+                LIMIT %s
+            ) pending
+        """, [company_id, fields.Datetime.now(), limit])
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _claim_queued(self, company_id, owner, limit):
+        ''' Reserva registros en cola (o con la reserva expirada) de una compañía y confirma la reserva '''
+        now = datetime.utcnow()
+        self.env.cr.execute("""
+            UPDATE account_invoice_verifactu
+            SET queue_state = 'sending', lease_owner = %s, lease_until = %s
+            WHERE id IN (
+                SELECT v.id
+                FROM account_invoice_verifactu v
+                WHERE v.company_id = %s
+                  AND v.queue_state IN ('queued', 'sending')
+                  AND (v.lease_until IS NULL OR v.lease_until < %s)
+                ORDER BY v.id
+                LIMIT %s
+                FOR UPDATE OF v SKIP LOCKED
+            )
+            RETURNING id
+        """, [owner, fields.Datetime.to_string(now + timedelta(seconds=_LEASE_SECONDS)),
+              company_id, fields.Datetime.to_string(now), limit])
+        ids = sorted(row[0] for row in self.env.cr.fetchall())
+        self.env.cr.commit()
+        self.invalidate_cache(ids=ids)
+        return ids
+
+    @api.multi
+    def _chain_batch(self, anterior=None, rebuild=False):
+        """
+        Encadena los registros en el orden en que se enviarán: el primero con el último registro
+        aceptado y cada uno de los siguientes con el anterior del lote.
+        :param anterior: registro con el que se encadena el primero (por defecto _get_anterior)
+        :param rebuild: reconstruye todos los registros aunque su anterior no cambie (su huella sí)
+        """
+        previous = to_sign = self.browse()
+        for rec in self:
+            expected = previous or anterior or rec._get_anterior()
+            if rebuild or rec.anterior != expected:
+                rec.with_context(verifactu_anterior_id=expected.id, verifactu_defer_sign=True).update_register_data()
+                to_sign |= rec
+            previous = rec
+        to_sign.filtered(lambda r: r.invoice_id.company_id.verifactu_sif == 'no_verificable')._sign_registers()
+        return True
+
+    @api.multi
+    def _dispatch_claimed(self, owner):
+        ''' Envía en bloque los registros reclamados, aplica la respuesta y confirma el resultado '''
+        # Cada sobre se confirma en cuanto se aplica su respuesta (_send_isolated)
+        records = self.with_context(verifactu_commit_envelopes=True).filtered(lambda r: r.lease_owner == owner).sorted('id')
+        if not records:
+            return False
+        # Registros con un envío fallido por error transitorio: se reenvía el mismo sobre
+        retries = records.filtered(lambda r: r.send_attempts and r.state == 'draft' and (r.batch_id.request or r.request))
+        fresh = records - retries
+        if retries:
+            retries._resend_stored()
+        if retries.filtered(lambda r: r.queue_state == 'queued'):
+            # Siguen sin poder enviarse: los nuevos esperan detrás de ellos
+            fresh.write({'queue_state': 'queued', 'lease_owner': False, 'lease_until': False})
+        elif fresh:
+            # Algún registro anterior ha podido ser rechazado mientras estos esperaban en la cola
+            if fresh._send_isolated(fresh._chain_batch):
+                fresh.send_aeat_batch()
+        # Un fallo generando el QR no cambia el resultado del envío
+        try:
+            with self.env.cr.savepoint():
+                records.filtered(lambda r: r.state in ['accepted','partially_accepted']).generate_qr()
+        except Exception:
+            _logger.exception('Error generando el QR de los registros Veri*Factu %s', records.ids)
+        # Los registros devueltos a la cola (reenvío pendiente) no se dan por procesados
+        records.filtered(lambda r: r.queue_state == 'sending').write({'queue_state': 'done', 'lease_owner': False, 'lease_until': False})
+        for invoice in records.mapped('invoice_id'):
+            try:
+                with self.env.cr.savepoint():
+                    invoice._verifactu_post_inform()
+            except Exception:
+                _logger.exception('Error validando la factura %s tras su envío a AEAT', invoice.move_name)
+        self.env.cr.commit()
         return True
 
     def send_soap_request(self):
@@ -557,41 +1129,234 @@ class AccountInvoiceVerifactu(models.Model):
     
     def send_aeat(self):
         self.ensure_one()
+        return self._send_envelope(self.request)
+
+    @api.multi
+    def send_aeat_batch(self):
+        """
+        Envía los registros agrupados por compañía en sobres de hasta MAX_REGISTERS_PER_ENVELOPE
+        registros, una única petición mTLS por sobre. Cada sobre se envía aislado (_send_isolated):
+        el fallo de uno no deshace la respuesta de la AEAT a los anteriores.
+        """
+        accepted = ['accepted', 'partially_accepted']
+        for company in self.mapped('company_id'):
+            records = self.filtered(lambda r: r.company_id == company).sorted('id')
+            rechain = False
+            for start in range(0, len(records), MAX_REGISTERS_PER_ENVELOPE):
+                chunk = records[start:start + MAX_REGISTERS_PER_ENVELOPE]
+
+                def send(chunk=chunk, rechain=rechain):
+                    if rechain:
+                        # El sobre anterior no terminó en el registro (y la huella) con el que se encadenó este
+                        chunk._chain_batch(rebuild=True)
+                    if len(chunk) == 1:
+                        return chunk.send_soap_request()
+                    batch = self.env['account.invoice.verifactu.batch'].create({
+                        'company_id': company.id,
+                        'request': chunk._render_soap_envelope(),
+                    })
+                    chunk.write({'batch_id': batch.id})
+                    return chunk._send_envelope(batch.request, holder=batch)
+
+                if not chunk._send_isolated(send) or chunk.filtered('retry_after'):
+                    # Fallo: el resto está encadenado con este sobre y espera en la cola para no adelantarse
+                    records[start + MAX_REGISTERS_PER_ENVELOPE:].filtered('queue_state').write(
+                        {'queue_state': 'queued', 'lease_owner': False, 'lease_until': False})
+                    break
+                rechain = bool(chunk._rechain_after_rejection()) or chunk[-1].state not in accepted
+        return True
+
+    @api.multi
+    def _send_isolated(self, send):
+        """
+        Ejecuta el envío de un sobre de estos registros, o su preparación (``send()``), en un
+        savepoint propio. Si falla, sólo se rechazan los registros que no tienen respuesta de la
+        AEAT (los ya aceptados no se tocan). Con el contexto
+        verifactu_commit_envelopes (distribuidor) la respuesta de cada sobre se confirma antes
+        de enviar el siguiente. Devuelve False si el envío ha fallado.
+        """
+        try:
+            with self.env.cr.savepoint():
+                send()
+            result = True
+        except Exception as e:
+            _logger.exception('Error enviando a AEAT los registros Veri*Factu %s', self.ids)
+            self.invalidate_cache()
+            self.filtered(lambda r: r.state == 'draft' and not r.estado_registro).write(
+                {'state': 'rejected', 'last_error': str(e)[:255]})
+            result = False
+        if self._context.get('verifactu_commit_envelopes'):
+            self.env.cr.commit()
+        return result
+
+    @api.multi
+    def _rechain_after_rejection(self):
+        """
+        Los registros de un sobre se encadenan con el anterior del sobre antes de conocer la
+        respuesta. Si la AEAT rechaza uno, los aceptados que le siguen quedan encadenados con un
+        registro rechazado: se encadenan de nuevo con el último aceptado anterior al rechazo y se
+        reenvían (como subsanación). El reenvío vuelve a pasar por aquí si hay otro rechazo.
+        """
+        accepted = ['accepted', 'partially_accepted']
+        rejected = self.filtered(lambda r: r.state == 'rejected')[:1]
+        if not rejected:
+            return False
+        position = self.ids.index(rejected.id)
+        broken = self[position + 1:].filtered(lambda r: r.state in accepted)
+        if not broken:
+            return False
+        anterior = self[:position].filtered(lambda r: r.state in accepted)[-1:] or rejected.anterior
+        _logger.info('Registros Veri*Factu %s encadenados con el registro rechazado %s: se reenvían',
+                     broken.ids, rejected.id)
+
+        def rechain():
+            # La cabeza de la cadena vuelve al último aceptado: el reenvío la avanza de nuevo
+            chain = self.env['account.invoice.verifactu.chain']
+            chain._get_head(rejected.company_id.id, chain._chain_of(rejected))._set_head(anterior)
+            broken._chain_batch(anterior=anterior, rebuild=True)
+            broken.write({'batch_id': False})
+
+        if broken._send_isolated(rechain):
+            broken.send_aeat_batch()
+        return True
+
+    @api.multi
+    def _aeat_post(self, payload):
+        """ Envía el sobre SOAP al endpoint AEAT de la compañía de los registros """
+        rec = self[0]
+        config = (rec.invoice_id.company_id or rec.company_id)._verifactu_config()
         # Preparar headers, endpoint
         headers = {
             'Content-Type': 'text/xml; charset=utf-8',
         }
-        soap_action = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.soap_action') or ''
-        if soap_action:
-            headers['SOAPAction'] = soap_action
-        verifactu_endpoint = self.verifactu_endpoint()
-
-        # Verificación SSL configurable (por defecto True)
-        ssl_verify_param = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.ssl_verify', 'True')
-        verify_ssl = (str(ssl_verify_param).lower() != 'false')
+        if config.soap_action:
+            headers['SOAPAction'] = config.soap_action
+        verifactu_endpoint = config.endpoint
 
         if not verifactu_endpoint:
-            self.state = 'rejected'
             raise UserError(_("No hay endpoint configurado para Veri*factu."))
-        
+
+        # La administración exige una conexión segurra de punto a punto
+        session = rec.invoice_id.company_id._verifactu_session()
+        return session.post(
+            verifactu_endpoint,
+            data=(payload or '').encode('utf-8'),
+            headers=headers,
+            timeout=(15, 90),
+            verify=config.ssl_verify,      # cadena de confianza (True o ruta a CA)
+        )
+
+    @api.model
+    def _retry_delay(self, attempt, base=_RETRY_BACKOFF, cap=_RETRY_BACKOFF_MAX):
+        ''' Espera exponencial con jitter para el intento attempt (desde 0) '''
+        delay = min(cap, base * (2 ** attempt))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    @api.multi
+    def _aeat_transmit(self, payload):
+        '''
+        Envía el sobre a la AEAT distinguiendo los fallos transitorios (timeout, conexión,
+        HTTP 408/429/5xx) de cualquier otra respuesta. Los transitorios se reintentan unas pocas
+        veces con el mismo contenido y, si persisten, se lanza AeatTransientError.
+        El circuit breaker del endpoint evita enviar mientras la AEAT no responde.
+        '''
+        endpoint = self[0].verifactu_endpoint()
+        breaker = self.env['account.invoice.verifactu.breaker']
+        error = None
+        for attempt in range(_INLINE_RETRIES + 1):
+            if attempt:
+                time.sleep(self._retry_delay(attempt - 1, base=_INLINE_BACKOFF, cap=_INLINE_BACKOFF * 4))
+            if endpoint and not breaker._allow(endpoint):
+                raise aeat_session.AeatTransientError(_("AEAT endpoint %s unavailable (circuit open)") % endpoint)
+            try:
+                resp = self._aeat_post(payload)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            else:
+                if resp.status_code not in aeat_session.TRANSIENT_HTTP_STATUS or \
+                        aeat_response.fault(resp.content) is not None:
+                    # La AEAT ha respondido (también con un SOAP Fault): no se reintenta
+                    breaker._record_success(endpoint)
+                    return resp
+                error = 'HTTP %s %s' % (resp.status_code, resp.reason or '')
+            _logger.warning('Fallo transitorio enviando a AEAT (intento %s): %s', attempt + 1, error)
+            if breaker._record_failure(endpoint, error) == 'open':
+                break
+        raise aeat_session.AeatTransientError(error)
+
+    @api.multi
+    def _schedule_retry(self, error):
+        '''
+        Tras un fallo transitorio el registro no se rechaza: vuelve a la cola para reenviar más
+        tarde exactamente el mismo sobre. Al agotar _MAX_SEND_ATTEMPTS se da por rechazado.
+        '''
+        now = datetime.utcnow()
+        by_attempts = OrderedDict()
+        for rec in self:
+            by_attempts.setdefault(rec.send_attempts + 1, []).append(rec.id)
+        for attempts, ids in by_attempts.items():
+            records = self.browse(ids)
+            values = {'send_attempts': attempts, 'last_error': (error or '')[:255]}
+            if attempts >= _MAX_SEND_ATTEMPTS:
+                values.update(state='rejected', retry_after=False)
+                records.write(values)
+                records.filtered('queue_state').write({'queue_state': 'done', 'lease_owner': False, 'lease_until': False})
+            else:
+                values.update(
+                    queue_state='queued', lease_owner=False, lease_until=False,
+                    retry_after=fields.Datetime.to_string(now + timedelta(seconds=self._retry_delay(attempts - 1))),
+                )
+                records.write(values)
+        return False
+
+    @api.multi
+    def _resend_stored(self):
+        ''' Reenvía sin cambios el sobre ya enviado de cada registro (o de su lote) '''
+        for batch in self.mapped('batch_id'):
+            records = self.filtered(lambda r: r.batch_id == batch)
+            records._send_isolated(lambda: records._send_envelope(batch.request, holder=batch))
+        for rec in self.filtered(lambda r: not r.batch_id):
+            rec._send_isolated(lambda: rec._send_envelope(rec.request))
+        return True
+
+    @api.model
+    def _retry_pending(self, company_id):
+        ''' Indica si la compañía tiene registros esperando a ser reenviados '''
+        self.env.cr.execute("""
+            SELECT 1 FROM account_invoice_verifactu
+            WHERE company_id = %s AND queue_state = 'queued' AND retry_after > %s
+            LIMIT 1
+        """, [company_id, fields.Datetime.now()])
+        return bool(self.env.cr.fetchone())
+
+    @api.multi
+    def _send_envelope(self, payload, holder=None):
+        """
+        Envía el sobre y aplica la respuesta a cada registro.
+        :param payload: sobre SOAP ya generado
+        :param holder: registro donde se guarda la respuesta (el propio registro o el lote)
+        """
+        holder = holder if holder is not None else self
+        with verifactu_metrics.measure(self, 'send_aeat', holder) as probe:
+            if probe:
+                probe.size = verifactu_metrics.payload_size(payload)
+            return self._send_envelope_measured(payload, holder)
+
+    @api.multi
+    def _send_envelope_measured(self, payload, holder):
+        ''' _send_envelope: petición, formato y lectura de la respuesta se miden por separado '''
         try:
-            # La administración exige una conexión segurra de punto a punto
-            p12_data = base64.b64decode(self.invoice_id.company_id.verifactu_p12_file or b'')
-            p12_password = (self.invoice_id.company_id.verifactu_p12_password or '').strip()
-            resp = pkcs12_post(
-                verifactu_endpoint,
-                data=(self.request or '').encode('utf-8'),
-                headers=headers,
-                pkcs12_data=p12_data,
-                pkcs12_password=p12_password,
-                timeout=(15, 90),
-                verify=verify_ssl,      # cadena de confianza (True o ruta a CA)
-            )
-            self.response = self.pretty_xml(resp.text, encoding='UTF-8', xml_declaration=True) or ''
-            _logger.infor('AEAT request: %s' % self.request)
-            _logger.info('AEAT response: %s' % self.response)
+            # Incluye la negociación TLS cuando la sesión abre una conexión nueva
+            with verifactu_metrics.measure(self, 'aeat_transport', holder) as probe:
+                resp = self._aeat_transmit(payload)
+                if probe:
+                    probe.size = len(resp.content or b'')
+            with verifactu_metrics.measure(self, 'pretty_xml', holder):
+                holder.response = self.pretty_xml(resp.text, encoding='UTF-8', xml_declaration=True) or ''
+            _logger.info('AEAT request: %s' % payload)
+            _logger.info('AEAT response: %s' % holder.response)
             # En caso de respuesta de tipo html no aseguramos de mantener la codificación
-            if self.response_mode == 'html':
+            if holder.response_mode == 'html':
                 raw = resp.content  # bytes
                 enc = 'utf-8'
                 # intenta detectar por cabecera o meta
@@ -606,12 +1371,19 @@ class AccountInvoiceVerifactu(models.Model):
                 html_text = raw.decode(enc, errors='replace')
                 if '<base ' not in html_text.lower():
                     html_text = html_text.replace('<head>', '<head><base href="https://sede.agenciatributaria.gob.es/">', 1)
-                self.response = html_text
-            resp.raise_for_status()
+                holder.response = html_text
+            # Un SOAP Fault (HTTP 500) se aplica como rechazo con la respuesta de la AEAT
+            if resp.status_code < 400 or aeat_response.fault(resp.content) is None:
+                resp.raise_for_status()
+        except aeat_session.AeatTransientError as e:
+            if self._context.get('verifactu_raise_transient'):
+                # Quien envía (p.ej. la remisión por requerimiento) gestiona el reintento
+                raise
+            return self._schedule_retry(str(e))
         except Exception as e:
             _logger.exception('Error de conexión enviando a AEAT')
             # Estado rechazado por fallo de transporte
-            self.state = 'rejected'
+            self.write({'state': 'rejected'})
             # Intentamos dejar trazas útiles al usuario
             raise UserError(_("Error de conexión con AEAT: %s") % e)
 
@@ -622,73 +1394,83 @@ class AccountInvoiceVerifactu(models.Model):
             else:
                 data = resp.content.encode('utf-8')
 
-            root = etree.fromstring(data)
-
-            def first_text(xpaths):
-                for xp in xpaths:
-                    el = root.find(xp)
-                    if el is not None and (el.text or '').strip():
-                        return el.text.strip()
-                return ''
-
-            # Posibles ubicaciones/campos según documentación/respuestas AEAT
-            estado = first_text([
-                './/{*}EstadoEnvio',
-                './/{*}Estado',
-                './/{*}Resultado',
-                './/{*}CodigoResultado',
-                './/{*}CodigoRespuesta',
-                './/{*}resultCode',
-            ])
-
-            # Buscar errores
-            errores_nodes = (
-                root.findall('.//{*}Errores/{*}Error') or
-                root.findall('.//{*}ListaErrores/{*}Error') or
-                root.findall('.//{*}Errores')
-            )
-            hay_errores = False
-            if errores_nodes:
-                for e in errores_nodes:
-                    cod = (e.findtext('.//{*}Codigo') or e.findtext('.//{*}codigoError') or e.findtext('.//{*}CodigoError') or '').strip()
-                    if cod:
-                        hay_errores = True
-                        break
-
-            estado_l = (estado or '').lower()
-            # Decisión del estado
-            if (
-                'parcial' in estado_l or
-                'con error' in estado_l or
-                'conerro' in estado_l or
-                (hay_errores and ('acept' in estado_l or estado_l in ('00', '0', 'ok')))
-            ):
-                self.state = 'partially_accepted'
-            elif (
-                (estado_l in ('correcto', 'ok', '00', '0')) or ('acept' in estado_l and not hay_errores)
-            ):
-                self.state = 'accepted'
-            else:
-                self.state = 'rejected'
-
+            with verifactu_metrics.measure(self, 'aeat_response', holder) as probe:
+                response = aeat_response.parse(data)
+                self._apply_aeat_response(response)
+                if probe:
+                    probe.size = len(data)
+            self.env['account.invoice.verifactu.flow']._set_wait(
+                self[0].company_id._verifactu_config().nif, response.tiempo_espera_envio)
         except Exception as e:
             _logger.exception('No se pudo parsear la respuesta SOAP de AEAT')
-            self.state = 'rejected'
+            self.write({'state': 'rejected'})
             return {'type': 'ir.actions.client', 'tag': 'reload'}
 
-        return self.write({'send_date': fields.Datetime.now()})
+        return self.write({'send_date': fields.Datetime.now(), 'retry_after': False, 'last_error': False})
+
+    @api.multi
+    def _apply_aeat_response(self, response):
+        """
+        Fija el estado de cada registro a partir de su RespuestaLinea (IDFactura + TipoOperacion),
+        guardando EstadoRegistro, CodigoErrorRegistro, DescripcionErrorRegistro y el CSV del envío.
+        Los registros sin línea propia toman el estado global del envío.
+        Los registros con el mismo resultado se actualizan con una única escritura.
+        :param response: aeat_response.AeatResponse
+        """
+        lines = dict(((line.num_serie, line.fecha_expedicion, line.type), line) for line in response.lines)
+        global_values = None
+        groups = OrderedDict()
+        for rec in self:
+            line = lines.get(((rec.invoice_id.move_name or '').strip(), (rec.date_invoice or '').strip(), rec.type))
+            if line and line.estado_registro in _ESTADO_REGISTRO:
+                values = (
+                    ('state', _ESTADO_REGISTRO[line.estado_registro]),
+                    ('estado_registro', line.estado_registro),
+                    ('codigo_error_registro', line.codigo_error_registro or False),
+                    ('descripcion_error_registro', line.descripcion_error_registro or False),
+                )
+            else:
+                if global_values is None:
+                    global_values = (
+                        ('state', self._response_global_state(response)),
+                        ('estado_registro', False),
+                        ('codigo_error_registro', False),
+                        ('descripcion_error_registro', response.fault or False),
+                    )
+                values = global_values
+            groups.setdefault(values, []).append(rec.id)
+        for values, ids in groups.items():
+            self.browse(ids).write(dict(values, csv=response.csv or False))
+        return True
+
+    @api.model
+    def _response_global_state(self, response):
+        """ Estado de un envío a partir de la respuesta global de la AEAT (EstadoEnvio) """
+        if response.fault:
+            return 'rejected'
+        return _ESTADO_ENVIO.get(response.estado_envio, 'rejected')
         
     
     def action_send_bulk(self):
         """Enviar registros en bloque (histórico)"""
-        # Aquí tu lógica; por ahora, solo mensaje
+        records = self.filtered(lambda r: r.type != 'event' and r.state == 'draft' and r.registro_factura and
+                                          r.queue_state not in ['queued','sending'] and
+                                          r.invoice_id.company_id.verifactu_sif == 'verificable')
+        errors = []
+        for company in records.mapped('company_id'):
+            try:
+                records.filtered(lambda r: r.company_id == company).send_aeat_batch()
+            except UserError as e:
+                errors.append('%s: %s' % (company.name, e.name))
+        accepted = records.filtered(lambda r: r.state in ['accepted','partially_accepted'])
+        accepted.generate_qr()
         return {
             'type': 'ir.actions.client',
             'tag': 'display_notification',
             'params': {
-                'title': "Acción no disponible",
-                'message': "Se pidieron %s registros." % len(self),
-                'sticky': False,  # True = notificación persistente hasta que el usuario la cierre
-                'type': 'success',  # success / warning / danger
+                'title': "Envío en bloque",
+                'message': "Enviados %s de %s registros, %s aceptados. %s" % (len(records), len(self), len(accepted), ' '.join(errors)),
+                'sticky': bool(errors),  # True = notificación persistente hasta que el usuario la cierre
+                'type': 'danger' if errors else 'success',  # success / warning / danger
             }
         }
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+class AccountInvoiceVerifactuBatch(models.Model):
+    _name = "account.invoice.verifactu.batch"
+    _inherit = ['account.invoice.verifactu.payload.mixin']
+    _order = "id desc"
+    
+    _payload_fields = {
+        'request': 'text',
+        'response': 'text',
+    }
+
+    company_id = fields.Many2one('res.company', required=True, index=True)
+    
+    verifactu_ids = fields.One2many('account.invoice.verifactu', 'batch_id', string="Registros")
+    
+    requirement_id = fields.Many2one('account.invoice.verifactu.requirement', index=True, readonly=True, ondelete='set null',
+        help="Requerimiento de la AEAT al que responde el envío")
+    
+    register_count = fields.Integer(compute='_compute_register_count', store=False)
+    
+    timing_ids = fields.One2many('account.invoice.verifactu.timing', 'batch_id', string="Tiempos por etapa", readonly=True)
+    
+    request = fields.Text(help="Soap Envelope sent to AEAT, including every RegistroFactura of the batch",
+                          compute='_compute_request', inverse='_inverse_request')
+    request_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
+    
+    response = fields.Text(help="AEAT soap service response", compute='_compute_response', inverse='_inverse_response')
+    response_payload_id = fields.Many2one('account.invoice.verifactu.payload', readonly=True, ondelete='restrict', index=True)
+    
+    response_mode = fields.Selection([
+        ('xml', 'XML'),
+        ('html', 'HTML'),
+        ('json', 'JSON'),
+        ('text', 'Texto'),
+    ], string='Modo de respuesta', compute='_compute_response_mode', store=False)
+    
+    @api.depends('verifactu_ids')
+    def _compute_register_count(self):
+        for rec in self:
+            rec.register_count = len(rec.verifactu_ids)
+    
+    @api.depends('request_payload_id')
+    def _compute_request(self):
+        self._get_payload('request')
+
+    def _inverse_request(self):
+        self._set_payload('request')
+
+    @api.depends('response_payload_id')
+    def _compute_response(self):
+        self._get_payload('response')
+
+    def _inverse_response(self):
+        self._set_payload('response')
+
+    @api.depends('response')
+    def _compute_response_mode(self):
+        verifactu = self.env['account.invoice.verifactu']
+        for rec in self:
+            rec.response_mode = verifactu._get_response_mode(rec.response)
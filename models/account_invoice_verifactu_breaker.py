@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+# Fallos transitorios consecutivos que abren el circuito
+FAILURE_THRESHOLD = 5
+# Segundos que el circuito permanece abierto antes de dejar pasar un envío de prueba
+OPEN_SECONDS = 60
+
+
+class AccountInvoiceVerifactuBreaker(models.Model):
+    '''
+    Circuit breaker de cada endpoint de la AEAT, compartido por todos los workers.
+    Tras FAILURE_THRESHOLD fallos transitorios consecutivos (timeouts, errores de conexión,
+    HTTP 5xx) el circuito se abre y no se envía nada durante OPEN_SECONDS; después un único
+    envío de prueba (half_open) decide si se cierra o vuelve a abrirse.
+    '''
+    _name = "account.invoice.verifactu.breaker"
+    _order = "endpoint"
+
+    endpoint = fields.Char(required=True, readonly=True)
+
+    state = fields.Selection([
+        ('closed', 'Cerrado'),
+        ('open', 'Abierto'),
+        ('half_open', 'Semiabierto'),
+        ], default='closed', required=True, readonly=True,
+        help="Cerrado: se envía con normalidad. Abierto: la AEAT no responde y no se envía. "
+             "Semiabierto: se está probando si la AEAT vuelve a responder.")
+
+    failure_count = fields.Integer(readonly=True, help="Fallos transitorios consecutivos")
+
+    opened_until = fields.Datetime(readonly=True)
+
+    last_error = fields.Char(readonly=True)
+
+    last_failure_date = fields.Datetime(readonly=True)
+
+    _sql_constraints = [
+        ('endpoint_uniq', 'unique(endpoint)', 'Only one circuit breaker per endpoint is allowed'),
+    ]
+
+    @api.model
+    def _allow(self, endpoint):
+        ''' Indica si puede enviarse al endpoint; con el circuito abierto y vencido, reserva el envío de prueba '''
+        self.env.cr.execute("""
+            SELECT state, failure_count FROM account_invoice_verifactu_breaker WHERE endpoint = %s
+        """, [endpoint])
+        row = self.env.cr.fetchone()
+        if not row or row[0] == 'closed':
+            return True
+        # El estado lo comparten todos los workers: se consulta y actualiza en una transacción propia
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE account_invoice_verifactu_breaker
+                SET state = 'half_open', opened_until = now() at time zone 'UTC' + %s * interval '1 second',
+                    write_date = now() at time zone 'UTC'
+                WHERE endpoint = %s AND state != 'closed' AND opened_until <= now() at time zone 'UTC'
+                RETURNING id
+            """, [OPEN_SECONDS, endpoint])
+            if cr.fetchone():
+                _logger.info("Veri*Factu: circuit half open for %s, sending probe", endpoint)
+                return True
+            cr.execute("SELECT state FROM account_invoice_verifactu_breaker WHERE endpoint = %s", [endpoint])
+            row = cr.fetchone()
+        return not row or row[0] == 'closed'
+
+    @api.model
+    def _record_success(self, endpoint):
+        self.env.cr.execute("""
+            SELECT 1 FROM account_invoice_verifactu_breaker
+            WHERE endpoint = %s AND (state != 'closed' OR failure_count != 0)
+        """, [endpoint])
+        if not self.env.cr.fetchone():
+            return False
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE account_invoice_verifactu_breaker
+                SET state = 'closed', failure_count = 0, opened_until = NULL, write_date = now() at time zone 'UTC'
+                WHERE endpoint = %s
+            """, [endpoint])
+        _logger.info("Veri*Factu: circuit closed for %s", endpoint)
+        return True
+
+    @api.model
+    def _record_failure(self, endpoint, error):
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                INSERT INTO account_invoice_verifactu_breaker AS b
+                    (endpoint, state, failure_count, last_error, last_failure_date, create_uid, create_date, write_uid, write_date)
+                VALUES (%s, 'closed', 1, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (endpoint) DO UPDATE
+                SET failure_count = b.failure_count + 1,
+                    last_error = EXCLUDED.last_error,
+                    last_failure_date = EXCLUDED.last_failure_date,
+                    write_date = EXCLUDED.write_date,
+                    state = CASE WHEN b.state = 'half_open' OR b.failure_count + 1 >= %s THEN 'open' ELSE b.state END,
+                    opened_until = CASE WHEN b.state = 'half_open' OR b.failure_count + 1 >= %s
+                                        THEN now() at time zone 'UTC' + %s * interval '1 second'
+                                        ELSE b.opened_until END
+                RETURNING state
+            """, [endpoint, (error or '')[:255], self.env.uid, self.env.uid,
+                  FAILURE_THRESHOLD, FAILURE_THRESHOLD, OPEN_SECONDS])
+            state = cr.fetchone()[0]
+        if state == 'open':
+            _logger.warning("Veri*Factu: circuit open for %s (%s)", endpoint, error)
+        return state
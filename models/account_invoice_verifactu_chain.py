@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+ACCEPTED_STATES = ('accepted', 'partially_accepted')
+
+class AccountInvoiceVerifactuChain(models.Model):
+    '''
+    Cabeza de la cadena de registros de cada compañía: último registro aceptado por la AEAT
+    con el que debe encadenarse el siguiente registro. Hay una cadena para los registros de
+    facturación (altas y anulaciones) y otra para los registros de evento.
+    '''
+    _name = "account.invoice.verifactu.chain"
+
+    company_id = fields.Many2one('res.company', required=True, ondelete='cascade')
+    
+    chain = fields.Selection([('invoice','Registros de facturación'),('event','Registros de evento')], required=True)
+    
+    head_id = fields.Many2one('account.invoice.verifactu', ondelete='set null', help="Último registro aceptado de la cadena")
+    
+    hash = fields.Char(size=64, help="Huella del último registro aceptado")
+    
+    num_serie = fields.Char(help="NumSerieFactura del último registro aceptado")
+    
+    date_invoice = fields.Char(help="FechaExpedicionFactura del último registro aceptado (DD-MM-YYYY)")
+    
+    _sql_constraints = [
+        ('company_chain_uniq', 'unique(company_id, chain)', 'Only one chain head per company and chain is allowed'),
+    ]
+    
+    @api.model
+    def _chain_of(self, register):
+        return 'event' if register.type == 'event' else 'invoice'
+    
+    @api.model
+    def _get_head(self, company_id, chain, lock=True):
+        '''
+        Devuelve la cabeza de la cadena de la compañía, creándola si no existe.
+        Con lock=True la fila queda bloqueada (SELECT ... FOR UPDATE) hasta el final de la
+        transacción, de modo que dos procesos no pueden encadenar con el mismo registro.
+        '''
+        cr = self.env.cr
+        cr.execute("""
+            SELECT id FROM account_invoice_verifactu_chain
+            WHERE company_id = %s AND chain = %s
+        """ + (" FOR UPDATE" if lock else ""), [company_id, chain])
+        row = cr.fetchone()
+        if row:
+            return self.browse(row[0])
+        cr.execute("""
+            INSERT INTO account_invoice_verifactu_chain (company_id, chain, create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (company_id, chain) DO NOTHING
+        """, [company_id, chain, self.env.uid, self.env.uid])
+        cr.execute("""
+            SELECT id FROM account_invoice_verifactu_chain
+            WHERE company_id = %s AND chain = %s
+        """ + (" FOR UPDATE" if lock else ""), [company_id, chain])
+        head = self.browse(cr.fetchone()[0])
+        if not head.head_id:
+            # Primera vez: se inicializa a partir de los registros existentes
+            last = head._search_last_accepted()
+            if last:
+                head._set_head(last)
+        return head
+    
+    @api.multi
+    def _search_last_accepted(self):
+        self.ensure_one()
+        domain = [('company_id', '=', self.company_id.id), ('state', 'in', list(ACCEPTED_STATES))]
+        domain += [('type','=','event')] if self.chain == 'event' else [('type','!=','event')]
+        return self.env['account.invoice.verifactu'].search(domain, order="send_date desc, generation_date desc, id desc", limit=1)
+    
+    @api.multi
+    def _set_head(self, register):
+        self.ensure_one()
+        return self.write({
+            'head_id': register.id,
+            'hash': register.hash,
+            'num_serie': register.invoice_id.move_name,
+            'date_invoice': register.date_invoice,
+        })
+    
+    @api.model
+    def _advance(self, registers):
+        ''' Avanza la cabeza de cada cadena hasta el último de los registros aceptados '''
+        for register in registers.filtered(lambda r: r.state in ACCEPTED_STATES).sorted('id'):
+            company = register.company_id
+            if not company:
+                continue
+            head = self._get_head(company.id, self._chain_of(register))
+            if not head.head_id or head.head_id.id <= register.id:
+                head._set_head(register)
+        return True
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import datetime, timedelta
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountInvoiceVerifactuFlow(models.Model):
+    '''
+    Control de flujo de los envíos a la AEAT por obligado a emitir (NIF).
+    Cada respuesta de la AEAT indica en TiempoEsperaEnvio los segundos que hay que esperar
+    antes del siguiente envío del mismo obligado, salvo que se acumulen registros suficientes
+    para un envío completo. El estado se guarda en base de datos para que lo vean todos los
+    workers de Odoo.
+    '''
+    _name = "account.invoice.verifactu.flow"
+    _order = "nif"
+
+    nif = fields.Char(string="NIF", required=True, readonly=True)
+
+    tiempo_espera_envio = fields.Integer(readonly=True, help="Último TiempoEsperaEnvio (segundos) devuelto por la AEAT")
+
+    last_send_date = fields.Datetime(readonly=True, help="Fecha del último envío con respuesta de la AEAT")
+
+    next_send_after = fields.Datetime(readonly=True, help="No se envían nuevos registros hasta esta fecha salvo envíos completos")
+
+    _sql_constraints = [
+        ('nif_uniq', 'unique(nif)', 'Only one flow control record per NIF is allowed'),
+    ]
+
+    @api.model
+    def _window_open(self, nif):
+        ''' Indica si ya ha transcurrido el tiempo de espera del último envío del NIF '''
+        self.env.cr.execute("""
+            SELECT next_send_after IS NULL OR next_send_after <= now() at time zone 'UTC'
+            FROM account_invoice_verifactu_flow WHERE nif = %s
+        """, [nif])
+        row = self.env.cr.fetchone()
+        return not row or row[0]
+
+    @api.model
+    def _set_wait(self, nif, seconds):
+        '''
+        Registra el TiempoEsperaEnvio de una respuesta. Se confirma en una transacción propia
+        para que el resto de workers lo vean de inmediato.
+        '''
+        if not nif or seconds is None:
+            return False
+        now = datetime.utcnow()
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                INSERT INTO account_invoice_verifactu_flow
+                    (nif, tiempo_espera_envio, last_send_date, next_send_after, create_uid, create_date, write_uid, write_date)
+                VALUES (%s, %s, %s, %s, %s, now() at time zone 'UTC', %s, now() at time zone 'UTC')
+                ON CONFLICT (nif) DO UPDATE
+                SET tiempo_espera_envio = EXCLUDED.tiempo_espera_envio,
+                    last_send_date = EXCLUDED.last_send_date,
+                    next_send_after = EXCLUDED.next_send_after,
+                    write_uid = EXCLUDED.write_uid,
+                    write_date = EXCLUDED.write_date
+            """, [nif, seconds, fields.Datetime.to_string(now),
+                  fields.Datetime.to_string(now + timedelta(seconds=seconds)), self.env.uid, self.env.uid])
+        _logger.debug("Veri*Factu: next submission for %s after %s seconds", nif, seconds)
+        return True
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import base64
+import logging
+
+from odoo import api, fields, models, _
+
+from . import verifactu_payload
+
+_logger = logging.getLogger(__name__)
+
+# Los payloads sin usar durante este tiempo pueden eliminarse: _store los reutiliza antes de
+# que la transacción que los referencia se confirme
+_GC_GRACE_PERIOD = '1 day'
+
+# Campos de los registros y lotes que apuntan a un payload
+PAYLOAD_REFERENCES = [
+    ('account_invoice_verifactu', 'registro_factura_payload_id'),
+    ('account_invoice_verifactu', 'signature_payload_id'),
+    ('account_invoice_verifactu', 'request_payload_id'),
+    ('account_invoice_verifactu', 'response_payload_id'),
+    ('account_invoice_verifactu', 'qr_payload_id'),
+    ('account_invoice_verifactu_batch', 'request_payload_id'),
+    ('account_invoice_verifactu_batch', 'response_payload_id'),
+]
+
+
+class AccountInvoiceVerifactuPayload(models.Model):
+    '''
+    Almacén de payloads comprimidos y direccionados por contenido (SHA-256).
+    El contenido se guarda en la columna bytea ``content``, fuera del ORM para no
+    codificarlo en base64, y sólo se lee cuando se accede al campo del registro.
+    '''
+    _name = "account.invoice.verifactu.payload"
+    _log_access = False
+
+    checksum = fields.Char(size=64, required=True, readonly=True, help="SHA-256 del contenido sin comprimir")
+
+    compression = fields.Selection(verifactu_payload.COMPRESSIONS, required=True, readonly=True)
+
+    size = fields.Integer(readonly=True, help="Tamaño sin comprimir (bytes)")
+
+    stored_size = fields.Integer(readonly=True, help="Tamaño almacenado (bytes)")
+
+    last_used = fields.Datetime(readonly=True, help="Última vez que se guardó este contenido")
+
+    _sql_constraints = [
+        ('checksum_uniq', 'unique(checksum)', 'Payloads are addressed by their checksum'),
+    ]
+
+    @api.model_cr_context
+    def _auto_init(self):
+        res = super(AccountInvoiceVerifactuPayload, self)._auto_init()
+        self.env.cr.execute('ALTER TABLE "%s" ADD COLUMN IF NOT EXISTS content bytea' % self._table)
+        return res
+
+    @api.model
+    def _store(self, value):
+        '''
+        Guarda el contenido (texto o bytes) si no existe ya y devuelve el id del payload.
+        False si el contenido está vacío.
+        '''
+        data = verifactu_payload.to_bytes(value)
+        if not data:
+            return False
+        compression, content = verifactu_payload.pack(data)
+        # ON CONFLICT DO UPDATE para que RETURNING devuelva también el id ya existente;
+        # last_used protege el payload reutilizado de _gc_unreferenced
+        self.env.cr.execute("""
+            INSERT INTO account_invoice_verifactu_payload AS p (checksum, compression, size, stored_size, content, last_used)
+            VALUES (%s, %s, %s, %s, %s, now() at time zone 'UTC')
+            ON CONFLICT (checksum) DO UPDATE SET last_used = excluded.last_used
+            RETURNING id
+        """, [verifactu_payload.checksum(data), compression, len(data), len(content), content])
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _load(self, ids):
+        ''' {id: bytes} de los payloads indicados '''
+        ids = list(set(i for i in ids if i))
+        if not ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT id, compression, content FROM account_invoice_verifactu_payload WHERE id IN %s
+        """, [tuple(ids)])
+        return dict((pid, verifactu_payload.unpack(compression, content))
+                    for pid, compression, content in self.env.cr.fetchall())
+
+    @api.model
+    def _gc_unreferenced(self):
+        '''
+        Elimina los payloads que ya no referencia ningún registro ni lote y que no se han guardado
+        durante _GC_GRACE_PERIOD. Un _store concurrente que reutiliza un payload huérfano actualiza
+        last_used y bloquea la fila: el DELETE espera a esa transacción, vuelve a evaluar last_used
+        y lo conserva. Cada referencia se comprueba con NOT EXISTS sobre su índice.
+        '''
+        references = ''.join(
+            ' AND NOT EXISTS (SELECT 1 FROM %s r WHERE r.%s = p.id)' % (table, column)
+            for table, column in PAYLOAD_REFERENCES)
+        self.env.cr.execute("""
+            DELETE FROM account_invoice_verifactu_payload p
+            WHERE (p.last_used IS NULL OR p.last_used < (now() at time zone 'UTC') - interval %s)
+        """ + references, [_GC_GRACE_PERIOD])
+        _logger.info("Veri*Factu: %s unreferenced payloads removed", self.env.cr.rowcount)
+        return True
+
+
+class VerifactuPayloadMixin(models.AbstractModel):
+    '''
+    Campos de texto o binarios cuyo contenido vive en account.invoice.verifactu.payload.
+    Cada modelo declara el Many2one <campo>_payload_id y un campo no almacenado cuyo
+    compute e inverse llaman a _get_payload / _set_payload, de modo que cada payload sólo
+    se lee y descomprime cuando se accede a su campo.
+    '''
+    _name = "account.invoice.verifactu.payload.mixin"
+
+    # {campo: 'text' | 'binary'}
+    _payload_fields = {}
+
+    def _get_payload(self, name):
+        column = name + '_payload_id'
+        contents = self.env['account.invoice.verifactu.payload'].sudo()._load(self.mapped(column).ids)
+        binary = self._payload_fields[name] == 'binary'
+        for rec in self:
+            data = contents.get(rec[column].id)
+            if binary:
+                rec[name] = data and base64.b64encode(data) or False
+            else:
+                rec[name] = data and data.decode('utf-8') or False
+
+    def _set_payload(self, name):
+        column = name + '_payload_id'
+        store = self.env['account.invoice.verifactu.payload'].sudo()
+        binary = self._payload_fields[name] == 'binary'
+        for rec in self:
+            value = rec[name]
+            if value and binary:
+                value = base64.b64decode(value)
+            payload_id = store._store(value)
+            if rec[column].id != payload_id:
+                rec[column] = payload_id
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import Counter
+
+from lxml import etree
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError, ValidationError
+
+from . import aeat_session
+from . import verifactu_xml
+from . import verifactu_requirement
+from .account_invoice_verifactu import MAX_REGISTERS_PER_ENVELOPE
+
+_logger = logging.getLogger(__name__)
+
+# Clave para los advisory locks que impiden procesar a la vez el mismo requerimiento
+_REQUIREMENT_LOCK_KEY = 0x56460002
+# Registros que se verifican o firman entre dos confirmaciones del progreso
+_SIGN_CHUNK = 500
+
+# Registros de facturación del periodo posteriores al último procesado (paginación por id).
+# El periodo es el de la fecha de expedición de la factura, no el de creación del registro (UTC)
+_PERIOD_QUERY = """
+    SELECT r.id FROM account_invoice_verifactu r
+      JOIN account_invoice i ON i.id = r.invoice_id
+     WHERE r.company_id = %s
+       AND r.type IN ('alta', 'anulation')
+       AND i.date_invoice >= %s AND i.date_invoice <= %s
+       AND r.id > %s
+       {where}
+     ORDER BY r.id
+     LIMIT %s
+"""
+
+_NOT_INVALID = """
+       AND NOT EXISTS (SELECT 1 FROM account_invoice_verifactu_requirement_invalid_rel x
+                        WHERE x.requirement_id = %s AND x.register_id = r.id)
+"""
+
+
+class AccountInvoiceVerifactuRequirement(models.Model):
+    '''
+    Remisión a la AEAT de los registros de facturación de un periodo a requerimiento
+    (SIF no verificable, servicio RequerimientoSOAP).
+    El cron procesa el requerimiento en dos fases, confirmando el progreso tras cada bloque
+    para que un proceso interrumpido continúe donde se quedó:
+    * signing: se comprueba la firma de cada registro y se firman, en hilos paralelos,
+      los registros sin firma (y, si se indica, los de firma no válida).
+    * sending: los registros con firma válida se envían en sobres de hasta
+      MAX_REGISTERS_PER_ENVELOPE registros con RemisionRequerimiento en la Cabecera.
+    '''
+    _name = "account.invoice.verifactu.requirement"
+    _order = "id desc"
+
+    name = fields.Char(string="Referencia", required=True, readonly=True, states={'draft': [('readonly', False)]},
+                       help="RefRequerimiento comunicada por la AEAT")
+    company_id = fields.Many2one('res.company', required=True, readonly=True, states={'draft': [('readonly', False)]},
+                                 default=lambda self: self.env.user.company_id)
+    date_from = fields.Date(string='Date from', required=True, readonly=True, states={'draft': [('readonly', False)]})
+    date_to = fields.Date(string='Date to', required=True, readonly=True, states={'draft': [('readonly', False)]})
+    resign_invalid = fields.Boolean(string="Volver a firmar firmas no válidas", readonly=True,
+                                    states={'draft': [('readonly', False)], 'error': [('readonly', False)]},
+                                    help="Los registros cuya firma no se puede verificar se firman de nuevo con el "
+                                         "certificado de la compañía; si no se marca, se excluyen de la remisión")
+    workers = fields.Integer(string="Hilos de firma", default=lambda self: verifactu_requirement.default_workers(),
+                             help="Hilos en paralelo para verificar y firmar los registros")
+
+    state = fields.Selection([
+        ('draft', 'Borrador'),
+        ('queued', 'En cola'),
+        ('signing', 'Firmando'),
+        ('sending', 'Enviando'),
+        ('done', 'Finalizado'),
+        ('error', 'Error'),
+        ], default='draft', required=True, readonly=True, copy=False,
+        help="""
+        *queued (En cola): pendiente de que lo procese el cron,
+        *signing (Firmando): verificando y firmando los registros del periodo,
+        *sending (Enviando): enviando los sobres a la AEAT,
+        *error (Error): detenido; puede reanudarse desde el último bloque procesado
+        """)
+
+    register_count = fields.Integer(string="Registros", readonly=True, copy=False)
+    signed_count = fields.Integer(string="Firmados", readonly=True, copy=False, help="Registros sin firma firmados por el requerimiento")
+    resigned_count = fields.Integer(string="Firmados de nuevo", readonly=True, copy=False)
+    invalid_count = fields.Integer(string="Firmas no válidas", readonly=True, copy=False)
+    sent_count = fields.Integer(string="Enviados", readonly=True, copy=False)
+    envelope_count = fields.Integer(string="Sobres", readonly=True, copy=False)
+
+    # Progreso: último registro (id) verificado y último enviado
+    checked_register_id = fields.Integer(readonly=True, copy=False)
+    sent_register_id = fields.Integer(readonly=True, copy=False)
+
+    invalid_register_ids = fields.Many2many('account.invoice.verifactu', 'account_invoice_verifactu_requirement_invalid_rel',
+                                            'requirement_id', 'register_id', string="Registros con firma no válida",
+                                            readonly=True, copy=False)
+    batch_ids = fields.One2many('account.invoice.verifactu.batch', 'requirement_id', string="Sobres enviados", readonly=True)
+
+    date_start = fields.Datetime(readonly=True, copy=False)
+    date_done = fields.Datetime(readonly=True, copy=False)
+    last_error = fields.Char(readonly=True, copy=False)
+
+    @api.constrains('date_from', 'date_to')
+    def _check_dates(self):
+        for rec in self:
+            if rec.date_from > rec.date_to:
+                raise ValidationError(_("The start date must be before the end date."))
+
+    @api.multi
+    def action_start(self):
+        ''' Deja el requerimiento en cola; si se detuvo por un error, continúa desde el último bloque '''
+        for rec in self:
+            if rec.company_id.verifactu_sif != 'no_verificable':
+                raise UserError(_("Only companies with a non verifiable (NO VERI*FACTU) system answer AEAT requirements."))
+            if not rec.company_id.sudo().verifactu_p12_file:
+                raise UserError(_("No se encontró el contenido del certificado .p12 en la compañía."))
+        self.filtered(lambda r: r.state in ['draft', 'error']).write({'state': 'queued', 'last_error': False})
+        return True
+
+    @api.model
+    def _cron_process(self):
+        ''' Procesa (o continúa) los requerimientos pendientes '''
+        cr = self.env.cr
+        for job in self.search([('state', 'in', ['queued', 'signing', 'sending'])], order='id'):
+            cr.execute("SELECT pg_try_advisory_lock(%s, %s)", [_REQUIREMENT_LOCK_KEY, job.id])
+            if not cr.fetchone()[0]:
+                continue
+            try:
+                job._run()
+            finally:
+                cr.execute("SELECT pg_advisory_unlock(%s, %s)", [_REQUIREMENT_LOCK_KEY, job.id])
+                cr.commit()
+        return True
+
+    @api.multi
+    def _run(self):
+        self.ensure_one()
+        cr = self.env.cr
+        try:
+            if self.state == 'queued':
+                self.write({'state': 'signing', 'date_start': self.date_start or fields.Datetime.now()})
+                cr.commit()
+            if self.state == 'signing':
+                self._sign_period()
+                self.write({'state': 'sending'})
+                cr.commit()
+            if self.state == 'sending' and self._send_period():
+                self.write({'state': 'done', 'date_done': fields.Datetime.now(), 'last_error': False})
+                cr.commit()
+        except aeat_session.AeatTransientError as e:
+            # Sigue en 'sending': el cron vuelve a enviar el mismo bloque en la próxima ejecución
+            cr.rollback()
+            self.invalidate_cache()
+            _logger.warning('Requerimiento %s: fallo transitorio enviando a AEAT: %s', self.name, e)
+            self.write({'last_error': str(e)[:255]})
+            cr.commit()
+        except Exception as e:
+            cr.rollback()
+            self.invalidate_cache()
+            _logger.exception('Error procesando el requerimiento %s', self.name)
+            self.write({'state': 'error', 'last_error': (getattr(e, 'name', None) or str(e))[:255]})
+            cr.commit()
+        return True
+
+    @api.multi
+    def _period_ids(self, after_id, limit, where='', params=None):
+        self.env.cr.execute(_PERIOD_QUERY.format(where=where),
+                            [self.company_id.id, self.date_from, self.date_to, after_id] + (params or []) + [limit])
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.multi
+    def _sign_period(self):
+        '''
+        Verifica la firma de los registros del periodo y firma los que no la tienen, en bloques de
+        _SIGN_CHUNK registros repartidos entre los hilos del pool.
+        '''
+        self.ensure_one()
+        cr = self.env.cr
+        verifactu = self.env['account.invoice.verifactu']
+        p12_data, p12_password = self.company_id._verifactu_p12_load()
+        with verifactu_requirement.SigningPool(p12_data, p12_password, self.workers) as pool:
+            while True:
+                ids = self._period_ids(self.checked_register_id, _SIGN_CHUNK)
+                if not ids:
+                    break
+                tasks = []
+                for rec in verifactu.browse(ids):
+                    registro = rec.registro_factura or \
+                        etree.tostring(verifactu_xml.build_unsigned(rec), encoding='unicode')
+                    tasks.append((rec.id, registro, verifactu_xml.DS_NS in registro, self.resign_invalid))
+                counts = Counter()
+                invalid = []
+                for reg_id, result, registro_factura, signature in pool.process(tasks):
+                    counts[result] += 1
+                    if result == verifactu_requirement.INVALID:
+                        invalid.append(reg_id)
+                    elif registro_factura:
+                        verifactu.browse(reg_id).write({'registro_factura': registro_factura, 'signature': signature})
+                self.write({
+                    'checked_register_id': ids[-1],
+                    'register_count': self.register_count + len(ids),
+                    'signed_count': self.signed_count + counts[verifactu_requirement.SIGNED],
+                    'resigned_count': self.resigned_count + counts[verifactu_requirement.RESIGNED],
+                    'invalid_count': self.invalid_count + len(invalid),
+                    'invalid_register_ids': [(4, reg_id) for reg_id in invalid],
+                })
+                cr.commit()
+                # Sólo el bloque en curso permanece en memoria
+                self.invalidate_cache()
+        return True
+
+    @api.multi
+    def _send_period(self):
+        '''
+        Envía los registros con firma válida en sobres de hasta MAX_REGISTERS_PER_ENVELOPE registros.
+        El último sobre lleva FinRequerimiento = S y, como cualquier envío incompleto, espera al
+        TiempoEsperaEnvio de la AEAT. Devuelve True al terminar y False si queda pendiente.
+        '''
+        self.ensure_one()
+        cr = self.env.cr
+        company = self.company_id
+        verifactu = self.env['account.invoice.verifactu'].with_context(verifactu_raise_transient=True)
+        while True:
+            ids = self._period_ids(self.sent_register_id, MAX_REGISTERS_PER_ENVELOPE + 1, _NOT_INVALID, [self.id])
+            if not ids:
+                return True
+            last = len(ids) <= MAX_REGISTERS_PER_ENVELOPE
+            if last and not verifactu._flow_window_open(company):
+                return False
+            registers = verifactu.browse(ids[:MAX_REGISTERS_PER_ENVELOPE])
+            batch = self.env['account.invoice.verifactu.batch'].create({
+                'company_id': company.id,
+                'requirement_id': self.id,
+                'request': verifactu_xml.render_envelope(company, registers.mapped('registro_factura'),
+                                                         requerimiento=(self.name, 'S' if last else 'N')),
+            })
+            registers.write({'batch_id': batch.id})
+            registers._send_envelope(batch.request, holder=batch)
+            self.write({
+                'sent_register_id': registers[-1].id,
+                'sent_count': self.sent_count + len(registers),
+                'envelope_count': self.envelope_count + 1,
+                'last_error': False,
+            })
+            cr.commit()
+            self.invalidate_cache()
+            if last:
+                return True
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import datetime, timedelta
+
+from odoo import api, fields, models, _
+
+from . import verifactu_metrics
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountInvoiceVerifactuTiming(models.Model):
+    '''
+    Duración y tamaño del payload de cada etapa de un registro (o de un lote) Veri*Factu.
+    Las filas se insertan con SQL desde verifactu_metrics y se agregan en histogramas por
+    compañía, endpoint y etapa para el controlador /account_verifactu/metrics.
+    '''
+    _name = "account.invoice.verifactu.timing"
+    _log_access = False
+    _order = "id desc"
+
+    date = fields.Datetime(required=True, readonly=True, index=True)
+    stage = fields.Selection(verifactu_metrics.STAGES, required=True, readonly=True, index=True)
+    company_id = fields.Many2one('res.company', readonly=True, index=True)
+    endpoint = fields.Char(readonly=True)
+    register_id = fields.Many2one('account.invoice.verifactu', readonly=True, index=True, ondelete='cascade')
+    batch_id = fields.Many2one('account.invoice.verifactu.batch', readonly=True, index=True, ondelete='cascade')
+    register_count = fields.Integer(string="Registros", readonly=True,
+                                    help="Registros medidos en la fila: 1, o los del lote en los envíos en bloque")
+    duration = fields.Float(string="Duración (ms)", digits=(16, 3), readonly=True, group_operator='avg')
+    size = fields.Integer(string="Tamaño (bytes)", readonly=True, group_operator='avg')
+
+    @api.model
+    def _enabled(self):
+        return self.env['res.company']._get_verifactu_config(False).metrics
+
+    @api.model
+    def _record(self, stage, records, seconds, size=None, holder=None):
+        '''
+        Guarda la medida de una etapa. Con un lote como holder se guarda una fila del lote;
+        si no, una fila por registro con su parte de la duración y del tamaño.
+        '''
+        records = records.filtered(lambda r: isinstance(r.id, int))
+        if not records:
+            return False
+        now = fields.Datetime.now()
+        company = records[0].invoice_id.company_id or records[0].company_id
+        company_id = company.id or None
+        endpoint = company and company._verifactu_config().endpoint or None
+        if holder is not None and holder._name == 'account.invoice.verifactu.batch':
+            rows = [(now, stage, company_id, endpoint, None, holder.id, len(records), seconds * 1000.0, size)]
+        else:
+            share = 1.0 / len(records)
+            part = int(size * share) if size is not None else None
+            rows = [(now, stage, company_id, endpoint, rec.id, None, 1, seconds * 1000.0 * share, part)
+                    for rec in records]
+        self.env.cr.execute("""
+            INSERT INTO account_invoice_verifactu_timing
+                (date, stage, company_id, endpoint, register_id, batch_id, register_count, duration, size)
+            VALUES %s
+        """ % ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(rows)), [item for row in rows for item in row])
+        return True
+
+    @api.model
+    def _aggregate(self, since=None):
+        '''
+        Histograma de duraciones por compañía, endpoint y etapa.
+        :param since: fecha (UTC) desde la que se agregan las medidas; todas las conservadas si no se indica
+        '''
+        buckets = ', '.join(['sum(CASE WHEN t.duration <= %s THEN 1 ELSE 0 END)'] * len(verifactu_metrics.BUCKETS))
+        self.env.cr.execute("""
+            SELECT t.company_id, c.name, t.endpoint, t.stage, count(*), coalesce(sum(t.duration), 0),
+                   coalesce(sum(t.size), 0), coalesce(sum(t.register_count), 0), {buckets}
+              FROM account_invoice_verifactu_timing t
+              LEFT JOIN res_company c ON c.id = t.company_id
+             WHERE %s IS NULL OR t.date >= %s
+             GROUP BY t.company_id, c.name, t.endpoint, t.stage
+             ORDER BY t.company_id, t.endpoint, t.stage
+        """.format(buckets=buckets), [bound * 1000.0 for bound in verifactu_metrics.BUCKETS] + [since, since])
+        return [{
+            'company_id': row[0],
+            'company': row[1],
+            'endpoint': row[2],
+            'stage': row[3],
+            'count': row[4],
+            'seconds': row[5] / 1000.0,
+            'bytes': int(row[6]),
+            'registers': int(row[7]),
+            'buckets': [int(count) for count in row[8:]],
+        } for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _gc_timings(self):
+        ''' Borra las medidas anteriores al periodo de retención (metrics_retention_days) '''
+        days = self.env['res.company']._get_verifactu_config(False).metrics_retention_days
+        limit = fields.Datetime.to_string(datetime.utcnow() - timedelta(days=days))
+        self.env.cr.execute("DELETE FROM account_invoice_verifactu_timing WHERE date < %s", [limit])
+        _logger.info("Veri*Factu: %s stage timings older than %s days removed", self.env.cr.rowcount, days)
+        return True
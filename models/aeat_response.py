@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+Lectura de la respuesta RespuestaRegFactuSistemaFacturacion de la AEAT.
+
+La respuesta se recorre en una única pasada con ``etree.iterparse``: cada RespuestaLinea
+se convierte en un ResponseLine y se libera de memoria en cuanto se ha leído.
+'''
+from collections import namedtuple
+from io import BytesIO
+
+from lxml import etree
+
+ResponseLine = namedtuple('ResponseLine', [
+    'num_serie', 'fecha_expedicion', 'type',
+    'estado_registro', 'codigo_error_registro', 'descripcion_error_registro',
+])
+
+AeatResponse = namedtuple('AeatResponse', [
+    'csv', 'estado_envio', 'tiempo_espera_envio', 'fault', 'lines',
+])
+
+_PARSER = etree.XMLParser(remove_blank_text=True, recover=False, resolve_entities=False)
+
+
+def _local(tag):
+    return etree.QName(tag).localname if isinstance(tag, str) else None
+
+
+def _text(element, *path):
+    ''' Texto del primer descendiente que sigue ``path`` (nombres locales) '''
+    for name in path:
+        if element is None:
+            return ''
+        element = next((child for child in element if _local(child.tag) == name), None)
+    return (element.text or '').strip() if element is not None else ''
+
+
+def _line(element):
+    tipo_operacion = _text(element, 'Operacion', 'TipoOperacion')
+    return ResponseLine(
+        num_serie=_text(element, 'IDFactura', 'NumSerieFactura'),
+        fecha_expedicion=_text(element, 'IDFactura', 'FechaExpedicionFactura'),
+        type='anulation' if tipo_operacion == 'Anulacion' else 'alta',
+        estado_registro=_text(element, 'EstadoRegistro'),
+        codigo_error_registro=_text(element, 'CodigoErrorRegistro'),
+        descripcion_error_registro=_text(element, 'DescripcionErrorRegistro'),
+    )
+
+
+def fault(data):
+    '''
+    faultstring si la respuesta (bytes) es un SOAP Fault, p.ej. un rechazo por esquema que la
+    AEAT devuelve con HTTP 500; None si no lo es o no es XML.
+    '''
+    try:
+        root = etree.fromstring(data, parser=_PARSER)
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+    if _local(root.tag) != 'Envelope':
+        return None
+    body = next((child for child in root if _local(child.tag) == 'Body'), None)
+    element = next((child for child in body if _local(child.tag) == 'Fault'), None) if body is not None else None
+    if element is None:
+        return None
+    return _text(element, 'faultstring') or _text(element, 'Reason', 'Text') or 'SOAP Fault'
+
+
+def parse(data):
+    '''
+    Interpreta la respuesta SOAP de la AEAT (bytes). Lanza etree.XMLSyntaxError si no es XML.
+    :return: AeatResponse; tiempo_espera_envio en segundos (int) o None.
+    '''
+    csv = estado_envio = fault = ''
+    tiempo_espera_envio = None
+    lines = []
+    for _event, element in etree.iterparse(BytesIO(data), events=('end',), remove_blank_text=True):
+        name = _local(element.tag)
+        if name == 'RespuestaLinea':
+            lines.append(_line(element))
+        elif name == 'CSV':
+            csv = (element.text or '').strip()
+        elif name == 'EstadoEnvio':
+            estado_envio = (element.text or '').strip()
+        elif name == 'TiempoEsperaEnvio':
+            try:
+                tiempo_espera_envio = int((element.text or '').strip())
+            except ValueError:
+                tiempo_espera_envio = None
+        elif name == 'faultstring':
+            fault = (element.text or '').strip()
+        elif name == 'Fault':
+            # Un Fault sin faultstring también es un rechazo del envío
+            fault = fault or 'SOAP Fault'
+        else:
+            continue
+        # Liberamos lo ya leído: la memoria no crece con el número de líneas
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
+    return AeatResponse(csv, estado_envio, tiempo_espera_envio, fault, lines)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+Sesiones HTTP persistentes para la conexión mTLS con la AEAT.
+
+Cada proceso mantiene una sesión por base de datos, compañía y certificado. La sesión
+conserva las conexiones abiertas (keep-alive), de modo que los envíos sucesivos no
+vuelven a decodificar el .p12, ni a construir el contexto SSL, ni a negociar TLS.
+'''
+import logging
+import threading
+
+import requests
+from requests_pkcs12 import Pkcs12Adapter
+
+_logger = logging.getLogger(__name__)
+
+# Conexiones abiertas que conserva cada sesión con un mismo host
+POOL_MAXSIZE = 4
+
+# Respuestas HTTP que indican una indisponibilidad temporal de la AEAT. Un HTTP 500 con un
+# SOAP Fault en el cuerpo no es transitorio: es la respuesta (rechazo) de la AEAT
+TRANSIENT_HTTP_STATUS = (408, 429, 500, 502, 503, 504)
+
+_lock = threading.Lock()
+_sessions = {}
+
+
+class AeatTransientError(Exception):
+    ''' Fallo transitorio de transporte (timeout, conexión, HTTP 5xx): el envío puede repetirse '''
+
+
+def get_session(dbname, company_id, cert_fingerprint, load_p12):
+    '''
+    Devuelve la sesión de la compañía para el certificado indicado, creándola si no existe.
+    :param load_p12: función sin argumentos que devuelve (p12_data, p12_password);
+                     solo se llama al crear la sesión
+    '''
+    key = (dbname, company_id, cert_fingerprint)
+    with _lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+        # Un certificado nuevo sustituye a cualquier otro de la misma compañía
+        _drop(lambda k: k[:2] == (dbname, company_id))
+        p12_data, p12_password = load_p12()
+        session = requests.Session()
+        session.mount('https://', Pkcs12Adapter(
+            pkcs12_data=p12_data,
+            pkcs12_password=p12_password,
+            pool_maxsize=POOL_MAXSIZE,
+        ))
+        _sessions[key] = session
+        _logger.debug('Nueva sesión AEAT para la compañía %s (%s)', company_id, dbname)
+        return session
+
+
+def invalidate(dbname, company_id=None):
+    ''' Cierra las sesiones de una compañía (o de toda la base de datos) '''
+    with _lock:
+        _drop(lambda k: k[0] == dbname and (company_id is None or k[1] == company_id))
+
+
+def _drop(predicate):
+    for key in [k for k in _sessions if predicate(k)]:
+        session = _sessions.pop(key)
+        try:
+            session.close()
+        except Exception:
+            _logger.warning('No se pudo cerrar la sesión AEAT %s', key, exc_info=True)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Caché por proceso del certificado .p12 de cada compañía ya decodificado.
+
+Firma, transporte y validación comparten la misma entrada: clave privada, certificado,
+cadena de certificados, un XMLSigner preparado y el motor de firma de registros. La entrada se identifica por base de datos,
+compañía y checksum del adjunto (más la contraseña), de modo que un certificado nuevo
+nunca reutiliza la entrada del anterior.
+'''
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+
+from signxml import XMLSigner, methods
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.hazmat.backends import default_backend
+
+from . import verifactu_signer
+
+_logger = logging.getLogger(__name__)
+
+P12Bundle = namedtuple('P12Bundle', [
+    'checksum',
+    'private_key',
+    'certificate',
+    'additional_certs',
+    'signer',
+    'register_signer',
+    'subject',
+    'not_valid_before',
+    'not_valid_after',
+])
+
+_lock = threading.Lock()
+_bundles = {}
+
+
+def load_key_and_certificates(p12_data, p12_password):
+    ''' pkcs12.load_key_and_certificates compatible con cryptography 2.x y >= 3.4 '''
+    password = p12_password.encode('utf-8') if p12_password else None
+    try:
+        # cryptography >= 3.4 (no necesita backend)
+        return pkcs12.load_key_and_certificates(p12_data, password)
+    except TypeError:
+        # cryptography 2.x (requiere backend)
+        return pkcs12.load_key_and_certificates(p12_data, password, backend=default_backend())
+
+
+def cache_key(dbname, company_id, checksum, p12_password):
+    password_digest = hashlib.sha256((p12_password or '').encode('utf-8')).hexdigest()
+    return (dbname, company_id, checksum, password_digest)
+
+
+def get_bundle(key, load_p12):
+    '''
+    Devuelve el P12Bundle de la clave indicada, decodificando el .p12 solo si no está en caché.
+    :param load_p12: función sin argumentos que devuelve (p12_data, p12_password)
+    :raise ValueError: si el .p12 no contiene clave y certificado
+    '''
+    with _lock:
+        bundle = _bundles.get(key)
+    if bundle is not None:
+        return bundle
+    p12_data, p12_password = load_p12()
+    bundle = build_bundle(key[2], p12_data, p12_password)
+    with _lock:
+        # Un certificado nuevo sustituye a cualquier otro de la misma compañía
+        for old_key in [k for k in _bundles if k[:2] == key[:2]]:
+            del _bundles[old_key]
+        _bundles[key] = bundle
+    return bundle
+
+
+def build_bundle(checksum, p12_data, p12_password):
+    '''
+    Decodifica el .p12 sin pasar por la caché (p.ej. en los procesos de firma en paralelo).
+    :raise ValueError: si el .p12 no contiene clave y certificado
+    '''
+    private_key, cert, additional_certs = load_key_and_certificates(p12_data, p12_password)
+    if private_key is None or cert is None:
+        raise ValueError("El .p12 no contiene clave y/o certificado.")
+    # Firmante XMLDSig Enveloped (RSA-SHA256, digest SHA256, C14N 1.0)
+    signer = XMLSigner(
+        method=methods.enveloped,
+        signature_algorithm="rsa-sha256",
+        digest_algorithm="sha256",
+        c14n_algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315",
+    )
+    additional_certs = list(additional_certs or [])
+    return P12Bundle(
+        checksum=checksum,
+        private_key=private_key,
+        certificate=cert,
+        additional_certs=additional_certs,
+        signer=signer,
+        register_signer=verifactu_signer.RegisterSigner(signer, private_key, [cert] + additional_certs),
+        subject=cert.subject.rfc4514_string() if hasattr(cert.subject, 'rfc4514_string') else str(cert.subject),
+        not_valid_before=cert.not_valid_before,
+        not_valid_after=cert.not_valid_after,
+    )
+
+
+def invalidate(dbname, company_id=None):
+    ''' Descarta los certificados en caché de una compañía (o de toda la base de datos) '''
+    with _lock:
+        for key in [k for k in _bundles if k[0] == dbname and (company_id is None or k[1] == company_id)]:
+            del _bundles[key]
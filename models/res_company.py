@@ -2,11 +2,17 @@
 
 import re
 import base64
+import hashlib
+import logging
 
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
 from odoo.exceptions import ValidationError
-from cryptography.hazmat.primitives.serialization import pkcs12
-from cryptography.hazmat.backends import default_backend
+
+from . import aeat_session
+from . import p12_store
+from . import verifactu_config
+
+_logger = logging.getLogger(__name__)
 
 
 
@@ -39,6 +45,8 @@ class res_company(models.Model):
         string="Contraseña .p12",
         help="Contraseña del fichero .p12. Dejar en blanco si no tiene."
     )
+    verifactu_p12_subject = fields.Char(string="Titular del certificado", compute='_compute_verifactu_p12_info')
+    verifactu_p12_not_after = fields.Datetime(string="Caducidad del certificado", compute='_compute_verifactu_p12_info')
     verifactu_operation = fields.Char(
         string="Operaciones",
         help="Descripción de las operaciones incuidas en las facturas (opcional)"
@@ -63,22 +71,113 @@ class res_company(models.Model):
         """
         try:
             p12_data = base64.b64decode(p12_bytes or b'')
-            if isinstance(password, str):
-                password = password.encode('utf-8')
+            if isinstance(password, bytes):
+                password = password.decode('utf-8')
             # Intenta decodificar el contenedor PKCS#12
-            key, cert, ca_certs = pkcs12.load_key_and_certificates(
-                p12_data, password, backend=default_backend()
-            )
+            key, cert, ca_certs = p12_store.load_key_and_certificates(p12_data, password)
             # Debe haber al menos una clave o un certificado
             return bool(cert or key)
         except Exception as e:
             # Log opcional: _logger.warning('Error validando p12: %s', e)
             return False
     
+    @api.multi
+    def _verifactu_p12_checksum(self):
+        ''' Checksum del adjunto con el .p12 de la compañía (identifica el certificado sin leerlo) '''
+        self.ensure_one()
+        attachment = self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_field', '=', 'verifactu_p12_file'),
+            ('res_id', '=', self.id),
+        ], limit=1)
+        if attachment.checksum:
+            return attachment.checksum
+        return hashlib.sha1(self.sudo().verifactu_p12_file or b'').hexdigest()
+
+    @api.multi
+    def _verifactu_p12_load(self):
+        ''' (p12_data, p12_password) del certificado de la compañía '''
+        self.ensure_one()
+        company = self.sudo()
+        p12_password = (company.verifactu_p12_password or '').strip()
+        return base64.b64decode(company.verifactu_p12_file or b''), p12_password
+
+    @api.multi
+    def _verifactu_p12_key(self):
+        self.ensure_one()
+        return p12_store.cache_key(self.env.cr.dbname, self.id, self._verifactu_p12_checksum(),
+                                   (self.sudo().verifactu_p12_password or '').strip())
+
+    @api.multi
+    def _verifactu_p12(self):
+        '''
+        Certificado .p12 de la compañía decodificado (clave, certificado, cadena y firmante),
+        compartido por firma, transporte y validación.
+        :raise ValueError: si el .p12 o la contraseña no son válidos
+        '''
+        self.ensure_one()
+        return p12_store.get_bundle(self._verifactu_p12_key(), self._verifactu_p12_load)
+
+    @api.multi
+    def _verifactu_p12_valid(self):
+        self.ensure_one()
+        try:
+            return bool(self._verifactu_p12())
+        except Exception as e:
+            _logger.warning('Error validando p12 de la compañía %s: %s', self.name, e)
+            return False
+
+    @api.depends('verifactu_p12_file', 'verifactu_p12_password')
+    def _compute_verifactu_p12_info(self):
+        for company in self:
+            subject = not_after = False
+            if company.id and company.sudo().verifactu_p12_file:
+                try:
+                    bundle = company._verifactu_p12()
+                    subject = bundle.subject
+                    not_after = fields.Datetime.to_string(bundle.not_valid_after)
+                except Exception:
+                    pass
+            company.verifactu_p12_subject = subject
+            company.verifactu_p12_not_after = not_after
+
+    @api.multi
+    def _verifactu_session(self):
+        ''' Sesión HTTP persistente (mTLS con el .p12 de la compañía) para enviar a la AEAT '''
+        self.ensure_one()
+        key = self._verifactu_p12_key()
+        return aeat_session.get_session(
+            self.env.cr.dbname, self.id,
+            '%s-%s' % key[2:],
+            self._verifactu_p12_load,
+        )
+    
+    @api.multi
+    def _verifactu_config(self):
+        ''' Instantánea (VerifactuConfig) de la configuración Veri*Factu de la compañía '''
+        self.ensure_one()
+        return self._get_verifactu_config(self.id)
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_verifactu_config(self, company_id):
+        '''
+        Lee en una sola consulta los parámetros account_verifactu.*; con company_id=False
+        devuelve sólo los parámetros generales. Se invalida con clear_caches() al guardar
+        los ajustes (set_param) o los datos Veri*Factu de la compañía.
+        '''
+        self.env.cr.execute("SELECT key, value FROM ir_config_parameter WHERE key LIKE %s",
+                            [verifactu_config.PARAM_PREFIX + '%'])
+        params = dict((key[len(verifactu_config.PARAM_PREFIX):], value) for key, value in self.env.cr.fetchall())
+        if not company_id:
+            return verifactu_config.build(params)
+        company = self.sudo().browse(company_id)
+        nif = company.vat and company.country_id and company.vat_clean()[1] or company.vat
+        return verifactu_config.build(params, company_id, nif, company.verifactu_sif)
+
     @api.onchange('verifactu_date','vat','verifactu_simplified_invoices')
     def onchange_verifactu_date(self):
-        verifactu_simplified_invoices = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_simplified_invoices')
-        verifactu_runing = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_runing')
+        verifactu_simplified_invoices = self._get_verifactu_config(False).simplified_invoices
         if self.vat[:2] == 'ES' and not self.verifactu_date:
             self.verifactu_date = '2026-01-01'
             self.verifactu_sif = 'verificable'
@@ -106,7 +205,7 @@ class res_company(models.Model):
                     "o la contraseña es incorrecta."
                 )    
         if 'verifactu_date' in values:
-            verifactu_simplified_invoices = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_simplified_invoices')
+            verifactu_simplified_invoices = self._get_verifactu_config(False).simplified_invoices
             values['verifactu_simplified_invoices'] = values.get('verifactu_simplified_invoices',False) and verifactu_simplified_invoices
         return super(res_company, self).create(values = values)
             
@@ -114,6 +213,13 @@ class res_company(models.Model):
     def write(self, values):
         '''Ensure companies from spain must active veri*factu'''
         res = super(res_company, self).write(values)
+        if {'vat', 'country_id', 'verifactu_sif', 'verifactu_date'} & set(values):
+            # Instantánea de configuración (_get_verifactu_config)
+            self.clear_caches()
+        if 'verifactu_p12_file' in values or 'verifactu_p12_password' in values:
+            for company_id in self:
+                aeat_session.invalidate(self.env.cr.dbname, company_id.id)
+                p12_store.invalidate(self.env.cr.dbname, company_id.id)
         for company_id in self:
             correction_values = {}
             if company_id.vat[:2] == 'ES' and not company_id.verifactu_date:
@@ -124,18 +230,19 @@ class res_company(models.Model):
                 if company_id.verifactu_sif == 'no_verificable':
                     if not company_id.verifactu_p12_file or not company_id.verifactu_p12_password:
                         raise ValidationError(_("An electronic signature is mandatory. You need your p12 file and password. %s") % company_id.name)
-                    if not self.verificar_p12(company_id.verifactu_p12_file,company_id.verifactu_p12_password):
+                    if not company_id._verifactu_p12_valid():
                         raise ValidationError(_(
                             "El archivo proporcionado no es un certificado PKCS#12 válido "\
                             "o la contraseña es incorrecta."\
                             "%s") % company_id.name
                         )      
                 if company_id.verifactu_simplified_invoices:
-                    verifactu_simplified_invoices = self.sudo().env['ir.config_parameter'].get_param('account_verifactu.verifactu_simplified_invoices')
+                    verifactu_simplified_invoices = self._get_verifactu_config(False).simplified_invoices
                     if not verifactu_simplified_invoices:
                         correction_values['verifactu_sif'] = verifactu_simplified_invoices
             if correction_values:
                 res = super(res_company, self).write(correction_values)
+                self.clear_caches()
         return res
     
             
\ No newline at end of file
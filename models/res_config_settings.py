@@ -32,6 +32,10 @@ Verificable means AEAT can vefify your SIF"""
     
     verifactu_simplified_invoices = fields.Boolean(string='Use of simplified invoices on verifactu', help='Simplified invoices like ticket of sale with no customer idenfied')
     
+    verifactu_async = fields.Boolean(string='Send registers from queue', help='Registers are sent to AEAT by a scheduled action instead of right after the invoice validation is saved')
+    
+    verifactu_metrics = fields.Boolean(string='Record stage timings', help='Store the duration and payload size of every register stage (rendering, signing, SOAP envelope, AEAT request, QR) and publish them on /account_verifactu/metrics')
+    
     @api.model
     def get_values(self):
         res = super(VeriFactuConfiguration, self).get_values()
@@ -43,6 +47,8 @@ Verificable means AEAT can vefify your SIF"""
         verifactu_endpoint_produccion_verificable = self.env["ir.config_parameter"].get_param("account_verifactu.verifactu_endpoint_produccion_verificable", default=None)
         verifactu_endpoint_produccion_no_verificable = self.env["ir.config_parameter"].get_param("account_verifactu.verifactu_endpoint_produccion_no_verificable", default=None)
         verifactu_simplified_invoices = self.env["ir.config_parameter"].get_param("account_verifactu.verifactu_simplified_invoices", default=None)
+        verifactu_async = self.env["ir.config_parameter"].get_param("account_verifactu.verifactu_async", default=None)
+        verifactu_metrics = self.env["ir.config_parameter"].get_param("account_verifactu.verifactu_metrics", default=None)
         res.update(
             verifactu_runing = verifactu_runing,
             verifactu_runing_method = verifactu_runing_method,
@@ -51,7 +57,9 @@ Verificable means AEAT can vefify your SIF"""
             verifactu_endpoint_no_produccion_no_verificable = verifactu_endpoint_no_produccion_no_verificable,
             verifactu_endpoint_produccion_verificable = verifactu_endpoint_produccion_verificable,
             verifactu_endpoint_produccion_no_verificable = verifactu_endpoint_produccion_no_verificable,
-            verifactu_simplified_invoices = verifactu_simplified_invoices
+            verifactu_simplified_invoices = verifactu_simplified_invoices,
+            verifactu_async = verifactu_async,
+            verifactu_metrics = verifactu_metrics not in (None, '', '0', 'False'),
         )
         return res
 
@@ -66,5 +74,16 @@ Verificable means AEAT can vefify your SIF"""
         self.env['ir.config_parameter'].set_param("account_verifactu.verifactu_endpoint_produccion_no_verificable", self.verifactu_endpoint_produccion_no_verificable or '')
 
         self.env['ir.config_parameter'].set_param("account_verifactu.verifactu_simplified_invoices", self.verifactu_simplified_invoices or '')
+        self.env['ir.config_parameter'].set_param("account_verifactu.verifactu_async", self.verifactu_async or '')
+        self.env['ir.config_parameter'].set_param("account_verifactu.verifactu_metrics", self.verifactu_metrics or '')
+        # Instantánea de configuración de cada compañía (res.company._get_verifactu_config)
+        self.env['res.company'].clear_caches()
+
+    @api.multi
+    def action_regenerate_verifactu_qr(self):
+        ''' Recalcula la URL del QR de todos los registros con los endpoints guardados '''
+        self.execute()
+        self.env['account.invoice.verifactu']._regenerate_qr_urls()
+        return {'type': 'ir.actions.client', 'tag': 'reload'}
 
     
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''
+Instantánea inmutable de la configuración Veri*Factu de una compañía.
+
+Reúne en una sola lectura los parámetros account_verifactu.* de ir.config_parameter
+y los datos de la compañía que usa el envío a la AEAT. res.company la guarda con
+ormcache (_get_verifactu_config) y la invalida al guardar los ajustes o la compañía.
+'''
+from collections import namedtuple
+
+PARAM_PREFIX = 'account_verifactu.'
+
+VerifactuConfig = namedtuple('VerifactuConfig', [
+    'company_id',
+    'nif',                    # NIF sin prefijo de país
+    'sif',                    # verificable | no_verificable
+    'runing',
+    'runing_method',          # production | no_production
+    'endpoint',               # endpoint SOAP según runing_method y sif
+    'soap_action',
+    'ssl_verify',             # True, False o ruta al bundle de CA
+    'simplified_invoices',
+    'send_async',
+    'batch_threshold',        # None si no está configurado
+    'integrity_workers',
+    'metrics',                # tiempos por etapa (verifactu_metrics)
+    'metrics_retention_days',
+])
+
+_ENDPOINT_KEYS = {
+    ('production', 'verificable'): 'verifactu_endpoint_produccion_verificable',
+    ('production', 'no_verificable'): 'verifactu_endpoint_produccion_no_verificable',
+    ('no_production', 'verificable'): 'verifactu_endpoint_no_produccion_verificable',
+    ('no_production', 'no_verificable'): 'verifactu_endpoint_no_produccion_no_verificable',
+}
+
+
+def _flag(value, default=False):
+    ''' Los parámetros booleanos se guardan como texto ('True', 'False', '1', '') '''
+    if value is None:
+        return default
+    return str(value).lower() not in ('', '0', 'false')
+
+
+def _int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _verify(value):
+    ''' ssl_verify: 'False'/'0' desactiva la verificación; cualquier otro texto es la ruta a un bundle de CA '''
+    if value is None or str(value).strip().lower() in ('', '1', 'true'):
+        return True
+    if str(value).strip().lower() in ('0', 'false'):
+        return False
+    return str(value).strip()
+
+
+def build(params, company_id=False, nif=False, sif=False):
+    '''
+    :param params: {clave sin prefijo: valor} de los parámetros account_verifactu.*
+    '''
+    runing_method = params.get('verifactu_runing_method') or False
+    endpoint_key = _ENDPOINT_KEYS[(
+        'production' if runing_method == 'production' else 'no_production',
+        'verificable' if sif == 'verificable' else 'no_verificable',
+    )]
+    return VerifactuConfig(
+        company_id=company_id,
+        nif=nif,
+        sif=sif,
+        runing=_flag(params.get('verifactu_runing')),
+        runing_method=runing_method,
+        endpoint=params.get(endpoint_key) or False,
+        soap_action=params.get('soap_action') or '',
+        # Verificación SSL configurable (por defecto True, o ruta a la CA, p.ej. la del servidor simulado)
+        ssl_verify=_verify(params.get('ssl_verify')),
+        simplified_invoices=_flag(params.get('verifactu_simplified_invoices')),
+        send_async=_flag(params.get('verifactu_async'), default=True),
+        batch_threshold=_int(params.get('batch_threshold')),
+        integrity_workers=_int(params.get('integrity_workers'), 4),
+        metrics=_flag(params.get('verifactu_metrics')),
+        metrics_retention_days=_int(params.get('metrics_retention_days'), 7),
+    )
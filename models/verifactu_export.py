@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+'''
+Exportación en streaming de los registros de facturación de un periodo (evento 08).
+
+Los registros se leen con un cursor de servidor y se serializan con generadores
+directamente a ficheros temporales, que después se comprimen en un zip:
+
+* registros.ndjson | registros.xml: los registros (un JSON por línea o los RegistroAlta /
+  RegistroAnulacion concatenados bajo un elemento raíz).
+* manifest.csv: id, tipo, NumSerieFactura, FechaExpedicionFactura, Huella y SHA-256 del XML
+  de cada registro.
+* manifest.json: resumen del periodo y SHA-256 de los ficheros anteriores.
+
+La memoria utilizada no depende del número de registros exportados.
+'''
+import os
+import csv
+import json
+import shutil
+import hashlib
+import zipfile
+import tempfile
+
+from . import verifactu_hash
+from . import verifactu_payload
+from . import verifactu_sql
+
+EXPORT_FORMATS = [('ndjson', 'NDJSON'), ('xml', 'XML')]
+
+_EXPORT_QUERY = """
+    SELECT r.id, r.type, r.state, i.move_name, to_char(i.date_invoice, 'DD-MM-YYYY'), r.generation_date, r.hash, a.hash,
+           r.send_date, i.type, i.amount_tax, i.amount_total, p.compression, p.content
+      FROM account_invoice_verifactu r
+      LEFT JOIN account_invoice_verifactu a ON a.id = r.anterior
+      LEFT JOIN account_invoice_verifactu_payload p ON p.id = r.registro_factura_payload_id
+      JOIN account_invoice i ON i.id = r.invoice_id
+     WHERE r.company_id = %s
+       AND r.type IN ('alta', 'anulation')
+       AND i.date_invoice >= %s AND i.date_invoice <= %s
+     ORDER BY r.id
+"""
+
+_COLUMNS = ('id', 'type', 'state', 'num_serie', 'fecha_expedicion', 'generation_date', 'hash',
+            'hash_anterior', 'send_date', 'invoice_type', 'amount_tax', 'amount_total', 'registro_factura')
+
+
+class _HashingWriter(object):
+    ''' Fichero de texto UTF-8 que calcula el SHA-256 de lo escrito '''
+
+    def __init__(self, path):
+        self.path = path
+        self.sha256 = hashlib.sha256()
+        self._file = open(path, 'wb')
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.sha256.update(data)
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+def _records(rows, summary):
+    ''' Convierte las filas en dicts y acumula el resumen del periodo '''
+    for row in rows:
+        # El RegistroFactura se guarda comprimido: se descomprime registro a registro
+        record = dict(zip(_COLUMNS, row[:-2] + (verifactu_payload.unpack_text(row[-2], row[-1]),)))
+        record['fecha_expedicion'] = record['fecha_expedicion'] or ''
+        record['send_date'] = record['send_date'] and str(record['send_date']) or None
+        summary['count'] += 1
+        if record['type'] == 'alta':
+            sign = verifactu_hash.amount_sign(record['invoice_type'])
+            summary['count_alta'] += 1
+            summary['suma_cuota_total_alta'] += (record['amount_tax'] or 0.0) * sign
+            summary['suma_importe_total_alta'] += (record['amount_total'] or 0.0) * sign
+        else:
+            summary['count_anulation'] += 1
+        reference = {
+            'id': record['id'],
+            'num_serie': record['num_serie'],
+            'fecha_expedicion': record['fecha_expedicion'],
+            'hash': record['hash'],
+        }
+        if summary['first'] is None:
+            summary['first'] = reference
+        summary['last'] = reference
+        yield record
+
+
+def _ndjson_chunks(records):
+    for record in records:
+        yield json.dumps(record, sort_keys=True, default=str) + '\n'
+
+
+def _xml_chunks(records):
+    yield "<?xml version='1.0' encoding='UTF-8'?>\n<RegistrosFacturacion>\n"
+    for record in records:
+        if record['registro_factura']:
+            yield record['registro_factura'].strip() + '\n'
+    yield "</RegistrosFacturacion>\n"
+
+
+def export_period(cr, company_id, date_from, date_to, export_format, path):
+    '''
+    Exporta al zip ``path`` los registros de facturación de la compañía de las facturas
+    expedidas entre ``date_from`` y ``date_to`` (fechas YYYY-MM-DD, ambas incluidas; no la
+    fecha de creación del registro, que es UTC) y devuelve el resumen.
+    '''
+    summary = {
+        'company_id': company_id,
+        'date_from': date_from,
+        'date_to': date_to,
+        'format': export_format,
+        'count': 0,
+        'count_alta': 0,
+        'count_anulation': 0,
+        'suma_cuota_total_alta': 0.0,
+        'suma_importe_total_alta': 0.0,
+        'first': None,
+        'last': None,
+        'files': {},
+    }
+    data_name = 'registros.%s' % export_format
+    tmpdir = tempfile.mkdtemp(prefix='verifactu_export_')
+    try:
+        data = _HashingWriter(os.path.join(tmpdir, data_name))
+        manifest = _HashingWriter(os.path.join(tmpdir, 'manifest.csv'))
+        manifest_csv = csv.writer(manifest, delimiter=';', lineterminator='\n')
+        manifest_csv.writerow(['id', 'type', 'num_serie', 'fecha_expedicion', 'hash', 'sha256_registro'])
+
+        def manifested(records):
+            for record in records:
+                xml = (record['registro_factura'] or '').encode('utf-8')
+                manifest_csv.writerow([record['id'], record['type'], record['num_serie'], record['fecha_expedicion'],
+                                       record['hash'], hashlib.sha256(xml).hexdigest()])
+                yield record
+
+        rows = verifactu_sql.stream_rows(cr, 'verifactu_export', _EXPORT_QUERY, [company_id, date_from, date_to])
+        records = manifested(_records(rows, summary))
+        chunks = _xml_chunks(records) if export_format == 'xml' else _ndjson_chunks(records)
+        try:
+            for chunk in chunks:
+                data.write(chunk)
+        finally:
+            data.close()
+            manifest.close()
+
+        summary['suma_cuota_total_alta'] = '{:.2f}'.format(summary['suma_cuota_total_alta'])
+        summary['suma_importe_total_alta'] = '{:.2f}'.format(summary['suma_importe_total_alta'])
+        summary['files'] = {
+            data_name: data.sha256.hexdigest(),
+            'manifest.csv': manifest.sha256.hexdigest(),
+        }
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            archive.write(data.path, data_name)
+            archive.write(manifest.path, 'manifest.csv')
+            archive.writestr('manifest.json', json.dumps(summary, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return summary
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''
+Cálculo de la huella (Huella / HuellaEvento) de los registros Veri*Factu.
+
+Las tuplas campo=valor son las que fija la AEAT para cada tipo de registro; se
+comparten entre ``account.invoice.verifactu.generate_hash`` y el verificador de
+integridad de la cadena, que trabaja directamente sobre filas SQL.
+'''
+import re
+import hashlib
+from datetime import datetime, timedelta
+
+SISTEMA_INFORMATICO_ID = 'OD'
+SISTEMA_INFORMATICO_VERSION = '11.0.0'
+
+
+def clean_vat(country_code, vat_number):
+    ''' NIF sin el prefijo del país '''
+    return re.sub(r"^%s" % re.escape(country_code or ''), "", vat_number or '', flags=re.IGNORECASE).strip()
+
+
+def amount_sign(invoice_type):
+    return 1 if invoice_type == 'out_invoice' else -1
+
+
+def alta_cuples(vat, num_serie, fecha, tipo_factura, cuota_total, importe_total, huella_anterior, generation_date):
+    return [
+        ("IDEmisorFactura", vat),
+        ("NumSerieFactura", num_serie.strip()),
+        ("FechaExpedicionFactura", fecha.strip()),
+        ("TipoFactura", tipo_factura),
+        ("CuotaTotal", "{:.2f}".format(cuota_total)),
+        ("ImporteTotal", "{:.2f}".format(importe_total)),
+        ("Huella", (huella_anterior or "").strip()),
+        ("FechaHoraHusoGenRegistro", generation_date),
+    ]
+
+
+def anulation_cuples(vat, num_serie, fecha, huella_anterior, generation_date):
+    return [
+        ("IDEmisorFacturaAnulada", vat),
+        ("NumSerieFacturaAnulada", num_serie.strip()),
+        ("FechaExpedicionFacturaAnulada", fecha.strip()),
+        ("Huella", (huella_anterior or "").strip()),
+        ("FechaHoraHusoGenRegistro", generation_date),
+    ]
+
+
+def event_cuples(vat, company_id, even_type, huella_anterior, generation_date):
+    return [
+        ("NIF", vat),
+        ("IdSistemaInformatico", SISTEMA_INFORMATICO_ID),
+        ("Version", SISTEMA_INFORMATICO_VERSION),
+        ("NumeroInstalacion", str(company_id)),
+        ("NIF", vat),
+        ("TipoEvento", even_type),
+        ("HuellaEvento", (huella_anterior or "").strip()),
+        ("FechaHoraHusoGenEvento", generation_date),
+    ]
+
+
+def compute_hash(cuples):
+    ''' Devuelve la cadena concatenada y su SHA-256 en hexadecimal mayúsculas '''
+    chain = "&".join("{}={}".format(k, v) for k, v in cuples)
+    return chain, hashlib.sha256(chain.encode("utf-8")).hexdigest().upper()
+
+
+def parse_generation_date(value):
+    '''
+    Convierte FechaHoraHusoGenRegistro (YYYY-MM-DDTHH:MM:SS+HH:MM) a datetime UTC naive.
+    Devuelve None si el valor no tiene ese formato.
+    '''
+    if not value or len(value) < 25:
+        return None
+    try:
+        moment = datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+        offset = timedelta(hours=int(value[20:22]), minutes=int(value[23:25]))
+    except ValueError:
+        return None
+    return moment - offset if value[19] == '+' else moment + offset
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+Verificación de la integridad y trazabilidad de la cadena de registros de facturación.
+
+Cada compañía se recorre con un cursor de servidor (DECLARE ... / FETCH), en el orden
+de encadenamiento, conservando en memoria sólo el registro anterior: el consumo de
+memoria no depende del tamaño de la tabla. Las comprobaciones son:
+
+* huella: se recalcula la Huella con las mismas tuplas que generate_hash.
+* cadena: el registro apunta (anterior) al registro aceptado inmediatamente anterior.
+* fechas: FechaHoraHusoGenRegistro no retrocede respecto al registro anterior.
+'''
+import logging
+from contextlib import closing
+
+import odoo
+
+from . import verifactu_hash
+from . import verifactu_sql
+
+_logger = logging.getLogger(__name__)
+
+# Máximo de identificadores de registros anómalos que se conservan por comprobación
+MAX_ANOMALY_IDS = 1000
+
+CHECKS = ('hash', 'chain', 'date')
+
+_CHAIN_QUERY = """
+    SELECT r.id, r.type, r.hash, r.generation_date, r.anterior, a.hash,
+           i.move_name, to_char(i.date_invoice, 'DD-MM-YYYY'), i.type, i.amount_tax, i.amount_total, t.type
+      FROM account_invoice_verifactu r
+      LEFT JOIN account_invoice_verifactu a ON a.id = r.anterior
+      LEFT JOIN account_invoice i ON i.id = r.invoice_id
+      LEFT JOIN account_invoice_verifactu_type t ON t.id = i.verifactu_invoice_type
+     WHERE r.company_id = %s
+       AND r.type IN ('alta', 'anulation')
+       AND r.state IN ('accepted', 'partially_accepted')
+     ORDER BY r.send_date, r.generation_date, r.id
+"""
+
+
+def _row_hash(vat, row):
+    (reg_id, reg_type, reg_hash, generation_date, anterior_id, anterior_hash,
+     move_name, fecha, invoice_type, amount_tax, amount_total, tipo_factura) = row
+    fecha = fecha or ''
+    if reg_type == 'alta':
+        sign = verifactu_hash.amount_sign(invoice_type)
+        cuples = verifactu_hash.alta_cuples(
+            vat, move_name or '', fecha, tipo_factura, (amount_tax or 0.0) * sign, (amount_total or 0.0) * sign,
+            anterior_hash, generation_date)
+    else:
+        cuples = verifactu_hash.anulation_cuples(vat, move_name or '', fecha, anterior_hash, generation_date)
+    return verifactu_hash.compute_hash(cuples)[1]
+
+
+def verify_company_chain(dbname, company_id, vat):
+    '''
+    Recorre la cadena de registros de facturación de una compañía con su propio cursor,
+    de modo que puede ejecutarse en un hilo independiente.
+    Devuelve un dict con el número de registros procesados y las anomalías por comprobación.
+    '''
+    result = {
+        'company_id': company_id,
+        'processed': 0,
+        'anomalies': dict((check, 0) for check in CHECKS),
+        'anomaly_ids': dict((check, []) for check in CHECKS),
+    }
+
+    def anomaly(check, reg_id):
+        result['anomalies'][check] += 1
+        if len(result['anomaly_ids'][check]) < MAX_ANOMALY_IDS:
+            result['anomaly_ids'][check].append(reg_id)
+
+    with closing(odoo.registry(dbname).cursor()) as cr:
+        prev_id = prev_date = None
+        for row in verifactu_sql.stream_rows(cr, 'verifactu_integrity', _CHAIN_QUERY, [company_id]):
+            reg_id, reg_hash, generation_date, anterior_id = row[0], row[2], row[3], row[4]
+            result['processed'] += 1
+            if _row_hash(vat, row) != (reg_hash or '').strip().upper():
+                anomaly('hash', reg_id)
+            if anterior_id != prev_id:
+                anomaly('chain', reg_id)
+            moment = verifactu_hash.parse_generation_date(generation_date)
+            if moment is None or (prev_date is not None and moment < prev_date):
+                anomaly('date', reg_id)
+            prev_id = reg_id
+            prev_date = moment or prev_date
+        # Sólo lectura
+        cr.rollback()
+    _logger.info("Veri*Factu integrity company %s: %s registers, anomalies %s",
+                 company_id, result['processed'], result['anomalies'])
+    return result
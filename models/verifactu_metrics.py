@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+Tiempos por etapa de los registros Veri*Factu (renderizado, firma, sobre SOAP, envío, QR).
+
+Con el parámetro account_verifactu.verifactu_metrics activo, cada etapa instrumentada se mide
+con un reloj monótono y se guarda en account.invoice.verifactu.timing junto con el tamaño del
+payload que produce. Desactivado, el único coste es consultar la configuración (ormcache).
+Las etapas de varios registros a la vez guardan una fila por registro con su parte proporcional
+de la duración y del tamaño; el envío de un lote guarda una única fila del lote.
+'''
+import functools
+import time
+from contextlib import contextmanager
+
+from . import aeat_session
+
+TIMING_MODEL = 'account.invoice.verifactu.timing'
+
+STAGES = [
+    ('update_register_data', 'Datos del registro'),
+    ('generate_register', 'RegistroFactura'),
+    ('sign', 'Firma'),
+    ('soap_envelope', 'Sobre SOAP'),
+    ('send_aeat', 'Envío a la AEAT'),
+    ('aeat_transport', 'Petición HTTP (TLS y AEAT)'),
+    ('pretty_xml', 'Formato de la respuesta'),
+    ('aeat_response', 'Lectura de la respuesta'),
+    ('generate_qr', 'QR'),
+]
+
+# Límites (segundos) de los buckets de los histogramas
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Probe(object):
+    ''' Tamaño (bytes) del payload de la etapa, lo indica quien la mide '''
+    __slots__ = ('size',)
+
+    def __init__(self):
+        self.size = None
+
+
+def payload_size(value):
+    if not value:
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return len(value.encode('utf-8'))
+
+
+@contextmanager
+def measure(records, stage, holder=None):
+    '''
+    Mide el bloque como la etapa ``stage`` de ``records``. Devuelve un Probe para indicar el
+    tamaño del payload o None si la instrumentación está desactivada.
+    Si el bloque lanza una excepción no se guarda nada (la transacción se deshará), salvo los
+    fallos transitorios de la AEAT: el registro vuelve a la cola y su espera sí interesa.
+    '''
+    timing = records.env[TIMING_MODEL]
+    if not timing._enabled():
+        yield None
+        return
+    probe = Probe()
+    start = time.perf_counter()
+    try:
+        yield probe
+    except aeat_session.AeatTransientError:
+        timing._record(stage, records, time.perf_counter() - start, probe.size, holder)
+        raise
+    timing._record(stage, records, time.perf_counter() - start, probe.size, holder)
+
+
+def timed(stage, size=None):
+    '''
+    Decorador de métodos de account.invoice.verifactu medidos como la etapa ``stage``.
+    :param size: función (registros, resultado) que devuelve el tamaño del payload en bytes
+    '''
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            timing = self.env[TIMING_MODEL]
+            if not timing._enabled():
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            elapsed = time.perf_counter() - start
+            timing._record(stage, self, elapsed, size(self, result) if size else None)
+            return result
+        return wrapper
+    return decorate
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _le(bound):
+    return '%g' % bound
+
+
+def render_prometheus(rows):
+    '''
+    Histogramas en formato de texto de Prometheus.
+    :param rows: filas de account.invoice.verifactu.timing._aggregate()
+    '''
+    out = [
+        '# HELP verifactu_stage_duration_seconds Duración de las etapas de los registros Veri*Factu',
+        '# TYPE verifactu_stage_duration_seconds histogram',
+    ]
+    totals = []
+    for row in rows:
+        labels = 'company_id="%s",company="%s",endpoint="%s",stage="%s"' % (
+            row['company_id'] or '', _label(row['company'] or ''), _label(row['endpoint'] or ''), row['stage'])
+        for bound, count in zip(BUCKETS, row['buckets']):
+            out.append('verifactu_stage_duration_seconds_bucket{%s,le="%s"} %s' % (labels, _le(bound), count))
+        out.append('verifactu_stage_duration_seconds_bucket{%s,le="+Inf"} %s' % (labels, row['count']))
+        out.append('verifactu_stage_duration_seconds_sum{%s} %.6f' % (labels, row['seconds']))
+        out.append('verifactu_stage_duration_seconds_count{%s} %s' % (labels, row['count']))
+        totals.append((labels, row))
+    out += [
+        '# HELP verifactu_stage_payload_bytes_total Bytes producidos por las etapas de los registros Veri*Factu',
+        '# TYPE verifactu_stage_payload_bytes_total counter',
+    ]
+    out += ['verifactu_stage_payload_bytes_total{%s} %s' % (labels, row['bytes']) for labels, row in totals]
+    out += [
+        '# HELP verifactu_stage_registers_total Registros procesados por las etapas',
+        '# TYPE verifactu_stage_registers_total counter',
+    ]
+    out += ['verifactu_stage_registers_total{%s} %s' % (labels, row['registers']) for labels, row in totals]
+    return '\n'.join(out) + '\n'
+
+
+def render_json(rows):
+    return [dict(row, buckets=dict(zip([_le(bound) for bound in BUCKETS], row['buckets']))) for row in rows]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+'''
+Compresión y direccionamiento por contenido de los payloads de los registros
+(RegistroFactura, firma, sobre SOAP, respuesta de la AEAT y QR).
+
+Cada payload se identifica por el SHA-256 de su contenido sin comprimir, de modo que
+un mismo contenido (p.ej. el QR que se copia en los registros de anulación) se guarda
+una sola vez. Se comprime con zlib salvo que no reduzca el tamaño (PNG).
+'''
+import zlib
+import hashlib
+
+COMPRESSIONS = [('none', 'Sin comprimir'), ('zlib', 'zlib')]
+
+# Nivel de compresión zlib: los XML comprimen ~10:1 ya con el nivel por defecto
+ZLIB_LEVEL = 6
+
+
+def to_bytes(value):
+    ''' Texto o bytes a bytes UTF-8; False/None/'' a b'' '''
+    if not value:
+        return b''
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def pack(data):
+    '''
+    :param data: bytes sin comprimir
+    :return: (compression, contenido)
+    '''
+    compressed = zlib.compress(data, ZLIB_LEVEL)
+    if len(compressed) < len(data):
+        return 'zlib', compressed
+    return 'none', data
+
+
+def unpack(compression, content):
+    ''' Inversa de pack: devuelve los bytes originales '''
+    if content is None:
+        return b''
+    content = bytes(content)
+    if compression == 'zlib':
+        return zlib.decompress(content)
+    return content
+
+
+def unpack_text(compression, content):
+    data = unpack(compression, content)
+    return data.decode('utf-8') if data else False
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+URL de cotejo del código QR de las facturas y caché de las imágenes PNG.
+
+Sólo la URL se guarda en el registro (qr_url). La imagen se genera al pedirla
+(vista o informe) y se conserva en una caché LRU por proceso, indexada por el
+SHA-1 de la URL: volver a imprimir una factura no vuelve a pasar por reportlab.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode, quote
+
+# Tamaño de la imagen del QR en píxeles
+QR_SIZE = 200
+# Imágenes PNG conservadas en memoria por proceso (~1 KB cada una)
+CACHE_SIZE = 1024
+
+
+def validation_endpoint(endpoint):
+    ''' Servicio de cotejo de la AEAT correspondiente al endpoint SOAP '''
+    return (endpoint or '').replace(
+        '/ws/SistemaFacturacion/VerifactuSOAP', '/ValidarQR').replace(
+        '/ws/SistemaFacturacion/RequerimientoSOAP', '/ValidarQRNoVerifactu').replace(
+        'www1', 'www2')
+
+
+def qr_url(endpoint, nif, num_serie, fecha, importe):
+    '''
+    :param fecha: DD-MM-AAAA
+    :param importe: importe total de la factura
+    '''
+    params = [
+        ('nif', nif),
+        ('numserie', num_serie or ''),   # el '/' se codificará a %2F
+        ('fecha', fecha or ''),
+        ('importe', '{:.2f}'.format(importe or 0.0)),   # punto decimal
+    ]
+    # Codifica SOLO valores de parámetros (mantén ?, &, = sin codificar)
+    return validation_endpoint(endpoint) + '?' + urlencode(params, quote_via=quote, safe='')
+
+
+class PngCache(object):
+    ''' Caché LRU y thread-safe de las imágenes PNG de los QR '''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url, render):
+        '''
+        :param render: función url -> bytes PNG, llamada sólo si la imagen no está en caché
+        '''
+        key = hashlib.sha1(url.encode('utf-8')).digest()
+        with self._lock:
+            png = self._items.get(key)
+            if png is not None:
+                self._items.move_to_end(key)
+                return png
+        png = render(url)
+        with self._lock:
+            self._items[key] = png
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return png
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+png_cache = PngCache()
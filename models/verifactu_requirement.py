@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''
+Verificación y firma en paralelo de los registros de facturación que se remiten a
+requerimiento de la AEAT (SIF no verificable).
+
+Cada hilo del pool decodifica el .p12 una sola vez y recibe tareas (id, registro_factura,
+firmado, refirmar) con el XML ya serializado: los hilos no usan el ORM ni la base de datos.
+Son hilos y no procesos: un fork dentro de un worker de Odoo heredaría sus conexiones a la
+base de datos y los locks del registry. lxml y OpenSSL liberan el GIL durante la
+canonicalización y la firma, que es donde se va el tiempo.
+'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import etree
+
+from . import p12_store
+from . import verifactu_signer
+
+# Resultado de cada tarea
+VALID = 'valid'          # firma correcta, no se modifica
+SIGNED = 'signed'        # registro sin firma, firmado ahora
+RESIGNED = 'resigned'    # firma no válida, firmado de nuevo
+INVALID = 'invalid'      # firma no válida (o XML ilegible), se excluye de la remisión
+
+_PARSER = etree.XMLParser(remove_blank_text=True, recover=False)
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def process_task(engine, task):
+    '''
+    :param task: (id, registro_factura, firmado, refirmar)
+    :return: (id, resultado, registro_factura, signature); los dos últimos sólo si se ha firmado
+    '''
+    reg_id, registro, signed, resign = task
+    if signed:
+        if engine.verify(registro):
+            return reg_id, VALID, None, None
+        if not resign:
+            return reg_id, INVALID, None, None
+    try:
+        root = etree.fromstring(registro.encode('utf-8'), parser=_PARSER)
+    except etree.XMLSyntaxError:
+        return reg_id, INVALID, None, None
+    for signature in root.findall('{%s}Signature' % verifactu_signer.DS_NS):
+        root.remove(signature)
+    signed_root, signature = engine.sign(root)
+    registro_factura, signature = verifactu_signer.serialize(signed_root, signature)
+    return reg_id, RESIGNED if signed else SIGNED, registro_factura, signature
+
+
+class SigningPool(object):
+    '''
+    Pool de hilos de verificación y firma con el certificado de una compañía.
+    Con un solo worker las tareas se procesan en el propio hilo.
+    '''
+
+    def __init__(self, p12_data, p12_password, workers):
+        self.workers = max(1, workers or 1)
+        self._p12 = (p12_data, p12_password)
+        # Motor de firma de cada hilo: se construye en su primera tarea
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+
+    def _engine(self):
+        engine = getattr(self._local, 'engine', None)
+        if engine is None:
+            engine = self._local.engine = p12_store.build_bundle(None, *self._p12).register_signer
+        return engine
+
+    def _task(self, task):
+        return process_task(self._engine(), task)
+
+    def process(self, tasks):
+        ''' Resultados de las tareas, en el mismo orden '''
+        if self._pool is None:
+            return [self._task(task) for task in tasks]
+        return list(self._pool.map(self._task, tasks))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
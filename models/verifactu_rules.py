@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+Tabla de decisión precompilada de los tipos de factura Veri*Factu (F1-F3 / R1-R5).
+
+Las reglas de account_invoice (ver REGLAS DE OBLIGADO CUMPLIMIENTO) sólo dependen del tipo
+de la factura y de si existen el cliente, la factura sustituida/rectificada y el cliente de
+ésta. La tabla se calcula una vez al importar el módulo para todas las combinaciones, de
+modo que decidir una factura es una consulta a un dict.
+'''
+from collections import namedtuple
+
+Rule = namedtuple('Rule', [
+    'type',                   # tipo de factura obligado (None: no se fuerza)
+    'partner_from_replaced',  # el cliente debe ser el de la factura rectificada
+    'invoice_type',           # código Veri*Factu por defecto (False: vacío, None: sin regla)
+    'keep',                   # se conserva el código actual si está entre los admitidos
+    'allowed',                # códigos admitidos
+    'clear_replaced',         # la factura rectificada debe quedar vacía
+])
+
+INVOICE_TYPES = ('out_invoice', 'out_refund', 'in_invoice', 'in_refund', 'replaced')
+PURCHASE_TYPES = ('in_invoice', 'in_refund')
+RECTIFICATIVAS_ORDINARIAS = ('R1', 'R2', 'R3', 'R4')
+
+NO_RULE = Rule(None, False, None, False, (), False)
+
+
+def _rule(invoice_type, has_partner, has_replaced, replaced_has_partner):
+    ''' Reglas de obligado cumplimiento para una combinación de condiciones '''
+    # Compras: sin tipo Veri*Factu ni factura rectificada
+    if invoice_type in PURCHASE_TYPES:
+        return Rule(None, False, False, False, (), True)
+    if has_replaced:
+        # Rectificativa de factura ordinaria: R4 por defecto, admite R1-R4
+        if replaced_has_partner:
+            return Rule('out_refund', True, 'R4', True, RECTIFICATIVAS_ORDINARIAS, False)
+        # Rectificativa de factura simplificada
+        if not has_partner:
+            return Rule('out_refund', False, 'R5', False, ('R5',), False)
+        # Sustitución (canje) de factura simplificada
+        return Rule('replaced', False, 'F3', False, ('F3',), False)
+    if has_partner:
+        if invoice_type == 'out_invoice':
+            return Rule(None, False, 'F1', False, ('F1',), False)
+        if invoice_type == 'out_refund':
+            return Rule(None, False, 'R4', True, RECTIFICATIVAS_ORDINARIAS, False)
+        return NO_RULE
+    # Factura simplificada
+    return Rule('out_invoice', False, 'F2', False, ('F2',), False)
+
+
+TABLE = dict(
+    ((invoice_type, has_partner, has_replaced, replaced_has_partner),
+     _rule(invoice_type, has_partner, has_replaced, replaced_has_partner))
+    for invoice_type in INVOICE_TYPES + (None,)
+    for has_partner in (False, True)
+    for has_replaced in (False, True)
+    for replaced_has_partner in ((False, True) if has_replaced else (False,))
+)
+
+
+def lookup(invoice_type, has_partner, has_replaced, replaced_has_partner):
+    return TABLE[(invoice_type if invoice_type in INVOICE_TYPES else None, bool(has_partner),
+                  bool(has_replaced), bool(has_replaced and replaced_has_partner))]
+
+
+def resolve(rule, current_code):
+    '''
+    Código Veri*Factu que debe tener la factura según la regla: None si no hay que cambiarlo,
+    False si debe quedar vacío.
+    '''
+    if rule.invoice_type is None:
+        return None
+    if rule.invoice_type is False:
+        return False
+    if rule.keep and current_code in rule.allowed:
+        return None
+    return rule.invoice_type
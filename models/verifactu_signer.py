@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''
+Motor de firma XMLDSig Enveloped de los registros de facturación (SIF no verificable).
+
+Cada certificado de compañía tiene un RegisterSigner (ver p12_store) con la clave, la cadena
+de certificados ya serializada y el XMLSigner preparados. La firma se hace sobre el árbol
+lxml que construye verifactu_xml, sin serializar ni volver a parsear el registro, y el
+registro se guarda tal y como se ha firmado para que la firma siga siendo verificable.
+'''
+import threading
+
+from lxml import etree
+from signxml import XMLVerifier
+from signxml.exceptions import InvalidSignature, InvalidInput
+from cryptography.hazmat.primitives import serialization
+
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+
+# Sangría con la que se firma y guarda el registro (la misma que pretty_print)
+INDENT = '  '
+
+
+class RegisterSigner(object):
+    ''' Firmante reutilizable de un certificado: firma uno o varios registros por llamada '''
+
+    # Algunas versiones de signxml no aceptan la cadena como objetos/PEM en ``cert`` y
+    # necesitan ``cert_chain`` en DER: se averigua en la primera firma y se recuerda.
+    _use_der_chain = None
+
+    def __init__(self, signer, private_key, certificates):
+        self.signer = signer
+        self.private_key = private_key
+        self.chain_pem = [c.public_bytes(serialization.Encoding.PEM).decode('ascii') for c in certificates]
+        self.chain_der = [c.public_bytes(serialization.Encoding.DER) for c in certificates]
+        # XMLSigner guarda estado durante sign(): un solo hilo a la vez por firmante
+        self._lock = threading.Lock()
+
+    def _sign(self, node):
+        if not RegisterSigner._use_der_chain:
+            try:
+                return self.signer.sign(node, key=self.private_key, cert=self.chain_pem,
+                                        key_name=None, always_add_key_value=True)
+            except TypeError:
+                if RegisterSigner._use_der_chain is False:
+                    raise
+                RegisterSigner._use_der_chain = True
+            else:
+                RegisterSigner._use_der_chain = False
+        return self.signer.sign(node, key=self.private_key, cert_chain=self.chain_der,
+                                key_name=None, always_add_key_value=True)
+
+    def sign(self, node):
+        '''
+        Firma el registro (elemento lxml sin firma). El registro se indenta antes de firmar:
+        su serialización con pretty_print conserva exactamente el contenido firmado.
+        :return: (registro firmado, elemento <ds:Signature>)
+        '''
+        etree.indent(node, space=INDENT)
+        with self._lock:
+            signed = self._sign(node)
+        signature = signed.find('{%s}Signature' % DS_NS)
+        if signature is None:
+            raise ValueError("No se pudo localizar el elemento <Signature> en la firma generada.")
+        return signed, signature
+
+    def sign_many(self, nodes):
+        ''' Firma varios registros con la misma clave y firmante '''
+        return [self.sign(node) for node in nodes]
+
+    def verify(self, registro):
+        '''
+        Comprueba la firma del registro serializado (registro_factura) con el certificado
+        del firmante. Cualquier cambio del contenido firmado, incluidos los espacios, la invalida.
+        '''
+        data = registro.encode('utf-8') if isinstance(registro, str) else registro
+        try:
+            XMLVerifier().verify(data, x509_cert=self.chain_pem[0])
+        except (InvalidSignature, InvalidInput, etree.XMLSyntaxError):
+            return False
+        return True
+
+
+def serialize(signed, signature):
+    ''' (registro_factura, signature) tal y como se guardan en el registro '''
+    return (etree.tostring(signed, pretty_print=True, encoding='unicode'),
+            etree.tostring(signature, encoding='unicode'))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+'''
+Lectura en streaming de consultas grandes mediante cursores de servidor (DECLARE / FETCH),
+de modo que el consumo de memoria no depende del número de filas.
+'''
+FETCH_SIZE = 2000
+
+
+def stream_rows(cr, name, query, params=None, fetch_size=FETCH_SIZE):
+    '''
+    Generador de las filas de ``query`` leídas de ``fetch_size`` en ``fetch_size`` a través del
+    cursor de servidor ``name``. Debe consumirse dentro de la transacción del cursor ``cr``.
+    '''
+    cr.execute("DECLARE %s NO SCROLL CURSOR FOR %s" % (name, query), params or [])
+    try:
+        while True:
+            cr.execute("FETCH FORWARD %d FROM %s" % (fetch_size, name))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cr.execute("CLOSE %s" % name)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+'''
+Construcción nativa (lxml) de los registros RegistroAlta y RegistroAnulacion
+y del sobre SOAP RegFactuSistemaFacturacion.
+
+Genera directamente el mismo XML que producen las plantillas QWeb
+``account_verifactu.RegistroAlta`` / ``account_verifactu.RegistroAnulacion``
+seguidas de ``pretty_xml``, sin pasar por el motor de plantillas ni por el
+ciclo render -> parse -> serialize.
+'''
+from lxml import etree
+from lxml.builder import ElementMaker
+
+from . import verifactu_hash
+
+SUM1_NS = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroInformacion.xsd'
+
+SOAPENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+SUM_NS = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd'
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+
+SUM1 = ElementMaker(namespace=SUM1_NS, nsmap={'sum1': SUM1_NS})
+SOAPENV = ElementMaker(namespace=SOAPENV_NS)
+SUM = ElementMaker(namespace=SUM_NS)
+
+ENVELOPE_NSMAP = {'soapenv': SOAPENV_NS, 'sum': SUM_NS, 'sum1': SUM1_NS, 'ds': DS_NS}
+
+RECTIFICATIVAS = ('R1', 'R2', 'R3', 'R4', 'R5')
+
+_PARSER = etree.XMLParser(remove_blank_text=True, recover=False)
+# Los registros firmados se insertan sin tocar sus espacios: forman parte de lo firmado
+_SIGNED_PARSER = etree.XMLParser(remove_blank_text=False, recover=False)
+
+
+def _text(value):
+    ''' Igual que t-esc/t-raw: False/None no escriben nada y el resto se pasa a str. '''
+    if value is None or value is False:
+        return None
+    value = value if isinstance(value, str) else str(value)
+    # Un elemento vacío se serializa como <tag/>, igual que tras el reparseo de pretty_xml
+    return value or None
+
+
+def _el(tag, value=None):
+    node = SUM1(tag)
+    node.text = _text(value)
+    return node
+
+
+def _amount(value):
+    return '{:.2f}'.format(value)
+
+
+def _encadenamiento(register):
+    anterior = register.anterior
+    if anterior:
+        return SUM1.Encadenamiento(
+            SUM1.RegistroAnterior(
+                _el('IDEmisorFactura', anterior.invoice_id.company_id.partner_id.vat_clean()[1]),
+                _el('NumSerieFactura', anterior.invoice_id.move_name),
+                _el('FechaExpedicionFactura', anterior.date_invoice),
+                _el('Huella', anterior.hash),
+            ))
+    return SUM1.Encadenamiento(_el('PrimerRegistro', 'S'))
+
+
+def _sistema_informatico(company):
+    return SUM1.SistemaInformatico(
+        _el('NombreRazon', company.verifactu_razon_social),
+        _el('NIF', company.vat_clean()[1]),
+        _el('NombreSistemaInformatico', 'Odoo'),
+        _el('IdSistemaInformatico', 'OD'),
+        _el('Version', '11.0.0'),
+        _el('NumeroInstalacion', company.id),
+        _el('TipoUsoPosibleSoloVerifactu', 'N'),
+        _el('TipoUsoPosibleMultiOT', 'N'),
+        _el('IndicadorMultiplesOT', 'N'),
+    )
+
+
+def _append_signature(node, register):
+    if register.signature:
+        node.append(etree.fromstring(register.signature.encode('utf-8'), parser=_PARSER))
+    return node
+
+
+def _detalle_desglose(tax_line, sign):
+    tax = tax_line.tax_id
+    exenta = (round(tax_line.amount_total, 2) == 0.00) and (round(tax_line.base * tax.amount / 100, 2) != 0.00) \
+        or (round(tax.amount / 100, 2) == 0.00)
+    return SUM1.DetalleDesglose(
+        _el('Impuesto', tax.verifactu_impuesto),
+        _el('ClaveRegimen', tax.verifactu_regimen),
+        _el('OperacionExenta', tax.verifactu_exento) if exenta
+        else _el('CalificacionOperacion', tax.verifactu_calificacion),
+        _el('TipoImpositivo', _amount(tax.amount or 0.00)),
+        _el('BaseImponibleOimporteNoSujeto', _amount(tax_line.base * sign)),
+        _el('CuotaRepercutida', _amount(tax_line.amount_total * sign)),
+    )
+
+
+def build_alta(register):
+    ''' Devuelve el elemento sum1:RegistroAlta del registro. '''
+    invoice = register.invoice_id
+    company = invoice.company_id
+    tipo_factura = invoice.verifactu_invoice_type.type
+    # Mismo signo que la huella (generate_hash): según el tipo de la factura
+    sign = verifactu_hash.amount_sign(invoice.type)
+
+    node = SUM1.RegistroAlta(
+        _el('IDVersion', '1.0'),
+        SUM1.IDFactura(
+            _el('IDEmisorFactura', company.partner_id.vat_clean()[1]),
+            _el('NumSerieFactura', invoice.move_name),
+            _el('FechaExpedicionFactura', register.date_invoice),
+        ),
+        _el('NombreRazonEmisor', company.verifactu_razon_social),
+        _el('Subsanacion', register.subsanacion),
+        _el('RechazoPrevio', register.rechazo_previo),
+        _el('TipoFactura', tipo_factura),
+    )
+    if tipo_factura in RECTIFICATIVAS:
+        node.append(_el('TipoRectificativa', 'I'))
+    node.extend([
+        _el('DescripcionOperacion', company.verifactu_operation),
+        SUM1.Destinatarios(
+            SUM1.IDDestinatario(
+                _el('NombreRazon', invoice.partner_id.name),
+                _el('NIF', invoice.partner_id.vat_clean()[1]),
+            )),
+        SUM1.Desglose(*[_detalle_desglose(tax_line, sign) for tax_line in invoice.tax_line_ids]),
+        _el('CuotaTotal', _amount(invoice.amount_tax * sign)),
+        _el('ImporteTotal', _amount(invoice.amount_total * sign)),
+        _encadenamiento(register),
+        _sistema_informatico(company),
+        _el('FechaHoraHusoGenRegistro', register.generation_date),
+        _el('TipoHuella', '01'),
+        _el('Huella', register.hash),
+    ])
+    return _append_signature(node, register)
+
+
+def build_anulacion(register):
+    ''' Devuelve el elemento sum1:RegistroAnulacion del registro. '''
+    invoice = register.invoice_id
+    company = invoice.company_id
+    node = SUM1.RegistroAnulacion(
+        _el('IDVersion', '1.0'),
+        SUM1.IDFactura(
+            _el('IDEmisorFacturaAnulada', company.partner_id.vat_clean()[1]),
+            _el('NumSerieFacturaAnulada', invoice.move_name),
+            _el('FechaExpedicionFacturaAnulada', register.date_invoice),
+        ),
+        _el('SinRegistroPrevio', register.sin_registro_previo),
+        _el('RechazoPrevio', register.rechazo_previo),
+        _encadenamiento(register),
+        _sistema_informatico(company),
+        _el('FechaHoraHusoGenRegistro', register.generation_date),
+        _el('TipoHuella', '01'),
+        _el('Huella', register.hash),
+    )
+    return _append_signature(node, register)
+
+
+BUILDERS = {
+    'alta': build_alta,
+    'anulation': build_anulacion,
+}
+
+
+def build_unsigned(register):
+    ''' Elemento del registro sin <ds:Signature>, para firmarlo; None si no hay constructor nativo '''
+    builder = BUILDERS.get(register.type)
+    if builder is None:
+        return None
+    node = builder(register)
+    for signature in node.findall('{%s}Signature' % DS_NS):
+        node.remove(signature)
+    return node
+
+
+def render_register(register):
+    '''
+    Devuelve el registro serializado igual que ``pretty_xml(..., xml_declaration=False)``
+    o None si el tipo de registro no tiene constructor nativo.
+    '''
+    builder = BUILDERS.get(register.type)
+    if builder is None:
+        return None
+    return etree.tostring(builder(register), pretty_print=True, encoding='unicode')
+
+
+def render_envelope(company, registros, requerimiento=None):
+    '''
+    Devuelve el sobre SOAP (con declaración XML) para los RegistroFactura ya generados
+    ``registros`` de la compañía ``company``. Equivale a la plantilla ``account_verifactu.soap_request``.
+    :param requerimiento: (RefRequerimiento, FinRequerimiento S/N) en la remisión de registros
+        de un SIF no verificable a requerimiento de la AEAT
+    '''
+    root = etree.Element(etree.QName(SOAPENV_NS, 'Envelope'), nsmap=ENVELOPE_NSMAP)
+    root.append(SOAPENV.Header())
+    cabecera = SUM.Cabecera(
+        SUM1.ObligadoEmision(
+            _el('NombreRazon', company.verifactu_razon_social),
+            _el('NIF', company.vat_clean()[1]),
+        ))
+    if requerimiento:
+        cabecera.append(SUM1.RemisionRequerimiento(
+            _el('RefRequerimiento', requerimiento[0]),
+            _el('FinRequerimiento', requerimiento[1]),
+        ))
+    reg_factu = SUM.RegFactuSistemaFacturacion(cabecera)
+    for registro in registros:
+        parser = _SIGNED_PARSER if DS_NS in registro else _PARSER
+        reg_factu.append(SUM.RegistroFactura(etree.fromstring(registro.encode('utf-8'), parser=parser)))
+    root.append(SOAPENV.Body(reg_factu))
+    return etree.tostring(root, pretty_print=True, encoding='UTF-8', xml_declaration=True).decode('utf-8')
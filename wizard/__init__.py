@@ -1,2 +1,3 @@
 # -*- coding: utf-8 -*-
-from . import account_invoice_verifactu_refund
\ No newline at end of file
+from . import account_invoice_verifactu_refund
+from . import account_invoice_verifactu_export
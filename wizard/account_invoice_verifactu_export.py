@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+
+from ..models.verifactu_export import EXPORT_FORMATS
+
+# Tamaño de bloque con el que se lee el zip para calcular su checksum
+_BLOCK_SIZE = 1 << 20
+
+
+class AccountInvoiceVerifactuExport(models.TransientModel):
+    """Exportación de registros de facturación de un periodo (evento 08)"""
+
+    _name = "account.invoice.verifactu.export"
+    _description = "Verifactu Period Export"
+
+    company_id = fields.Many2one('res.company', required=True, default=lambda self: self.env.user.company_id)
+    date_from = fields.Date(string='Date from', required=True)
+    date_to = fields.Date(string='Date to', required=True, default=fields.Date.context_today)
+    export_format = fields.Selection(EXPORT_FORMATS, string='Format', required=True, default='ndjson')
+
+    @api.multi
+    def action_export(self):
+        self.ensure_one()
+        if self.date_from > self.date_to:
+            raise UserError(_("The start date must be before the end date."))
+        event, path = self.env['account.invoice.verifactu']._export_period(
+            self.company_id.id, self.date_from, self.date_to, self.export_format)
+        name = 'verifactu_%s_%s_%s.zip' % (self.company_id.vat or self.company_id.id, self.date_from, self.date_to)
+        attachment = self._store_archive(path, name, event)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/account_verifactu/export/%s' % attachment.id,
+            'target': 'self',
+        }
+
+    @api.model
+    def _store_archive(self, path, name, record):
+        '''
+        Adjunta el zip temporal ``path`` a ``record`` moviéndolo al filestore, sin cargarlo en
+        memoria: el adjunto se crea con su store_fname y /account_verifactu/export lo sirve por bloques.
+        '''
+        Attachment = self.env['ir.attachment']
+        sha = hashlib.sha1()
+        try:
+            with open(path, 'rb') as archive:
+                for block in iter(lambda: archive.read(_BLOCK_SIZE), b''):
+                    sha.update(block)
+            file_size = os.path.getsize(path)
+            checksum = sha.hexdigest()
+            store_fname, full_path = Attachment._get_path(None, checksum)
+            if not os.path.exists(full_path):
+                shutil.move(path, full_path)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        attachment = Attachment.create({
+            'name': name,
+            'datas_fname': name,
+            'mimetype': 'application/zip',
+            'store_fname': store_fname,
+            'res_model': record._name,
+            'res_id': record.id,
+        })
+        # ir.attachment calcula file_size y checksum a partir de datas, que aquí no se carga
+        self.env.cr.execute("UPDATE ir_attachment SET file_size = %s, checksum = %s WHERE id = %s",
+                            [file_size, checksum, attachment.id])
+        attachment.invalidate_cache(['file_size', 'checksum'], attachment.ids)
+        return attachment
@@ -109,7 +109,7 @@ class AccountInvoiceVerifactuRefund(models.TransientModel):
                             'date': date,
                             'origin': inv.origin,
                             'fiscal_position_id': inv.fiscal_position_id.id,
-                            'verifactu_invoice_type': inv_verifactu_type_obj.search([('type','=',inv.description)],limit = 1).id,
+                            'verifactu_invoice_type': inv_verifactu_type_obj._get_type_ids().get(inv.description, False),
                             'verifactu_replaced_invoice': inv.id,
                         })
                         for field in inv_obj._get_refund_common_fields():